@@ -0,0 +1,267 @@
+"""
+Benchmarks of tracking, hashing, the local cache and push/pull
+
+Each run generates synthetic projects in a temporary directory, with the lazydata cache in a separate
+LAZYDATA_HOME, and uses a `file://` remote as a network-free stand-in for S3. Results are written as JSON,
+so runs on different commits can be compared:
+
+    python benchmarks/run_benchmarks.py --scale small --output before.json
+    git checkout my-branch
+    python benchmarks/run_benchmarks.py --scale small --output after.json
+    python benchmarks/run_benchmarks.py --compare before.json after.json
+"""
+
+from argparse import ArgumentParser, Namespace
+from contextlib import redirect_stdout
+from pathlib import Path
+import json
+import os
+import platform
+import runpy
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+# (number of small files, size of a small file, sizes of the big files)
+SCALES = {
+    "tiny": (100, 4 * 1024, [1024 * 1024, 16 * 1024 * 1024]),
+    "small": (1000, 16 * 1024, [1024 * 1024, 64 * 1024 * 1024, 256 * 1024 * 1024]),
+    "medium": (10000, 64 * 1024, [16 * 1024 * 1024, 1024 * 1024 * 1024, 4 * 1024 * 1024 * 1024]),
+    "large": (100000, 64 * 1024, [1024 * 1024 * 1024, 16 * 1024 * 1024 * 1024, 32 * 1024 * 1024 * 1024]),
+}
+
+# Number of timed calls of the track() hot path
+HOT_PATH_CALLS = 200
+
+# The script in the generated project calling track(), so the usage is recorded relative to the project
+TRACK_SCRIPT = """
+from lazydata import track
+
+def track_all(paths):
+    for path in paths:
+        track(path)
+"""
+
+BLOCK = os.urandom(1024 * 1024)
+
+
+def write_file(path:Path, size:int, seed:int):
+    """
+    Write a file of `size` bytes with content unique to the seed, without paying for a random number generator
+    """
+    path.parent.mkdir(parents=True, exist_ok=True)
+    header = ("%d\n" % seed).encode("utf-8")
+    with open(str(path), "wb") as fp:
+        fp.write(header[:size])
+        remaining = size - min(len(header), size)
+        while remaining > 0:
+            fp.write(BLOCK[:min(remaining, len(BLOCK))])
+            remaining -= len(BLOCK)
+
+
+def percentile(samples:list, fraction:float) -> float:
+    samples = sorted(samples)
+    return samples[min(len(samples) - 1, int(fraction * len(samples)))]
+
+
+class Benchmarks:
+
+    def __init__(self, root:Path, num_files:int, small_size:int, big_sizes:list):
+        self.root = root
+        self.num_files = num_files
+        self.small_size = small_size
+        self.big_sizes = big_sizes
+        self.results = []
+
+        self.project = Path(root, "project")
+        self.remote = Path(root, "remote")
+        self.project.mkdir()
+        self.remote.mkdir()
+        with open(str(Path(self.project, "lazydata.yml")), "w") as fp:
+            fp.write("version: 1\n")
+        with open(str(Path(self.project, "track_files.py")), "w") as fp:
+            fp.write(TRACK_SCRIPT)
+        os.chdir(str(self.project))
+
+        # imported here as the cache location is read from LAZYDATA_HOME on import
+        from lazydata import metrics
+        from lazydata.config.config import Config
+        from lazydata.storage.local import LocalStorage
+        self.metrics = metrics
+        self.Config = Config
+        self.local = LocalStorage()
+        self.track_all = runpy.run_path(str(Path(self.project, "track_files.py")))["track_all"]
+
+    def record(self, name:str, seconds:float, params:dict, num_bytes:int = 0, ops:int = 0, **extra):
+        result = {"name": name, "params": params, "seconds": seconds, "metrics": self.metrics.snapshot()}
+        if num_bytes:
+            result["bytes_per_second"] = num_bytes / seconds
+        if ops:
+            result["ops_per_second"] = ops / seconds
+        result.update(extra)
+        self.results.append(result)
+        # progress goes to stderr, the results might be written to stdout
+        print("%-28s %-32s %10.3fs %s" % (name, json.dumps(params), seconds,
+                                          " ".join("%s=%.4g" % (k, v) for k, v in result.items()
+                                                   if isinstance(v, float) and k != "seconds")),
+              file=sys.stderr)
+
+    def timed(self, fn, *args):
+        self.metrics.reset()
+        start = time.perf_counter()
+        with open(os.devnull, "w") as devnull, redirect_stdout(devnull):
+            fn(*args)
+        return time.perf_counter() - start
+
+    def run(self):
+        from lazydata.storage.hash import calculate_file_sha256
+
+        # hashing and the local cache, on files of different sizes
+        for size in self.big_sizes:
+            path = Path(self.project, "big", "file_%d.bin" % size)
+            write_file(path, size, seed=size)
+
+            seconds = self.timed(calculate_file_sha256, str(path))
+            self.record("hash", seconds, {"size": size}, num_bytes=size)
+
+            seconds = self.timed(self.local.store_file, str(path))
+            self.record("store_file", seconds, {"size": size}, num_bytes=size)
+
+            sha256 = calculate_file_sha256(str(path))
+            copy_path = Path(self.root, "copy.bin")
+            seconds = self.timed(self.local.copy_file_to, sha256, str(copy_path))
+            self.record("copy_file_to", seconds, {"size": size}, num_bytes=size)
+            copy_path.unlink()
+
+            # tracked as well, to be part of the push and pull
+            self.timed(self.track_all, [str(path.relative_to(self.project))])
+
+        # tracking many small files for the first time
+        paths = []
+        for i in range(self.num_files):
+            path = Path("small", "%03d" % (i % 1000), "file_%d.bin" % i)
+            write_file(Path(self.project, path), self.small_size, seed=i)
+            paths.append(str(path))
+
+        seconds = self.timed(self.track_all, paths)
+        self.record("track_new", seconds, {"files": self.num_files, "size": self.small_size},
+                    num_bytes=self.num_files * self.small_size, ops=self.num_files)
+
+        # the hot path: tracking a file that is already tracked and unchanged
+        latencies = []
+        with open(os.devnull, "w") as devnull, redirect_stdout(devnull):
+            self.metrics.reset()
+            for i in range(HOT_PATH_CALLS):
+                start = time.perf_counter()
+                self.track_all([paths[i % len(paths)]])
+                latencies.append(time.perf_counter() - start)
+        self.record("track_hot_path", sum(latencies), {"calls": HOT_PATH_CALLS, "tracked_files": self.num_files},
+                    ops=HOT_PATH_CALLS, p50=percentile(latencies, 0.5), p95=percentile(latencies, 0.95),
+                    p99=percentile(latencies, 0.99))
+
+        # push and pull against the file:// remote
+        from lazydata.cli.commands.pull import PullCommand
+        from lazydata.cli.commands.push import PushCommand
+        from lazydata.storage.remote import RemoteStorage
+
+        config = self.Config()
+        config.add_remote("file://%s" % str(self.remote), None)
+        total_bytes = self.num_files * self.small_size + sum(self.big_sizes)
+        num_files = self.num_files + len(self.big_sizes)
+
+        seconds = self.timed(PushCommand().handle, Namespace(replicate=False, mirrors_only=False))
+        self.record("push", seconds, {"files": num_files}, num_bytes=total_bytes, ops=num_files)
+
+        seconds = self.timed(PushCommand().handle, Namespace(replicate=False, mirrors_only=False))
+        self.record("push_no_changes", seconds, {"files": num_files}, ops=num_files)
+
+        # pull into an empty cache and project
+        shutil.rmtree(str(self.local.data_path))
+        shutil.rmtree(str(Path(self.project, "small")))
+        shutil.rmtree(str(Path(self.project, "big")))
+        RemoteStorage.clear_registry()
+        seconds = self.timed(PullCommand().handle, Namespace(artefacts=[]))
+        self.record("pull", seconds, {"files": num_files}, num_bytes=total_bytes, ops=num_files)
+
+        # pull from the local cache into an empty project
+        shutil.rmtree(str(Path(self.project, "small")))
+        shutil.rmtree(str(Path(self.project, "big")))
+        seconds = self.timed(PullCommand().handle, Namespace(artefacts=[]))
+        self.record("pull_cached", seconds, {"files": num_files}, num_bytes=total_bytes, ops=num_files)
+
+        seconds = self.timed(PullCommand().handle, Namespace(artefacts=[]))
+        self.record("pull_no_changes", seconds, {"files": num_files}, ops=num_files)
+
+
+def environment() -> dict:
+    try:
+        commit = subprocess.check_output(["git", "rev-parse", "HEAD"], cwd=str(Path(__file__).parent),
+                                         stderr=subprocess.DEVNULL).decode("utf-8").strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {
+        "commit": commit,
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpus": os.cpu_count(),
+        "time": time.time(),
+    }
+
+
+def compare(before_path:str, after_path:str):
+    with open(before_path) as fp:
+        before = json.load(fp)
+    with open(after_path) as fp:
+        after = json.load(fp)
+
+    print("%s -> %s" % (before["environment"]["commit"], after["environment"]["commit"]))
+    before_results = {(r["name"], json.dumps(r["params"], sort_keys=True)): r for r in before["results"]}
+    for result in after["results"]:
+        key = (result["name"], json.dumps(result["params"], sort_keys=True))
+        if key not in before_results:
+            continue
+        old = before_results[key]["seconds"]
+        print("%-28s %-32s %10.3fs %10.3fs %+7.1f%%" % (result["name"], key[1], old, result["seconds"],
+                                                         100.0 * (result["seconds"] - old) / old if old else 0.0))
+
+
+def main():
+    parser = ArgumentParser(description="Benchmark lazydata on synthetic projects")
+    parser.add_argument("--scale", choices=sorted(SCALES), default="small", help="Size of the generated projects")
+    parser.add_argument("--files", type=int, help="Override the number of small files")
+    parser.add_argument("--output", type=str, help="Write the results as JSON to this file")
+    parser.add_argument("--workdir", type=str, help="Where to generate the projects (default: a temporary dir)")
+    parser.add_argument("--compare", type=str, nargs=2, metavar=("BEFORE", "AFTER"),
+                        help="Compare two result files instead of running the benchmarks")
+    args = parser.parse_args()
+
+    if args.compare:
+        compare(*args.compare)
+        return
+
+    num_files, small_size, big_sizes = SCALES[args.scale]
+    if args.files is not None:
+        num_files = args.files
+
+    root = Path(tempfile.mkdtemp(prefix="lazydata-bench-", dir=args.workdir))
+    os.environ["LAZYDATA_HOME"] = str(Path(root, "home"))
+    cwd = os.getcwd()
+    try:
+        benchmarks = Benchmarks(root, num_files, small_size, big_sizes)
+        benchmarks.run()
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(str(root), ignore_errors=True)
+
+    report = {"environment": environment(), "scale": args.scale, "results": benchmarks.results}
+    if args.output:
+        with open(args.output, "w") as fp:
+            json.dump(report, fp, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+
+
+if __name__ == "__main__":
+    main()
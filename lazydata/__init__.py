@@ -1,4 +1,4 @@
-from .tracker import track
+from .tracker import track, prefetch, load, output, open_tracked as open, map_tracked as mmap
 
 name = "lazydata"
 
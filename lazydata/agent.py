@@ -0,0 +1,295 @@
+"""
+A long-running per-user agent answering track() calls over a Unix socket
+
+Starting a Python process that uses lazydata costs parsing the config, opening the metadb and setting up
+the remote clients. With `lazydata agent` running, track() sends the request to the agent instead, which
+keeps all of that warm and shares downloads between processes. Without a running agent (or with
+LAZYDATA_AGENT=0) track() works in-process as usual.
+
+The protocol is one JSON object per line in each direction.
+"""
+
+from pathlib import Path
+from typing import Optional
+import builtins
+import io
+import json
+import os
+import socket
+import socketserver
+import sys
+import threading
+
+from lazydata.storage.local import BASE_PATH
+
+AGENT_SOCKET_PATH = Path(BASE_PATH, "agent.sock")
+# Set to 0 to never use the agent
+AGENT_ENV_VAR = "LAZYDATA_AGENT"
+
+_client = None
+_client_lock = threading.Lock()
+
+
+class AgentError(RuntimeError):
+    pass
+
+
+def _agent_exception(error_type:str, message:str) -> Exception:
+    """
+    Rebuild an exception raised in the agent, so callers get the same type as without the agent
+    """
+    exception_type = getattr(builtins, error_type or "", None)
+    if isinstance(exception_type, type) and issubclass(exception_type, Exception):
+        try:
+            return exception_type(message)
+        except TypeError:
+            # e.g. UnicodeDecodeError, which needs more arguments
+            pass
+    return AgentError(message)
+
+
+class AgentClient:
+    """
+    A connection to the agent, kept open for the life of the process
+    """
+
+    def __init__(self, socket_path:str):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.connect(socket_path)
+        self.reader = self.sock.makefile("rb")
+        self.pid = os.getpid()
+
+    def request(self, request:dict) -> dict:
+        self.sock.sendall(json.dumps(request).encode("utf-8") + b"\n")
+        line = self.reader.readline()
+        if not line:
+            raise ConnectionError("The lazydata agent closed the connection.")
+        return json.loads(line.decode("utf-8"))
+
+    def close(self):
+        self.reader.close()
+        self.sock.close()
+
+
+def agent_request(request:dict) -> Optional[dict]:
+    """
+    Send a request to the agent, if it's running
+
+    :param request: The request, with an `op` key
+    :return: The response, or None if there's no agent to answer it
+    """
+    global _client
+
+    if os.environ.get(AGENT_ENV_VAR, "") == "0" or not AGENT_SOCKET_PATH.exists():
+        return None
+
+    with _client_lock:
+        try:
+            if _client is None or _client.pid != os.getpid():
+                # connections are not shared with forked children
+                _client = AgentClient(str(AGENT_SOCKET_PATH))
+            response = _client.request(request)
+        except (OSError, ValueError):
+            # the agent went away, fall back to doing the work in-process
+            if _client is not None:
+                _client.close()
+            _client = None
+            return None
+
+    if response.get("output"):
+        sys.stdout.write(response["output"])
+    if not response["ok"]:
+        raise _agent_exception(response.get("error_type"), response["error"])
+    return response
+
+
+def agent_track(path:str, source_url:Optional[str], script_location:str) -> bool:
+    """
+    Track a file through the agent
+
+    :return: True if the agent tracked the file, False if there's no agent
+    """
+    abs_path = os.path.abspath(path)
+    response = agent_request({
+        "op": "track",
+        "path": abs_path,
+        "display_path": path,
+        "source_url": source_url,
+        "script": os.path.abspath(script_location) if script_location else "",
+        "cwd": os.getcwd(),
+    })
+    return response is not None
+
+
+def agent_prefetch(script_path:str) -> bool:
+    """
+    Start a prefetch of the files a script uses in the agent
+
+    :return: True if the agent started it, False if there's no agent
+    """
+    response = agent_request({"op": "prefetch", "script": os.path.abspath(script_path), "cwd": os.getcwd()})
+    return response is not None
+
+
+class ProjectState:
+    """
+    The warm state of one project: its config and the prefetcher shared by all the clients
+    """
+
+    def __init__(self, config_path:Path, local):
+        from lazydata.config.config import Config
+        from lazydata.storage.fetch_file import Prefetcher
+
+        self.config_path = config_path
+        self.config = Config(config_path.parent)
+        self.prefetcher = Prefetcher(self.config, local)
+        self.lock = threading.RLock()
+        self.stat = self._stat()
+
+    def _stat(self):
+        stat = os.stat(str(self.config_path))
+        return stat.st_mtime_ns, stat.st_size
+
+    def refresh(self):
+        """
+        Reload the config if it was changed by someone else, e.g. a git checkout
+        """
+        from lazydata.config.config import Config
+
+        if self._stat() != self.stat:
+            self.config = Config(self.config_path.parent)
+            self.prefetcher.config = self.config
+            self.stat = self._stat()
+
+    def saved(self):
+        # our own changes don't need a reload
+        self.stat = self._stat()
+
+
+class AgentServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, socket_path:str):
+        from lazydata.storage.local import LocalStorage
+
+        self.local = LocalStorage()
+        self.projects = {}
+        self.projects_lock = threading.Lock()
+
+        # only the user can connect, from the moment the socket exists
+        umask = os.umask(0o177)
+        try:
+            super().__init__(socket_path, AgentHandler)
+        finally:
+            os.umask(umask)
+
+    def project(self, cwd:str) -> ProjectState:
+        # searched on every request, a lazydata.yml might have been created or moved since the last one
+        config_path = None
+        for directory in [Path(cwd)] + list(Path(cwd).parents):
+            candidate = Path(directory, "lazydata.yml")
+            if candidate.exists():
+                config_path = candidate
+        if config_path is None:
+            raise RuntimeError("Cannot find the lazydata.yml file in any of the parent directories. "
+                               "Did you run `lazydata init`?")
+
+        with self.projects_lock:
+            state = self.projects.get(config_path)
+            if state is None:
+                state = self.projects[config_path] = ProjectState(config_path, self.local)
+        return state
+
+    def handle_request_dict(self, request:dict, output) -> dict:
+        """
+        Answer a request
+
+        :param request: The request, with an `op` key
+        :param output: Where the messages for the client are written
+        :return: The response
+        """
+        from lazydata.tracker import _track
+
+        op = request.get("op")
+        if op == "ping":
+            return {"pid": os.getpid()}
+        elif op == "shutdown":
+            threading.Thread(target=self.shutdown).start()
+            return {}
+
+        state = self.project(request["cwd"])
+        with state.lock:
+            state.refresh()
+        config = state.config
+
+        if op == "prefetch":
+            entries = config.tracked_files_used_in(request["script"])
+            state.prefetcher.submit(entries)
+            return {}
+        elif op == "track":
+            latest, older = config.get_latest_and_all_file_entries(request["path"])
+            if latest is not None:
+                if os.path.exists(request["path"]):
+                    known = self.local.get_file_sha256(request["path"])
+                    stale = latest["hash"] not in known and any(e["hash"] in known for e in older)
+                else:
+                    stale = True
+                if stale:
+                    # download outside of the project lock, shared with the other clients that need the file
+                    state.prefetcher.submit([latest])
+                    state.prefetcher.wait_for(latest["hash"])
+
+            with state.lock:
+                _track(request["path"], request["source_url"], request["script"], config=config, local=self.local,
+                       output=output)
+                state.saved()
+            return {}
+        else:
+            raise RuntimeError("Unknown agent request `%s`" % op)
+
+
+class AgentHandler(socketserver.StreamRequestHandler):
+
+    def handle(self):
+        for line in self.rfile:
+            request = json.loads(line.decode("utf-8"))
+            buffer = io.StringIO()
+            try:
+                response = self.server.handle_request_dict(request, buffer)
+                response["ok"] = True
+            except Exception as e:
+                response = {"ok": False, "error": str(e), "error_type": type(e).__name__}
+            output = buffer.getvalue()
+
+            if request.get("display_path") and request.get("path"):
+                # messages should show the path as the client gave it
+                output = output.replace(request["path"], request["display_path"])
+            response["output"] = output
+
+            self.wfile.write(json.dumps(response).encode("utf-8") + b"\n")
+            self.wfile.flush()
+
+
+def run_agent():
+    """
+    Run the agent in the foreground until it's shut down
+
+    :return:
+    """
+    socket_path = str(AGENT_SOCKET_PATH)
+    if AGENT_SOCKET_PATH.exists():
+        try:
+            AgentClient(socket_path).close()
+            raise RuntimeError("The lazydata agent is already running.")
+        except OSError:
+            # left behind by an agent that didn't exit cleanly
+            AGENT_SOCKET_PATH.unlink()
+
+    server = AgentServer(socket_path)
+    print("LAZYDATA: Agent listening on `%s`" % socket_path)
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+        if AGENT_SOCKET_PATH.exists():
+            AGENT_SOCKET_PATH.unlink()
@@ -2,11 +2,18 @@ import argparse
 
 from lazydata.cli.commands.init import InitCommand
 from lazydata.cli.commands.pull import PullCommand
+from lazydata.cli.commands.prefetch import PrefetchCommand
+from lazydata.cli.commands.bundle import BundleCommand
+from lazydata.cli.commands.unbundle import UnbundleCommand
 from lazydata.cli.commands.push import PushCommand
 from lazydata.cli.commands.ls import LsCommand
+from lazydata.cli.commands.watch import WatchCommand
+from lazydata.cli.commands.agent import AgentCommand
+from lazydata.cli.commands.peer import PeerCommand
 from lazydata.cli.commands.addremote import AddRemoteCommand
 from lazydata.cli.commands.addsource import AddSourceCommand
 from lazydata.cli.commands.removeremote import RemoveRemoteCommand
+from lazydata.cli.commands.remotegc import RemoteGcCommand
 from lazydata.cli.commands.config import ConfigCommand
 
 def cli():
@@ -35,6 +42,36 @@ def cli():
             "handler": PullCommand(),
             "help": "Pull files from remote storage"
         },
+        {
+            "command": "prefetch",
+            "handler": PrefetchCommand(),
+            "help": "Fetch files into the local cache in parallel, ahead of their use"
+        },
+        {
+            "command": "bundle",
+            "handler": BundleCommand(),
+            "help": "Write the tracked files into a single archive, e.g. to move them where there's no remote"
+        },
+        {
+            "command": "unbundle",
+            "handler": UnbundleCommand(),
+            "help": "Import the files of a bundle into the local cache"
+        },
+        {
+            "command": "watch",
+            "handler": WatchCommand(),
+            "help": "Keep the hashes of the tracked files up to date in the background as they change"
+        },
+        {
+            "command": "agent",
+            "handler": AgentCommand(),
+            "help": "Run an agent that answers track() calls of all the local processes with warm caches"
+        },
+        {
+            "command": "peer",
+            "handler": PeerCommand(),
+            "help": "Serve the local cache to the other nodes of a cluster listed in LAZYDATA_PEERS"
+        },
         {
             "command": "add-source",
             "handler": AddSourceCommand(),
@@ -45,6 +82,11 @@ def cli():
             "handler": AddRemoteCommand(),
             "help": "Add a remote storage backend"
         },
+        {
+            "command": "remote-gc",
+            "handler": RemoteGcCommand(),
+            "help": "Delete the files in the remote that are no longer used"
+        },
         # {
         #     "command": "remove-remote",
         #     "handler": RemoveRemoteCommand(),
@@ -55,11 +97,16 @@ def cli():
              "handler": ConfigCommand(),
              "help": "Configure access credentials for remote storage backends"
         },
-        # {
-        #     "command": "ls",
-        #     "handler": LsCommand(),
-        #     "help": "List tracked files and their current status"
-        # },
+        {
+            "command": "ls",
+            "handler": LsCommand(),
+            "help": "List tracked files and their current status"
+        },
+        {
+            "command": "status",
+            "handler": LsCommand(),
+            "help": "Same as `ls`"
+        },
 
     ]
     subparsers = parser.add_subparsers(title="subcommands")
@@ -3,6 +3,7 @@ import sys
 
 from lazydata.config.config import Config
 from lazydata.storage.cloudsetup import setup_aws_credentials
+from lazydata.storage.compression import CODECS
 from lazydata.storage.remote import RemoteStorage
 
 import lazy_import
@@ -13,14 +14,24 @@ class AddRemoteCommand(BaseCommand):
     def add_arguments(self, parser):
         parser.add_argument('url', type=str, help='URL of the remote storage backend')
         parser.add_argument('--endpoint-url', type=str, nargs='?', help='The complete URL to use for the constructed client')
+        parser.add_argument('--compression', type=str, choices=sorted(CODECS), default=None,
+                            help='Compress files stored in the remote with this codec')
+        parser.add_argument('--pack', type=int, nargs='?', const=True, default=None, metavar='THRESHOLD',
+                            help='Bundle files smaller than THRESHOLD bytes (default 1MB) into packs')
+        parser.add_argument('--chunk', type=int, nargs='?', const=True, default=None, metavar='THRESHOLD',
+                            help='Store files of THRESHOLD bytes (default 64MB) or more in chunks, so that new '
+                                 'versions only transfer the chunks that changed')
+        parser.add_argument('--mirror', action='store_true',
+                            help='Add the URL as a mirror of the existing remote, files are fetched from the fastest one')
         return parser
 
     def handle(self, args):
         url = args.url
         endpoint_url = args.endpoint_url
 
-        if not url.startswith("s3://"):
-            print("ERROR: Only S3 URLs are currently supported. For example: `s3://mybucket` or `s3://mybucket/myfolder`")
+        if not (url.startswith("s3://") or url.startswith("file://")):
+            print("ERROR: Only S3 and local filesystem URLs are currently supported. For example: `s3://mybucket`, "
+                  "`s3://mybucket/myfolder` or `file:///mnt/shared/lazydata`")
             sys.exit(1)
 
         success = False
@@ -29,7 +40,11 @@ class AddRemoteCommand(BaseCommand):
             try:
                 if remote.check_storage_exists():
                     config = Config()
-                    config.add_remote(url, endpoint_url=endpoint_url)
+                    if args.mirror:
+                        config.add_mirror(url, endpoint_url=endpoint_url)
+                    else:
+                        config.add_remote(url, endpoint_url=endpoint_url, compression=args.compression,
+                                          pack_threshold=args.pack, chunk_threshold=args.chunk)
                     success = True
                 else:
                     success = True
@@ -42,6 +57,8 @@ class AddRemoteCommand(BaseCommand):
                 config_now = input("Do you want to configure AWS credentials now? [y/n] ")
                 if config_now.strip() == "y":
                     setup_aws_credentials()
+                    # the cached backend was created with the old credentials
+                    RemoteStorage.clear_registry()
                     print("Credentials successfully stored. Trying again with these new credentials...")
                 else:
                     success = True
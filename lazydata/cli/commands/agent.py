@@ -0,0 +1,37 @@
+from lazydata.agent import agent_request, run_agent
+from lazydata.cli.commands.BaseCommand import BaseCommand
+
+import subprocess
+import sys
+
+
+class AgentCommand(BaseCommand):
+    def add_arguments(self, parser):
+        parser.add_argument('--background', action='store_true', help='Detach and run the agent in the background')
+        parser.add_argument('--stop', action='store_true', help='Stop the running agent')
+        parser.add_argument('--status', action='store_true', help='Check if the agent is running')
+        return parser
+
+    def handle(self, args):
+        if args.stop or args.status:
+            response = agent_request({"op": "shutdown" if args.stop else "ping"})
+            if response is None:
+                print("The lazydata agent is not running.")
+            elif args.stop:
+                print("Stopped the lazydata agent.")
+            else:
+                print("The lazydata agent is running with pid %d." % response["pid"])
+            return
+
+        if args.background:
+            # re-run this command detached from the terminal
+            subprocess.Popen([sys.executable, "-c", "from lazydata.cli.cli import cli; cli()", "agent"],
+                             stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, stdin=subprocess.DEVNULL,
+                             start_new_session=True)
+            print("Started the lazydata agent in the background.")
+            return
+
+        try:
+            run_agent()
+        except KeyboardInterrupt:
+            pass
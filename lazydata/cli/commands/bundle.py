@@ -0,0 +1,68 @@
+from lazydata.cli.commands.BaseCommand import BaseCommand
+from lazydata.config.config import Config
+from lazydata.storage.bundle import write_bundle
+from lazydata.storage.fetch_file import fetch_files
+from lazydata.storage.local import LocalStorage
+
+from collections import OrderedDict
+from contextlib import redirect_stdout
+import sys
+
+
+class BundleCommand(BaseCommand):
+    def add_arguments(self, parser):
+        parser.add_argument('output', type=str, help='Path of the bundle to write, or - for stdout')
+        parser.add_argument('artefacts', type=str, nargs="*",
+                            help='Scripts, files or directories whose tracked files to bundle (default: all)')
+        parser.add_argument('--all-versions', action='store_true',
+                            help='Bundle all the tracked versions of the files instead of only the latest')
+        return parser
+
+    def handle(self, args):
+        config = Config()
+        local = LocalStorage()
+
+        if args.artefacts == []:
+            entries = config.config["files"]
+        else:
+            entries = []
+            for artefact in args.artefacts:
+                entries.extend(config.resolve_artefact(artefact))
+        if args.all_versions:
+            paths = {e["path"] for e in entries}
+            entries = [e for e in config.config["files"] if e["path"] in paths]
+        else:
+            entries = list(OrderedDict((e["path"], e) for e in entries).values())
+        hashes = list(OrderedDict.fromkeys(e["hash"] for e in entries))
+
+        # messages go to stderr when the bundle itself is written to stdout
+        log = sys.stderr if args.output == "-" else sys.stdout
+
+        missing = [e for e in entries if not local.hash_to_file(e["hash"]).exists()]
+        if missing:
+            if "remote" not in config.config and not all(config.source_url(e["hash"]) for e in missing):
+                print("ERROR: %d of the files are not in the local cache and there's no remote to get them from, "
+                      "e.g. `%s`" % (len(missing), missing[0]["path"]), file=log)
+                sys.exit(1)
+            print("LAZYDATA: Fetching %d files into the local cache first..." % len(missing), file=log)
+            # fetch_files only takes the latest version of each path, so the versions are fetched in rounds
+            rounds = []
+            for e in missing:
+                for paths in rounds:
+                    if e["path"] not in paths:
+                        paths[e["path"]] = e
+                        break
+                else:
+                    rounds.append(OrderedDict([(e["path"], e)]))
+            with redirect_stdout(log):
+                for paths in rounds:
+                    fetch_files(config=config, local=local, entries=list(paths.values()), copy=False)
+
+        if args.output == "-":
+            total = write_bundle(local, hashes, sys.stdout.buffer, files=entries)
+            sys.stdout.buffer.flush()
+        else:
+            with open(args.output, "wb") as fp:
+                total = write_bundle(local, hashes, fp, files=entries)
+
+        print("LAZYDATA: Bundled %d files (%.1f MB)" % (len(hashes), total / (1024 * 1024)), file=log)
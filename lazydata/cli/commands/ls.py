@@ -1,5 +1,60 @@
 from lazydata.cli.commands.BaseCommand import BaseCommand
+from lazydata.config.config import Config
+from lazydata.storage.local import LocalStorage
+from lazydata.storage.remote import RemoteStorage
+from lazydata.storage.status import get_status, STATUS_OK
+
+import json
 
 
 class LsCommand(BaseCommand):
-    pass
\ No newline at end of file
+    def add_arguments(self, parser):
+        parser.add_argument('artefacts', type=str, nargs="*",
+                            help='Scripts, files or directories whose tracked files to list (default: all)')
+        parser.add_argument('--remote', action='store_true', help='Also check which files are in the remote')
+        parser.add_argument('--json', action='store_true', help='Print the status as JSON')
+        return parser
+
+    def handle(self, args):
+        config = Config()
+        local = LocalStorage()
+
+        if args.artefacts == []:
+            entries = config.config["files"]
+        else:
+            entries = []
+            for artefact in args.artefacts:
+                entries.extend(config.resolve_artefact(artefact))
+
+        remote = None
+        if args.remote:
+            if "remote" not in config.config:
+                print("ERROR: Remote not specified for this lazydata project. Use `lazydata add-remote` to add it.")
+                return
+            remote = RemoteStorage.get_from_config(config)
+
+        statuses = get_status(config, local, entries, remote=remote)
+
+        if args.json:
+            print(json.dumps(statuses, indent=2))
+            return
+
+        header = "%-10s %-7s" % ("STATUS", "CACHED")
+        if remote is not None:
+            header += " %-7s" % "REMOTE"
+        print(header + " PATH")
+        for s in statuses:
+            line = "%-10s %-7s" % (s["status"], "yes" if s["cached"] else "no")
+            if remote is not None:
+                line += " %-7s" % ("yes" if s["remote"] else "no")
+            print(line + " " + s["path"])
+
+        counts = {}
+        for s in statuses:
+            counts[s["status"]] = counts.get(s["status"], 0) + 1
+        summary = ", ".join("%d %s" % (n, status) for status, n in sorted(counts.items(), key=lambda c: c[0] != STATUS_OK))
+        print("\n%d tracked files%s" % (len(statuses), ": " + summary if summary else ""))
+        if remote is not None:
+            not_pushed = sum(1 for s in statuses if not s["remote"])
+            if not_pushed:
+                print("%d not in the remote, run `lazydata push` to upload them" % not_pushed)
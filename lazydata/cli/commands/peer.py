@@ -0,0 +1,20 @@
+from lazydata.cli.commands.BaseCommand import BaseCommand
+from lazydata.config.config import Config
+from lazydata.storage.local import LocalStorage
+from lazydata.storage.peers import run_peer_server, DEFAULT_PEER_HOST, DEFAULT_PEER_PORT
+
+
+class PeerCommand(BaseCommand):
+    def add_arguments(self, parser):
+        parser.add_argument('--host', default=DEFAULT_PEER_HOST,
+                            help='Address to listen on (default: %(default)s), any other address needs '
+                                 'LAZYDATA_PEER_TOKEN')
+        parser.add_argument('--port', type=int, default=DEFAULT_PEER_PORT,
+                            help='Port to listen on (default: %(default)s)')
+        return parser
+
+    def handle(self, args):
+        try:
+            run_peer_server(Config(), LocalStorage(), args.host, args.port)
+        except KeyboardInterrupt:
+            pass
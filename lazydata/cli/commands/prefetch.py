@@ -0,0 +1,37 @@
+from lazydata.cli.commands.BaseCommand import BaseCommand
+from lazydata.config.config import Config
+from lazydata.storage.fetch_file import fetch_files
+from lazydata.storage.local import LocalStorage
+
+import subprocess
+import sys
+
+
+class PrefetchCommand(BaseCommand):
+    def add_arguments(self, parser):
+        parser.add_argument('artefacts', type=str, nargs="*",
+                            help='Scripts, files or directories whose tracked files to prefetch (default: all)')
+        parser.add_argument('--background', action='store_true', help='Detach and prefetch in the background')
+        return parser
+
+    def handle(self, args):
+        if args.background:
+            # re-run this command detached from the terminal
+            subprocess.Popen([sys.executable, "-c", "from lazydata.cli.cli import cli; cli()", "prefetch"] + args.artefacts,
+                             stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, stdin=subprocess.DEVNULL,
+                             start_new_session=True)
+            print("Prefetching in the background...")
+            return
+
+        config = Config()
+        local = LocalStorage()
+
+        if args.artefacts == []:
+            entries = config.config["files"]
+        else:
+            entries = []
+            for artefact in args.artefacts:
+                entries.extend(config.resolve_artefact(artefact))
+
+        # only bring the files into the local cache, `track()` will copy them over when they are used
+        fetch_files(config=config, local=local, entries=entries, copy=False)
@@ -1,16 +1,54 @@
 from lazydata.cli.commands.BaseCommand import BaseCommand
 from lazydata.config.config import Config
+from lazydata.metrics import timed
 from lazydata.storage.local import LocalStorage
 from lazydata.storage.remote import RemoteStorage
 
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+import subprocess
+import sys
+
 
 class PushCommand(BaseCommand):
 
+    def add_arguments(self, parser):
+        parser.add_argument('--replicate', action='store_true',
+                            help='After pushing to the remote, copy the files to its mirrors in the background')
+        parser.add_argument('--mirrors-only', action='store_true',
+                            help='Only copy the files to the mirrors of the remote')
+        return parser
+
     def handle(self, args):
         config = Config()
         if "remote" in config.config:
-            remote = RemoteStorage.get_from_config(config)
             local = LocalStorage()
-            remote.upload(local,config)
+
+            if args.mirrors_only:
+                mirrors = RemoteStorage.get_mirrors_from_config(config)
+                if not mirrors:
+                    print("ERROR: No mirrors specified for this lazydata project. "
+                          "Use `lazydata add-remote --mirror` to add them.")
+                    return
+                # the mirrors are independent so they can all be uploaded to at the same time
+                with ThreadPoolExecutor(max_workers=len(mirrors)) as executor:
+                    for _ in executor.map(lambda mirror: mirror.upload(local, config), mirrors):
+                        pass
+                return
+
+            remote = RemoteStorage.get_from_config(config)
+            with timed("push"):
+                remote.upload(local,config)
+
+            if args.replicate and config.config.get("mirrors"):
+                # replicate detached from the terminal, logging to the lazydata dir
+                log_path = Path(local.base_path, "replicate.log")
+                with open(str(log_path), "a") as log_fp:
+                    subprocess.Popen([sys.executable, "-c", "from lazydata.cli.cli import cli; cli()", "push",
+                                      "--mirrors-only"],
+                                     stdout=log_fp, stderr=log_fp, stdin=subprocess.DEVNULL,
+                                     cwd=str(config.config_path.parent), start_new_session=True)
+                print("LAZYDATA: Replicating to %d mirror(s) in the background, see `%s`"
+                      % (len(config.config["mirrors"]), str(log_path)))
         else:
             print("ERROR: Remote not specified for this lazydata project. Use `lazydata add-remote` to add it.")
@@ -0,0 +1,49 @@
+from lazydata.cli.commands.BaseCommand import BaseCommand
+from lazydata.config.config import Config
+from lazydata.storage.local import LocalStorage
+from lazydata.storage.remote import RemoteStorage
+
+from pathlib import Path
+
+
+class RemoteGcCommand(BaseCommand):
+
+    def add_arguments(self, parser):
+        parser.add_argument('configs', type=str, nargs="*",
+                            help='lazydata.yml files (or their directories) of all the projects sharing the remote. '
+                                 'Files not used by any of them are deleted (default: the current project)')
+        parser.add_argument('--keep-versions', type=int, default=0, metavar='N',
+                            help='Only keep the last N versions of each file (default: all versions)')
+        parser.add_argument('--dry-run', action='store_true',
+                            help='Only report what would be deleted')
+        return parser
+
+    def handle(self, args):
+        if args.keep_versions < 0:
+            print("ERROR: --keep-versions needs to be a positive number")
+            return
+
+        if args.configs == []:
+            configs = [Config()]
+        else:
+            configs = []
+            for path in args.configs:
+                path = Path(path)
+                configs.append(Config(path if path.is_dir() else path.parent))
+
+        if "remote" not in configs[0].config:
+            print("ERROR: Remote not specified for this lazydata project. Use `lazydata add-remote` to add it.")
+            return
+
+        live = set()
+        for config in configs:
+            live.update(config.live_hashes(args.keep_versions))
+
+        remote = RemoteStorage.get_from_config(configs[0])
+        result = remote.collect_garbage(LocalStorage(), live, dry_run=args.dry_run)
+
+        print("LAZYDATA: %s %d files (%d objects, %.1f MB) from `%s`" %
+              ("Would delete" if args.dry_run else "Deleted", result["files"], result["objects"],
+               result["bytes"] / (1024 * 1024), remote.url))
+        if result["partial_packs"]:
+            print("LAZYDATA: Kept %d packs that also contain files still in use" % result["partial_packs"])
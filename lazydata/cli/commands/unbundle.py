@@ -0,0 +1,30 @@
+from lazydata.cli.commands.BaseCommand import BaseCommand
+from lazydata.storage.bundle import import_bundle
+from lazydata.storage.local import LocalStorage
+
+import sys
+
+
+class UnbundleCommand(BaseCommand):
+    def add_arguments(self, parser):
+        parser.add_argument('bundle', type=str, help='Path of the bundle to import, or - for stdin')
+        return parser
+
+    def handle(self, args):
+        local = LocalStorage()
+
+        if args.bundle == "-":
+            result = import_bundle(local, sys.stdin.buffer)
+        else:
+            with open(args.bundle, "rb") as fp:
+                result = import_bundle(local, fp)
+
+        if result["corrupted"]:
+            print("ERROR: %d files are corrupted in the bundle and were not imported, e.g. `%s`" %
+                  (len(result["corrupted"]), result["corrupted"][0]))
+
+        print("LAZYDATA: Imported %d files (%.1f MB) into the local cache, %d were already there. "
+              "Run `lazydata pull` to copy them into the workspace." %
+              (result["imported"], result["bytes"] / (1024 * 1024), result["skipped"]))
+        if result["corrupted"]:
+            sys.exit(1)
@@ -0,0 +1,30 @@
+from lazydata.cli.commands.BaseCommand import BaseCommand
+from lazydata.config.config import Config
+from lazydata.storage.local import LocalStorage
+from lazydata.storage.watcher import Watcher, DEFAULT_SETTLE_TIME
+
+import subprocess
+import sys
+
+
+class WatchCommand(BaseCommand):
+    def add_arguments(self, parser):
+        parser.add_argument('--settle', type=float, default=DEFAULT_SETTLE_TIME, metavar='SECONDS',
+                            help='Rehash a file once it has not been written to for this long (default: %(default)s)')
+        parser.add_argument('--background', action='store_true', help='Detach and watch in the background')
+        return parser
+
+    def handle(self, args):
+        if args.background:
+            # re-run this command detached from the terminal
+            subprocess.Popen([sys.executable, "-c", "from lazydata.cli.cli import cli; cli()", "watch",
+                              "--settle", str(args.settle)],
+                             stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, stdin=subprocess.DEVNULL,
+                             start_new_session=True)
+            print("Watching in the background...")
+            return
+
+        try:
+            Watcher(Config(), LocalStorage(), settle_time=args.settle).run()
+        except KeyboardInterrupt:
+            pass
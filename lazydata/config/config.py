@@ -5,10 +5,21 @@ Class to read and manipulate the project's config file
 
 from pathlib import Path
 from typing import Dict, Optional, List
+import hashlib
+import json
 import yaml
 import os
 
+from lazydata.metrics import timed
 from lazydata.storage.hash import calculate_file_sha256
+from lazydata.storage.local import BASE_PATH
+
+# the C parser is an order of magnitude faster on projects with many tracked files
+YamlLoader = getattr(yaml, "CSafeLoader", yaml.SafeLoader)
+
+# Parsed config files are cached as JSON, which loads much faster than YAML
+CONFIG_CACHE_PATH = Path(BASE_PATH, "configcache")
+
 
 class Config:
 
@@ -33,15 +44,58 @@ class Config:
             raise RuntimeError("Cannot find the lazydata.yml file in any of the parent directories. "
                                "Did you run `lazydata init`?")
 
-        try:
-            with open(str(self.config_path)) as fp:
-                self.config = yaml.safe_load(fp)
-        except Exception as e:
-            raise RuntimeError("Error parsing `lazydata.yml`. Please revert to the last working version.\n%s" % str(e))
+        with timed("config_load"):
+            self.config = self._load_cached()
+            if self.config is None:
+                try:
+                    with open(str(self.config_path)) as fp:
+                        self.config = yaml.load(fp, Loader=YamlLoader)
+                except Exception as e:
+                    raise RuntimeError("Error parsing `lazydata.yml`. Please revert to the last working version.\n%s"
+                                       % str(e))
+                self._store_cached()
 
         if "files" not in self.config:
             self.config["files"] = []
 
+    def _cache_path(self) -> Path:
+        return Path(CONFIG_CACHE_PATH, "%s.json" % hashlib.sha1(str(self.config_path).encode("utf-8")).hexdigest())
+
+    def _load_cached(self) -> Optional[dict]:
+        """
+        Get the parsed config from the cache, if the config file hasn't changed since it was cached
+
+        :return: The config dict or None
+        """
+        try:
+            stat = os.stat(str(self.config_path))
+            with open(str(self._cache_path())) as fp:
+                cached = json.load(fp)
+        except (OSError, ValueError):
+            return None
+
+        if cached.get("mtime_ns") != stat.st_mtime_ns or cached.get("size") != stat.st_size:
+            return None
+        return cached["config"]
+
+    def _store_cached(self):
+        """
+        Cache the parsed config, keyed by the mtime and size of the config file
+
+        :return:
+        """
+        try:
+            stat = os.stat(str(self.config_path))
+            CONFIG_CACHE_PATH.mkdir(parents=True, exist_ok=True)
+            cache_path = self._cache_path()
+            tmp_path = "%s.%d.tmp" % (str(cache_path), os.getpid())
+            with open(tmp_path, "w") as fp:
+                json.dump({"mtime_ns": stat.st_mtime_ns, "size": stat.st_size, "config": self.config}, fp)
+            os.replace(tmp_path, str(cache_path))
+        except (OSError, TypeError, ValueError):
+            # e.g. values JSON can't represent, the YAML is then parsed every time
+            pass
+
     def path_relative_to_config(self, path:str) -> Path:
         """
         Return the Path relative to the config file
@@ -79,20 +133,23 @@ class Config:
         else:
             return all_entries[-1], all_entries[:-1]
 
-    def add_file_entry(self, path:str, script_path:str, source_url: Optional[str] = None) -> Dict[str, str]:
+    def add_file_entry(self, path:str, script_path:str, source_url: Optional[str] = None,
+                       sha256: Optional[str] = None) -> Dict[str, str]:
         """
         Add a file entry to the config file
 
         :param path: The path to the data file
         :param script_path: The path to the script that used it
         :param source_url: The source to download file from
+        :param sha256: The hash of the file if already known, otherwise it's calculated
         :return:
         """
         # path relative to the config file
         path_rel = str(self.path_relative_to_config(path))
         script_path_rel = str(self.path_relative_to_config(script_path))
 
-        sha256 = calculate_file_sha256(path)
+        if sha256 is None:
+            sha256 = calculate_file_sha256(path)
 
         result = {
             "path": path_rel,
@@ -157,11 +214,16 @@ class Config:
             self.save_config()
         return entry
 
-    def add_remote(self, remote_url:str, endpoint_url:str):
+    def add_remote(self, remote_url:str, endpoint_url:str, compression:Optional[str] = None,
+                   pack_threshold=None, chunk_threshold=None):
         """
         Add a remote to the config file
 
         :param remote_url:
+        :param endpoint_url:
+        :param compression: Optional codec to compress the files with on push
+        :param pack_threshold: Optional size in bytes (or True for the default) under which files are bundled into packs
+        :param chunk_threshold: Optional size in bytes (or True for the default) from which files are stored in chunks
         :return:
         """
 
@@ -171,6 +233,29 @@ class Config:
             # Setting the remote config automatically sets the endpoint parameter, even if it is None
             self.config["remote"] = remote_url
             self.config["endpoint"] = endpoint_url
+            if compression is not None:
+                self.config["compression"] = compression
+            if pack_threshold is not None:
+                self.config["pack_threshold"] = pack_threshold
+            if chunk_threshold is not None:
+                self.config["chunk_threshold"] = chunk_threshold
+            self.save_config()
+
+    def add_mirror(self, remote_url:str, endpoint_url:str):
+        """
+        Add a mirror of the remote to the config file
+
+        :param remote_url:
+        :param endpoint_url:
+        :return:
+        """
+
+        if "remote" not in self.config:
+            print("ERROR: Add the primary remote with `lazydata add-remote` before adding mirrors. Aborting...")
+        elif remote_url in [self.config["remote"]] + [m["url"] for m in self.config.get("mirrors", [])]:
+            print("ERROR: Remote `%s` is already in `lazydata.yml`. Aborting..." % remote_url)
+        else:
+            self.config.setdefault("mirrors", []).append({"url": remote_url, "endpoint": endpoint_url})
             self.save_config()
 
     def check_file_tracked(self, path:str):
@@ -207,9 +292,56 @@ class Config:
 
         return entries
 
+    def resolve_artefact(self, artefact:str) -> List[dict]:
+        """
+        Get the tracked files an artefact refers to: either a tracked file itself,
+        a script that uses tracked files, or a directory with tracked files in it.
+
+        :param artefact: Path to a file, script or directory
+        :return: List of config file entries, empty if nothing matches
+        """
+
+        # 1) check if the artefact is a file we are tracking
+        latest, _ = self.get_latest_and_all_file_entries(artefact)
+        if latest is not None:
+            return [latest]
+
+        # 2) Check for usage
+        used_entries = self.tracked_files_used_in(artefact)
+        if used_entries:
+            return used_entries
+
+        # 3) check for a directory
+        dir_path = None
+        try:
+            # might fail on python 3.5...
+            dir_path = Path(artefact).resolve()
+        except Exception:
+            pass
+        if dir_path and dir_path.exists() and dir_path.is_dir():
+            return self.abs_path_matches_prefix(str(dir_path))
+
+        return []
+
+    def live_hashes(self, keep_versions:int = 0) -> set:
+        """
+        Get the sha256 of the file versions still needed by this project
+
+        :param keep_versions: Number of most recent versions to keep for each path, 0 to keep all of them
+        :return:
+        """
+        if not keep_versions:
+            return {e["hash"] for e in self.config["files"]}
+
+        versions = {}
+        for e in self.config["files"]:
+            versions.setdefault(e["path"], []).append(e["hash"])
+        return {sha256 for hashes in versions.values() for sha256 in hashes[-keep_versions:]}
+
     def source_url(self, sha256: str) -> Optional[str]:
         try:
-            result = [e["source_url"] for e in self.config["files"] if e["hash"] == sha256][-1]
+            result = [e["source_url"] for e in self.config["files"]
+                      if e["hash"] == sha256 and "source_url" in e][-1]
         except IndexError:
             result = None
         return result
@@ -222,7 +354,7 @@ class Config:
                 result = None
         elif source_url is not None:
             try:
-                result = [e["path"] for e in self.config["files"] if e["source_url"] == source_url][-1]
+                result = [e["path"] for e in self.config["files"] if e.get("source_url") == source_url][-1]
             except IndexError:
                 result = None
         else:
@@ -236,12 +368,20 @@ class Config:
         :return:
         """
 
-        with open(str(self.config_path), "w") as fp:
+        with timed("config_save"), open(str(self.config_path), "w") as fp:
             yaml.dump({"version": self.config["version"]}, fp, default_flow_style=False)
             if "remote" in self.config:
                 yaml.dump({"remote": self.config["remote"]}, fp, default_flow_style=False)
             if "endpoint" in self.config:
                 yaml.dump({"endpoint": self.config["endpoint"]}, fp, default_flow_style=False)
+            if "mirrors" in self.config:
+                yaml.dump({"mirrors": self.config["mirrors"]}, fp, default_flow_style=False)
+            if "compression" in self.config:
+                yaml.dump({"compression": self.config["compression"]}, fp, default_flow_style=False)
+            if "pack_threshold" in self.config:
+                yaml.dump({"pack_threshold": self.config["pack_threshold"]}, fp, default_flow_style=False)
+            if "chunk_threshold" in self.config:
+                yaml.dump({"chunk_threshold": self.config["chunk_threshold"]}, fp, default_flow_style=False)
             if "files" in self.config:
                 yaml.dump({"files": self.config["files"]}, fp, default_flow_style=False)
 
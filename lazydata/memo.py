@@ -0,0 +1,322 @@
+"""
+Memoization of the objects parsed from tracked files, used by `lazydata.load()`
+
+Parsed objects are keyed by the content hash of the file and the reader that parsed it, so re-loading an
+unchanged file returns the object parsed the first time, without reading the file again. They are kept
+in an LRU bounded by their estimated memory use, and optionally pickled next to the blob in the local
+cache so that other processes (and restarted notebooks) can skip the parsing too.
+"""
+
+from collections import OrderedDict
+from pathlib import Path
+from typing import Any, Callable, Optional
+import hashlib
+import os
+import pickle
+import sysconfig
+import tempfile
+import threading
+import types
+
+from lazydata.metrics import count, timed
+
+# Memory (in MB) the memoized objects may use, the least recently used ones are dropped beyond it
+LOAD_CACHE_ENV_VAR = "LAZYDATA_LOAD_CACHE_MB"
+DEFAULT_LOAD_CACHE_MB = 1024
+# Nesting depth of the values a reader key is built from, deeper (e.g. recursive) values are not keyed
+MAX_KEY_DEPTH = 8
+
+
+class UnstableReader(Exception):
+    """
+    The reader depends on a value that can't be identified across processes
+    """
+    pass
+
+
+def _object_repr(obj:Any, depth:int, seen:set) -> str:
+    if not hasattr(obj, "__dict__"):
+        raise UnstableReader()
+    obj_type = type(obj)
+    return "%s.%s%s" % (obj_type.__module__, obj_type.__qualname__, _stable_repr(vars(obj), depth + 1, seen))
+
+
+def _stable_repr(value:Any, depth:int, seen:set) -> str:
+    """
+    Get a representation of a value that is the same in all processes, unlike the default repr of most objects
+    """
+    if depth > MAX_KEY_DEPTH:
+        raise UnstableReader()
+
+    if value is None or isinstance(value, (bool, int, float, complex, str, bytes)):
+        return repr(value)
+    if isinstance(value, (tuple, list)):
+        return "%s(%s)" % (type(value).__name__, ",".join(_stable_repr(v, depth + 1, seen) for v in value))
+    if isinstance(value, (set, frozenset)):
+        return "set(%s)" % ",".join(sorted(_stable_repr(v, depth + 1, seen) for v in value))
+    if isinstance(value, dict):
+        return "dict(%s)" % ",".join(sorted("%s:%s" % (_stable_repr(k, depth + 1, seen),
+                                                      _stable_repr(v, depth + 1, seen))
+                                            for k, v in value.items()))
+    if isinstance(value, types.ModuleType):
+        return "module:%s" % value.__name__
+    if isinstance(value, type):
+        return "type:%s.%s" % (value.__module__, value.__qualname__)
+    if callable(value):
+        return "callable(%s)" % ",".join(_reader_parts(value, depth + 1, seen))
+    return _object_repr(value, depth, seen)
+
+
+def _is_installed(code:types.CodeType) -> bool:
+    """
+    Check if the code is from the standard library or an installed package, which only change when reinstalled
+    """
+    if code.co_filename.startswith("<frozen"):
+        return True
+    global _installed_paths
+    if _installed_paths is None:
+        paths = sysconfig.get_paths()
+        _installed_paths = tuple({os.path.join(paths[name], "") for name in ("stdlib", "platstdlib",
+                                                                              "purelib", "platlib")})
+    return code.co_filename.startswith(_installed_paths)
+
+
+_installed_paths = None
+
+
+def _code_parts(code:types.CodeType, namespace:dict, depth:int, seen:set) -> list:
+    """
+    The body of a function, so a changed reader doesn't return the objects parsed by the old one
+    """
+    if depth > MAX_KEY_DEPTH:
+        raise UnstableReader()
+
+    parts = [code.co_code.hex(), ",".join(code.co_names),
+             repr([c for c in code.co_consts if not isinstance(c, types.CodeType)])]
+    for const in code.co_consts:
+        if isinstance(const, types.CodeType):
+            # e.g. a comprehension or a nested function
+            parts.extend(_code_parts(const, namespace, depth + 1, seen))
+
+    if not _is_installed(code):
+        # the globals it uses, e.g. a helper function or a setting at the top of the notebook
+        for name in code.co_names:
+            if name in namespace:
+                parts.append("%s=%s" % (name, _stable_repr(namespace[name], depth + 1, seen)))
+    return parts
+
+
+def _reader_parts(reader:Callable, depth:int, seen:set) -> list:
+    func = reader
+    parts = []
+    # e.g. functools.partial(pd.read_csv, sep=";")
+    while hasattr(func, "func") and hasattr(func, "args"):
+        parts.append(_stable_repr(func.args, depth, seen))
+        parts.append(_stable_repr(getattr(func, "keywords", None) or {}, depth, seen))
+        func = func.func
+
+    # e.g. parser.parse, which depends on how the parser is configured
+    bound_to = getattr(func, "__self__", None)
+    if bound_to is not None:
+        parts.append(_stable_repr(bound_to, depth, seen))
+    func = getattr(func, "__func__", func)
+
+    parts.append(getattr(func, "__module__", None) or "")
+    parts.append(getattr(func, "__qualname__", None) or "")
+    if id(func) in seen:
+        # e.g. a recursive helper, its body is already in the key
+        return parts
+    seen.add(id(func))
+
+    code = getattr(func, "__code__", None)
+    if code is not None:
+        parts.extend(_code_parts(code, getattr(func, "__globals__", None) or {}, depth, seen))
+        parts.append(_stable_repr(getattr(func, "__defaults__", None), depth, seen))
+        parts.append(_stable_repr(getattr(func, "__kwdefaults__", None), depth, seen))
+        # e.g. `lambda p: pd.read_csv(p, sep=sep)`
+        for cell in getattr(func, "__closure__", None) or ():
+            try:
+                parts.append(_stable_repr(cell.cell_contents, depth, seen))
+            except ValueError:
+                # not assigned yet
+                parts.append("")
+    elif not isinstance(func, types.BuiltinFunctionType):
+        # an object with a __call__ method
+        parts.append(_object_repr(func, depth, seen))
+
+    return parts
+
+
+def reader_key(reader:Callable) -> Optional[str]:
+    """
+    Get a key identifying a reader across processes, and across re-definitions of the same function in a notebook.
+
+    The key covers the code of the reader and everything it's configured with: its default arguments, the variables
+    it closes over, the globals it uses (e.g. helper functions), the arguments of a `functools.partial` and the
+    object of a bound method.
+
+    :param reader: The function parsing the file
+    :return: The key, or None if the reader depends on something that can't be identified across processes
+    """
+    try:
+        parts = _reader_parts(reader, 0, set())
+    except UnstableReader:
+        return None
+
+    return hashlib.sha1("\0".join(parts).encode("utf-8")).hexdigest()[:16]
+
+
+def estimate_size(obj:Any, file_size:int) -> int:
+    """
+    Estimate the memory used by a parsed object
+
+    :param obj: The parsed object
+    :param file_size: Size of the file it was parsed from, used if there's nothing better
+    :return: size in bytes
+    """
+    memory_usage = getattr(obj, "memory_usage", None)
+    if callable(memory_usage):
+        # pandas
+        try:
+            usage = memory_usage(deep=True)
+            return int(usage.sum() if hasattr(usage, "sum") else usage)
+        except Exception:
+            pass
+
+    nbytes = getattr(obj, "nbytes", None)
+    if isinstance(nbytes, int):
+        # numpy and pyarrow
+        return nbytes
+
+    return file_size
+
+
+class ParsedCache:
+    """
+    An LRU of parsed objects keyed by (sha256, reader key), bounded by their estimated size
+    """
+
+    def __init__(self, max_bytes:int):
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.total_bytes = 0
+        self.lock = threading.Lock()
+
+    def get(self, key:tuple):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            self.entries.move_to_end(key)
+            return entry
+
+    def put(self, key:tuple, obj:Any, size:int):
+        if size > self.max_bytes:
+            # would evict everything else and itself
+            return
+
+        with self.lock:
+            if key in self.entries:
+                self.total_bytes -= self.entries.pop(key)[1]
+            self.entries[key] = (obj, size)
+            self.total_bytes += size
+
+            while self.total_bytes > self.max_bytes:
+                _, (_, evicted_size) = self.entries.popitem(last=False)
+                self.total_bytes -= evicted_size
+                count("load_memo_evicted")
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.total_bytes = 0
+
+
+_cache = ParsedCache(int(float(os.environ.get(LOAD_CACHE_ENV_VAR, DEFAULT_LOAD_CACHE_MB)) * 1024 * 1024))
+
+
+def clear_memo():
+    """
+    Drop all the memoized objects of this process
+
+    :return:
+    """
+    _cache.clear()
+
+
+def _read_pickle(path:Path) -> Optional[tuple]:
+    try:
+        with open(str(path), "rb") as fp:
+            return (pickle.load(fp),)
+    except Exception:
+        # not cached yet, or written by an incompatible version of the library that created the object
+        return None
+
+
+def _write_pickle(path:Path, obj:Any, tmp_dir:Path):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    fd, tmp_name = tempfile.mkstemp(dir=str(tmp_dir), suffix=".pickle")
+    try:
+        with os.fdopen(fd, "wb") as fp:
+            pickle.dump(obj, fp, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_name, str(path))
+    except Exception:
+        # not everything can be pickled, the object is still memoized in memory
+        if os.path.exists(tmp_name):
+            os.unlink(tmp_name)
+
+
+def load_parsed(local, path:str, sha256:str, reader:Callable, disk_cache:bool = False) -> Any:
+    """
+    Get the object parsed from a file by the reader, parsing it only if it wasn't already
+
+    :param local: LocalStorage instance
+    :param path: Path to the file, at the version with the sha256
+    :param sha256: The content hash of the file
+    :param reader: Function taking the path and returning the parsed object
+    :param disk_cache: Also keep the parsed object pickled in the local cache
+    :return: The parsed object
+    """
+    stable_key = reader_key(reader)
+    if stable_key is not None:
+        key = (sha256, stable_key)
+        pickle_path = local.hash_to_parsed_file(sha256, stable_key) if disk_cache else None
+    else:
+        # only memoized in memory for this very reader (the key keeps it alive, so its id can't be reused)
+        key = (sha256, reader)
+        pickle_path = None
+        try:
+            hash(reader)
+        except TypeError:
+            with timed("parse", os.path.getsize(path)):
+                return reader(path)
+
+    entry = _cache.get(key)
+    if entry is not None:
+        count("load_memo_hit")
+        if pickle_path is not None and not pickle_path.exists():
+            # parsed by an earlier call without the disk cache
+            _write_pickle(pickle_path, entry[0], local.tmp_path)
+        return entry[0]
+    count("load_memo_miss")
+
+    file_size = os.path.getsize(path)
+
+    found = None
+    if pickle_path is not None:
+        with timed("load_disk_cache") as event:
+            found = _read_pickle(pickle_path)
+            if found is not None:
+                event["bytes"] = pickle_path.stat().st_size
+        count("load_disk_hit" if found is not None else "load_disk_miss")
+
+    if found is not None:
+        obj = found[0]
+    else:
+        with timed("parse", file_size):
+            obj = reader(path)
+        if pickle_path is not None:
+            _write_pickle(pickle_path, obj, local.tmp_path)
+
+    _cache.put(key, obj, estimate_size(obj, file_size))
+    return obj
@@ -0,0 +1,188 @@
+"""
+Instrumentation of the time spent and the bytes processed in each stage of tracking and transferring files
+
+Stages (e.g. `hash`, `cache_copy`, `download`) are timed with `timed()` and events (e.g. `cache_hit`) are
+counted with `count()`. Both are aggregated per process and passed to the hooks registered with `add_hook()`.
+Stages can be nested, e.g. `track` includes `hash`, so their times don't add up.
+
+Setting the LAZYDATA_METRICS environment variable to a file path exports the metrics of every lazydata
+process: as JSON lines appended for each event, or as Prometheus text written at exit if the path ends in `.prom`.
+"""
+
+from contextlib import contextmanager
+from typing import Callable, Dict
+import atexit
+import json
+import os
+import threading
+import time
+
+METRICS_ENV_VAR = "LAZYDATA_METRICS"
+
+_lock = threading.Lock()
+# stage name -> [calls, seconds, bytes, failures]
+_stages = {}
+# counter name -> value
+_counters = {}
+_hooks = []
+
+
+def add_hook(hook:Callable[[dict], None]):
+    """
+    Register a function called with each recorded event. Events are dicts with:
+
+    - `type`: `stage` or `counter`
+    - `name`: the stage or counter name
+    - `seconds`, `bytes` and `failed` for stages, `value` for counters
+    - `time` and `pid`
+
+    :param hook: The function to call, from the thread that recorded the event
+    :return:
+    """
+    with _lock:
+        _hooks.append(hook)
+
+
+def remove_hook(hook:Callable[[dict], None]):
+    with _lock:
+        if hook in _hooks:
+            _hooks.remove(hook)
+
+
+@contextmanager
+def timed(stage:str, num_bytes:int = 0):
+    """
+    Time a stage, e.g. `with timed("hash") as event: ...`
+
+    :param stage: The stage name
+    :param num_bytes: The bytes processed, if known upfront. Otherwise set `event["bytes"]` in the block.
+    :return:
+    """
+    event = {"type": "stage", "name": stage, "bytes": num_bytes, "failed": False}
+    start = time.perf_counter()
+    try:
+        yield event
+    except BaseException:
+        event["failed"] = True
+        raise
+    finally:
+        event["seconds"] = time.perf_counter() - start
+        _record(event)
+
+
+def count(name:str, value:int = 1):
+    """
+    Increment a counter
+
+    :param name: The counter name
+    :param value: The increment
+    :return:
+    """
+    _record({"type": "counter", "name": name, "value": value})
+
+
+def _record(event:dict):
+    event["time"] = time.time()
+    event["pid"] = os.getpid()
+
+    with _lock:
+        if event["type"] == "stage":
+            stage = _stages.setdefault(event["name"], [0, 0.0, 0, 0])
+            stage[0] += 1
+            stage[1] += event["seconds"]
+            stage[2] += event["bytes"]
+            stage[3] += int(event["failed"])
+        else:
+            _counters[event["name"]] = _counters.get(event["name"], 0) + event["value"]
+        hooks = list(_hooks)
+
+    for hook in hooks:
+        hook(event)
+
+
+def snapshot() -> Dict[str, dict]:
+    """
+    Get the metrics aggregated since the start of the process (or the last reset)
+
+    :return: dict with `stages` (name to calls, seconds, bytes and failures) and `counters` (name to value)
+    """
+    with _lock:
+        return {
+            "stages": {name: {"calls": calls, "seconds": seconds, "bytes": num_bytes, "failures": failures}
+                       for name, (calls, seconds, num_bytes, failures) in _stages.items()},
+            "counters": dict(_counters),
+        }
+
+
+def reset():
+    with _lock:
+        _stages.clear()
+        _counters.clear()
+
+
+def to_prometheus() -> str:
+    """
+    Format the aggregated metrics in the Prometheus text exposition format
+
+    :return:
+    """
+    metrics = snapshot()
+    lines = []
+    for metric, field, help_text in [("lazydata_stage_calls_total", "calls", "Number of times a stage ran"),
+                                     ("lazydata_stage_seconds_total", "seconds", "Time spent in a stage"),
+                                     ("lazydata_stage_bytes_total", "bytes", "Bytes processed by a stage"),
+                                     ("lazydata_stage_failures_total", "failures", "Number of times a stage failed")]:
+        lines.append("# HELP %s %s" % (metric, help_text))
+        lines.append("# TYPE %s counter" % metric)
+        for name, stage in sorted(metrics["stages"].items()):
+            lines.append('%s{stage="%s"} %s' % (metric, name, stage[field]))
+
+    lines.append("# HELP lazydata_events_total Number of times an event happened")
+    lines.append("# TYPE lazydata_events_total counter")
+    for name, value in sorted(metrics["counters"].items()):
+        lines.append('lazydata_events_total{event="%s"} %s' % (name, value))
+
+    return "\n".join(lines) + "\n"
+
+
+class JsonLinesWriter:
+    """
+    A hook appending each event as a line of JSON to a file, safe to share between processes
+    """
+
+    def __init__(self, path:str):
+        self.path = path
+        self._lock = threading.Lock()
+
+    def __call__(self, event:dict):
+        line = json.dumps(event, sort_keys=True) + "\n"
+        with self._lock:
+            # a single small append is atomic, so lines of concurrent processes don't interleave
+            with open(self.path, "a") as fp:
+                fp.write(line)
+
+
+def write_prometheus(path:str):
+    """
+    Write the aggregated metrics to a file in the Prometheus text format, e.g. for the node exporter textfile collector
+
+    :param path:
+    :return:
+    """
+    tmp_path = "%s.%d.tmp" % (path, os.getpid())
+    with open(tmp_path, "w") as fp:
+        fp.write(to_prometheus())
+    os.replace(tmp_path, path)
+
+
+def _setup_from_env():
+    path = os.environ.get(METRICS_ENV_VAR)
+    if not path:
+        return
+    if path.endswith(".prom"):
+        atexit.register(write_prometheus, path)
+    else:
+        add_hook(JsonLinesWriter(path))
+
+
+_setup_from_env()
@@ -0,0 +1,196 @@
+"""
+Bundles: single-file archives of blobs from the local cache, to move files where no remote is reachable
+
+A bundle is an uncompressed tar file, so it can be inspected with standard tools and streamed through
+pipes. Its first member is `lazydata-index.json`, followed by one member per blob named like in the remote
+(`data/xx/xxxx`). The index maps each sha256 to the offset of its content (relative to the end of the
+index member) and its size, which makes the blobs readable in parallel when the bundle is a regular file.
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+from typing import BinaryIO, Dict, Iterable, List, Tuple
+import json
+import os
+import stat
+import tarfile
+import time
+
+from lazydata.metrics import count, timed
+from lazydata.storage.hash import BUF_SIZE
+from lazydata.storage.local import LocalStorage
+from lazydata.storage.status import HASH_WORKERS
+
+INDEX_NAME = "lazydata-index.json"
+BUNDLE_VERSION = 1
+
+# tar headers and content are in blocks of this size
+TAR_BLOCK = tarfile.BLOCKSIZE
+
+
+def _padded(size:int) -> int:
+    return (size + TAR_BLOCK - 1) // TAR_BLOCK * TAR_BLOCK
+
+
+def _tar_info(name:str, size:int, mtime:float) -> tarfile.TarInfo:
+    info = tarfile.TarInfo(name)
+    info.size = size
+    info.mtime = int(mtime)
+    info.mode = 0o644
+    return info
+
+
+def write_bundle(local:LocalStorage, hashes:List[str], fileobj:BinaryIO, files:List[dict] = ()) -> int:
+    """
+    Write the blobs into a bundle. The output is written sequentially, so it can be a pipe.
+
+    :param local: LocalStorage instance holding the blobs
+    :param hashes: sha256 of the blobs to bundle, all of them in the local cache
+    :param fileobj: Binary file object to write the bundle to
+    :param files: config entries of the bundled files, recorded in the index for reference
+    :return: The total size of the bundled blobs
+    """
+    # the offsets are known upfront, as all the members have a single 512 byte header: the names are short, and
+    # the GNU format stores sizes of 8GB and more in the same header (the ustar format can't)
+    blobs = {}
+    offset = 0
+    for sha256 in hashes:
+        size = local.hash_to_file(sha256).stat().st_size
+        blobs[sha256] = [offset + TAR_BLOCK, size]
+        offset += TAR_BLOCK + _padded(size)
+
+    index = json.dumps({
+        "version": BUNDLE_VERSION,
+        "blobs": blobs,
+        "files": [{"path": e["path"], "hash": e["hash"]} for e in files],
+    }, sort_keys=True).encode("utf-8")
+
+    now = time.time()
+    total = 0
+    with tarfile.open(fileobj=fileobj, mode="w|", format=tarfile.GNU_FORMAT, bufsize=BUF_SIZE * 16) as tar:
+        tar.addfile(_tar_info(INDEX_NAME, len(index), now), _BytesReader(index))
+        for sha256 in hashes:
+            size = blobs[sha256][1]
+            with timed("bundle_write", size), open(str(local.hash_to_file(sha256)), "rb") as fp:
+                tar.addfile(_tar_info(str(local.hash_to_remote_path(sha256)), size, now), fp)
+            total += size
+    return total
+
+
+class _BytesReader:
+    def __init__(self, data:bytes):
+        self.data = data
+        self.position = 0
+
+    def read(self, size:int = -1) -> bytes:
+        end = len(self.data) if size < 0 else self.position + size
+        data = self.data[self.position:end]
+        self.position += len(data)
+        return data
+
+
+def _read_index(tar:tarfile.TarFile) -> Tuple[dict, tarfile.TarInfo]:
+    member = tar.next()
+    if member is None or member.name != INDEX_NAME:
+        raise RuntimeError("Not a lazydata bundle: the first member should be `%s`." % INDEX_NAME)
+    index = json.loads(tar.extractfile(member).read().decode("utf-8"))
+    if index.get("version") != BUNDLE_VERSION:
+        raise RuntimeError("Unsupported bundle version %s, upgrade lazydata to read it." % index.get("version"))
+    return index, member
+
+
+def _iter_range(fd:int, offset:int, size:int) -> Iterable[bytes]:
+    end = offset + size
+    while offset < end:
+        data = os.pread(fd, min(BUF_SIZE * 16, end - offset), offset)
+        if not data:
+            raise RuntimeError("The bundle ended unexpectedly.")
+        offset += len(data)
+        yield data
+
+
+def _import_blob(local:LocalStorage, chunks:Iterable[bytes], sha256:str) -> bool:
+    """
+    :return: False if the blob is corrupted in the bundle
+    """
+    try:
+        local.store_stream(chunks, sha256=sha256)
+    except RuntimeError:
+        # the content didn't match the hash, or the bundle was cut short
+        return False
+    return True
+
+
+def _add_result(result:dict, sha256:str, size:int, imported:bool):
+    if imported:
+        result["imported"] += 1
+        result["bytes"] += size
+    else:
+        result["corrupted"].append(sha256)
+
+
+def import_bundle(local:LocalStorage, fileobj:BinaryIO, workers:int = HASH_WORKERS) -> Dict[str, int]:
+    """
+    Import the blobs of a bundle into the local cache, verifying each of them against its hash.
+    Blobs that are already in the cache are skipped.
+
+    If the bundle is a regular file, the blobs are read and verified in parallel, otherwise (e.g. stdin)
+    they are read in the order they are in.
+
+    :param local: LocalStorage instance to import into
+    :param fileobj: Binary file object with the bundle
+    :param workers: Number of blobs imported in parallel
+    :return: dict with the number of `imported` and `skipped` blobs, the `bytes` imported
+             and the list of sha256 of the `corrupted` blobs that were not imported
+    """
+    result = {"imported": 0, "skipped": 0, "bytes": 0, "corrupted": []}
+
+    try:
+        seekable = stat.S_ISREG(os.fstat(fileobj.fileno()).st_mode)
+    except (AttributeError, OSError, ValueError):
+        seekable = False
+
+    if seekable:
+        start = fileobj.tell()
+        with tarfile.open(fileobj=fileobj, mode="r|") as tar:
+            index, member = _read_index(tar)
+        base = start + member.offset_data + _padded(member.size)
+
+        todo = []
+        for sha256, (offset, size) in index["blobs"].items():
+            if local.hash_to_file(sha256).exists():
+                result["skipped"] += 1
+            else:
+                todo.append((sha256, offset, size))
+
+        fd = fileobj.fileno()
+
+        def import_blob(item):
+            sha256, offset, size = item
+            with timed("bundle_import", size):
+                return _import_blob(local, _iter_range(fd, base + offset, size), sha256)
+
+        # the largest first, so a big blob at the end doesn't run alone
+        todo.sort(key=lambda item: -item[2])
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            for (sha256, _, size), imported in zip(todo, executor.map(import_blob, todo)):
+                _add_result(result, sha256, size, imported)
+    else:
+        with tarfile.open(fileobj=fileobj, mode="r|") as tar:
+            index, _ = _read_index(tar)
+            names = {str(local.hash_to_remote_path(sha256)): sha256 for sha256 in index["blobs"]}
+            for member in tar:
+                sha256 = names.get(member.name)
+                if sha256 is None:
+                    continue
+                if local.hash_to_file(sha256).exists():
+                    # skipped over by the next call to tar.next()
+                    result["skipped"] += 1
+                    continue
+                reader = tar.extractfile(member)
+                with timed("bundle_import", member.size):
+                    imported = _import_blob(local, iter(lambda: reader.read(BUF_SIZE * 16), b""), sha256)
+                _add_result(result, sha256, member.size, imported)
+
+    count("bundle_blob_imported", result["imported"])
+    count("bundle_blob_skipped", result["skipped"])
+    return result
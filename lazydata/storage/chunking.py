@@ -0,0 +1,208 @@
+"""
+Content-defined chunking of big files, so that a new version uploads and downloads only the chunks that changed
+
+A chunked file is stored as two kinds of objects in the remote:
+
+- `chunks/<chunk sha256>` with the content of each chunk, shared by all the files and versions that contain it
+- `manifests/<sha256>.json` listing the hash and size of the chunks of a file, in order
+
+The manifest is uploaded after the chunks, so it also acts as the completion marker.
+
+Chunk boundaries depend only on the bytes around them, so inserting or deleting bytes in a file changes
+the chunks around the edit but not the ones after it. A boundary is cut after an ANCHOR byte when the CRC
+of the CHUNK_WINDOW bytes ending there matches CUT_MASK. Looking for the anchor byte with `find()` keeps the
+pure Python loop to a few iterations per kilobyte.
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path, PurePosixPath
+from typing import Callable, Dict, Iterable, List, Tuple
+import hashlib
+import json
+import mmap
+import os
+import tempfile
+import zlib
+
+from lazydata.metrics import count, timed
+from lazydata.storage.local import LocalStorage
+
+# Default size from which files are chunked, used when `chunk_threshold: true` is set in lazydata.yml
+DEFAULT_CHUNK_THRESHOLD = 64 * 1024 * 1024
+# Bounds of the chunk sizes, the average is about MIN_CHUNK_SIZE + 1MB
+MIN_CHUNK_SIZE = 256 * 1024
+MAX_CHUNK_SIZE = 4 * 1024 * 1024
+# A boundary candidate follows each occurrence of this byte
+ANCHOR = b"\n"
+# Number of bytes before a candidate whose CRC decides if it's a boundary
+CHUNK_WINDOW = 32
+CUT_MASK = (1 << 12) - 1
+# Number of chunks downloaded in parallel while a file is reassembled
+CHUNK_WORKERS = 16
+# Number of chunks of a file uploaded in parallel, on top of the files that are uploaded in parallel
+CHUNK_UPLOAD_CONCURRENCY = 4
+
+CHUNKS_PREFIX = "chunks/"
+MANIFESTS_PREFIX = "manifests/"
+MANIFEST_VERSION = 1
+
+
+def get_chunk_threshold(config) -> int:
+    """
+    Get the size from which files are chunked for this project, 0 if chunking is disabled
+
+    :param config: project Config instance
+    :return:
+    """
+    threshold = config.config.get("chunk_threshold")
+    if threshold is True:
+        return DEFAULT_CHUNK_THRESHOLD
+    elif not threshold:
+        return 0
+    return int(threshold)
+
+
+def chunk_key(chunk_sha256:str) -> str:
+    return str(PurePosixPath("chunks", chunk_sha256))
+
+
+def manifest_key(sha256:str) -> str:
+    return str(PurePosixPath("manifests", "%s.json" % sha256))
+
+
+def find_chunks(path:str) -> List[List]:
+    """
+    Split a file into content-defined chunks
+
+    :param path: Path to the file
+    :return: list of [sha256, size] of the chunks, in order
+    """
+    chunks = []
+    with open(path, "rb") as fp:
+        size = os.fstat(fp.fileno()).st_size
+        if size == 0:
+            return chunks
+
+        with timed("chunking", size), mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            view = memoryview(mm)
+            try:
+                position = 0
+                while position < size:
+                    end = min(position + MAX_CHUNK_SIZE, size)
+                    cut = end
+                    candidate = position + MIN_CHUNK_SIZE
+                    while candidate < end:
+                        candidate = mm.find(ANCHOR, candidate, end)
+                        if candidate < 0:
+                            break
+                        if zlib.crc32(view[candidate - CHUNK_WINDOW:candidate + 1]) & CUT_MASK == 0:
+                            cut = candidate + 1
+                            break
+                        candidate += 1
+
+                    chunks.append([hashlib.sha256(view[position:cut]).hexdigest(), cut - position])
+                    position = cut
+            finally:
+                view.release()
+
+    return chunks
+
+
+def encode_manifest(chunks:List[List]) -> bytes:
+    return json.dumps({"version": MANIFEST_VERSION, "size": sum(size for _, size in chunks), "chunks": chunks},
+                      sort_keys=True).encode("utf-8")
+
+
+def decode_manifest(data:bytes) -> List[List]:
+    manifest = json.loads(data.decode("utf-8"))
+    if manifest.get("version") != MANIFEST_VERSION:
+        raise RuntimeError("Unsupported chunk manifest version %s, upgrade lazydata to read it." %
+                           manifest.get("version"))
+    return manifest["chunks"]
+
+
+def save_chunks(local:LocalStorage, sha256:str, chunks:List[List]):
+    """
+    Keep the chunk list of a file in the local cache, next to the file
+    """
+    path = local.hash_to_chunks_file(sha256)
+    fd, tmp_name = tempfile.mkstemp(dir=str(local.tmp_path), suffix=".chunks")
+    with os.fdopen(fd, "wb") as fp:
+        fp.write(encode_manifest(chunks))
+    os.replace(tmp_name, str(path))
+
+
+def get_chunks(local:LocalStorage, sha256:str) -> List[List]:
+    """
+    Get the chunks of a file in the local cache, splitting it only the first time
+
+    :param local: LocalStorage instance holding the file
+    :param sha256: hash of the file
+    :return: list of [sha256, size] of the chunks, in order
+    """
+    path = local.hash_to_chunks_file(sha256)
+    if path.exists():
+        with open(str(path), "rb") as fp:
+            return decode_manifest(fp.read())
+
+    chunks = find_chunks(str(local.hash_to_file(sha256)))
+    save_chunks(local, sha256, chunks)
+    return chunks
+
+
+def find_reusable_chunks(local:LocalStorage, hashes:Iterable[str]) -> Dict[str, Tuple[Path, int]]:
+    """
+    Find where the chunks of files in the local cache are, e.g. of the other versions of a file being downloaded
+
+    :param local: LocalStorage instance
+    :param hashes: sha256 of the files in the local cache
+    :return: dict of chunk sha256 -> (path of the file, offset of the chunk in it)
+    """
+    reusable = {}
+    for sha256 in hashes:
+        path = local.hash_to_file(sha256)
+        if not path.exists():
+            continue
+        offset = 0
+        for chunk_sha256, size in get_chunks(local, sha256):
+            reusable.setdefault(chunk_sha256, (path, offset))
+            offset += size
+    return reusable
+
+
+def assemble_chunks(chunks:List[List], reusable:Dict[str, Tuple[Path, int]],
+                    fetch_chunk:Callable[[str], bytes]) -> Iterable[bytes]:
+    """
+    Generator over the content of a chunked file, reading the chunks available locally and downloading the others
+    in parallel ahead of their turn
+
+    :param chunks: list of [sha256, size] of the chunks of the file
+    :param reusable: Locally available chunks, from find_reusable_chunks()
+    :param fetch_chunk: Function downloading a chunk by its sha256 and returning its verified content
+    :return:
+    """
+    remote_positions = [i for i, (chunk_sha256, _) in enumerate(chunks) if chunk_sha256 not in reusable]
+    count("chunk_reused", len(chunks) - len(remote_positions))
+    count("chunk_downloaded", len(remote_positions))
+
+    futures = {}
+    next_remote = 0
+    with ThreadPoolExecutor(max_workers=CHUNK_WORKERS) as executor:
+        try:
+            for i, (chunk_sha256, size) in enumerate(chunks):
+                # keep CHUNK_WORKERS downloads going, without holding more than that in memory
+                while next_remote < len(remote_positions) and len(futures) < CHUNK_WORKERS:
+                    position = remote_positions[next_remote]
+                    futures[position] = executor.submit(fetch_chunk, chunks[position][0])
+                    next_remote += 1
+
+                if i in futures:
+                    yield futures.pop(i).result()
+                else:
+                    path, offset = reusable[chunk_sha256]
+                    with open(str(path), "rb") as fp:
+                        fp.seek(offset)
+                        yield fp.read(size)
+        finally:
+            for future in futures.values():
+                future.cancel()
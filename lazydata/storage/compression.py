@@ -0,0 +1,177 @@
+"""
+Optional compression of the blobs stored in a remote
+
+The codec used for a blob is recorded in the object metadata, so remotes can hold a mix of
+compressed and uncompressed blobs, and the hashes always refer to the uncompressed content.
+"""
+
+from pathlib import Path
+from typing import Callable, Iterable, Optional
+import zlib
+
+import lazy_import
+zstandard = lazy_import.lazy_module("zstandard")
+
+from lazydata.storage.hash import BUF_SIZE
+
+# Object metadata key holding the codec name of a compressed blob
+ENCODING_METADATA_KEY = "lazydata-encoding"
+
+# File formats that are already compressed and wouldn't get any smaller
+INCOMPRESSIBLE_EXTENSIONS = {
+    ".gz", ".tgz", ".bz2", ".xz", ".lz4", ".zst", ".zip", ".7z", ".rar",
+    ".jpg", ".jpeg", ".png", ".gif", ".webp", ".mp3", ".mp4", ".mkv", ".avi", ".mov",
+    ".parquet", ".orc", ".npz", ".pt", ".tfrecord",
+}
+
+
+class GzipCodec:
+    """
+    gzip at the fastest level, always available
+    """
+    name = "gzip"
+
+    def compressobj(self):
+        return zlib.compressobj(1, zlib.DEFLATED, 31)
+
+    def decompressobj(self):
+        return zlib.decompressobj(31)
+
+
+class ZstdCodec:
+    """
+    Zstandard, needs the optional `zstandard` package
+    """
+    name = "zstd"
+
+    def compressobj(self):
+        return zstandard.ZstdCompressor(level=1).compressobj()
+
+    def decompressobj(self):
+        return ZstdDecompressObj()
+
+
+class ZstdDecompressObj:
+    """
+    Adapter giving the zstandard streaming decompressor the same interface as zlib's
+    """
+
+    def __init__(self):
+        self.obj = zstandard.ZstdDecompressor().decompressobj()
+
+    def decompress(self, data:bytes) -> bytes:
+        return self.obj.decompress(data)
+
+    def flush(self) -> bytes:
+        return b""
+
+
+CODECS = {
+    "gzip": GzipCodec(),
+    "zstd": ZstdCodec(),
+}
+
+
+def zstandard_available() -> bool:
+    """
+    Check if the optional `zstandard` package can be imported
+    """
+    # find_spec() can't be used, the lazy module is already in sys.modules without a spec
+    try:
+        zstandard.ZstdCompressor
+    except ImportError:
+        return False
+    return True
+
+
+def get_codec(name:Optional[str]):
+    """
+    Get the codec by name
+
+    :param name: Name of the codec, `None` or `none` for no compression
+    :return: The codec object or None
+    """
+    if name is None or name == "none":
+        return None
+
+    if name not in CODECS:
+        raise RuntimeError("Unknown compression `%s`. Supported: %s" % (name, ", ".join(sorted(CODECS))))
+
+    if name == "zstd" and not zstandard_available():
+        raise RuntimeError("Compression `zstd` needs the `zstandard` package. Install it with `pip install zstandard`.")
+
+    return CODECS[name]
+
+
+def should_compress(path:str) -> bool:
+    """
+    Check if it's worth compressing a file based on its extension
+
+    :param path: The filename the user would recognise
+    :return:
+    """
+    return Path(path).suffix.lower() not in INCOMPRESSIBLE_EXTENSIONS
+
+
+def decompress_stream(chunks:Iterable[bytes], encoding:str) -> Iterable[bytes]:
+    """
+    Decompress a stream of compressed chunks
+
+    :param chunks: Iterable of compressed bytes
+    :param encoding: The codec name recorded in the object metadata
+    :return: Generator of uncompressed bytes
+    """
+    obj = get_codec(encoding).decompressobj()
+    for chunk in chunks:
+        data = obj.decompress(chunk)
+        if data:
+            yield data
+    data = obj.flush()
+    if data:
+        yield data
+
+
+class CompressingReader:
+    """
+    A read-only file-like object returning the compressed content of a file
+    """
+
+    def __init__(self, path:str, codec, callback:Optional[Callable[[int], None]] = None):
+        """
+        :param path: Path of the file to compress
+        :param codec: The codec to use
+        :param callback: Called with the number of uncompressed bytes consumed, for progress reporting
+        """
+        self.fp = open(path, "rb")
+        self.obj = codec.compressobj()
+        self.callback = callback
+        self.buffer = b""
+        self.eof = False
+
+    def read(self, size:int = -1) -> bytes:
+        while not self.eof and (size < 0 or len(self.buffer) < size):
+            data = self.fp.read(BUF_SIZE * 16)
+            if data:
+                self.buffer += self.obj.compress(data)
+                if self.callback is not None:
+                    self.callback(len(data))
+            else:
+                self.buffer += self.obj.flush()
+                self.eof = True
+
+        if size < 0:
+            size = len(self.buffer)
+        result, self.buffer = self.buffer[:size], self.buffer[size:]
+        return result
+
+    def seekable(self) -> bool:
+        return False
+
+    def close(self):
+        self.fp.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
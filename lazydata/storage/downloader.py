@@ -0,0 +1,148 @@
+"""
+Pooled HTTP downloader for files added with a source URL
+
+"""
+
+from typing import Iterable, Optional, Tuple
+from urllib.error import HTTPError
+import threading
+
+import lazy_import
+urllib3 = lazy_import.lazy_module("urllib3")
+
+from lazydata.metrics import count
+from lazydata.storage.hash import BUF_SIZE
+from lazydata.storage.local import LocalStorage, SourceUrl
+from lazydata.storage.transfer import MAX_CONCURRENCY, CONNECT_TIMEOUT, READ_TIMEOUT
+
+_downloader = None
+_downloader_lock = threading.Lock()
+
+
+def get_downloader() -> "HttpDownloader":
+    """
+    Get the downloader shared by the whole process, so that its keep-alive connections are reused
+
+    :return:
+    """
+    global _downloader
+    with _downloader_lock:
+        if _downloader is None:
+            _downloader = HttpDownloader()
+        return _downloader
+
+
+class HttpDownloader:
+    """
+    Downloads over a pool of keep-alive connections shared by all threads.
+
+    The ETag and Last-Modified of each downloaded URL are stored in the metadb, so that a later
+    download of the same URL is a conditional request that skips the body if it hasn't changed.
+    """
+
+    def __init__(self):
+        # retries are left to the transfer layer, which also hedges straggling requests
+        self.pool = urllib3.PoolManager(maxsize=MAX_CONCURRENCY, retries=False,
+                                        timeout=urllib3.Timeout(connect=CONNECT_TIMEOUT, read=READ_TIMEOUT),
+                                        headers={"User-Agent": "lazydata"})
+
+    def _request(self, method:str, url:str, headers:Optional[dict] = None):
+        response = self.pool.request(method, url, headers=headers, preload_content=False, redirect=True)
+        if response.status >= 400:
+            response.release_conn()
+            # same error as urllib so the transfer layer can tell if it should retry
+            raise HTTPError(url, response.status, response.reason, response.headers, None)
+        return response
+
+    def head(self, url:str) -> Tuple[int, bool]:
+        """
+        Get the size of the file at the URL and if the server supports byte ranges
+
+        :param url:
+        :return: tuple of the size (0 if unknown) and True if ranged requests are supported
+        """
+        response = self._request("HEAD", url)
+        response.release_conn()
+        return int(response.headers.get("Content-Length") or 0), response.headers.get("Accept-Ranges") == "bytes"
+
+    def probe(self, url:str) -> Tuple[int, bool]:
+        """
+        Same as head(), except that a failed HEAD request counts as an unknown size without byte ranges. Some servers
+        reject HEAD requests (405), or only accept the GET request a URL was signed for (e.g. presigned S3 URLs), so
+        only the GET request decides if the file can be downloaded.
+
+        :param url:
+        :return: tuple of the size (0 if unknown) and True if ranged requests are supported
+        """
+        try:
+            return self.head(url)
+        except (OSError, urllib3.exceptions.HTTPError):
+            count("source_head_failed")
+            return 0, False
+
+    def fetch_range(self, url:str, start:int, end:int) -> Iterable[bytes]:
+        """
+        Generator over the bytes of a URL between `start` and `end` (inclusive)
+
+        :param url:
+        :param start:
+        :param end:
+        :return:
+        """
+        response = self._request("GET", url, headers={"Range": "bytes=%d-%d" % (start, end)})
+        try:
+            if response.status != 206:
+                raise RuntimeError("Server for `%s` ignored the byte range request." % url)
+            yield from response.stream(BUF_SIZE, decode_content=False)
+        finally:
+            response.release_conn()
+
+    def download(self, local:LocalStorage, url:str, sha256:Optional[str] = None, name:str = "") -> str:
+        """
+        Download a URL into the local cache
+
+        :param local: LocalStorage instance
+        :param url: The URL to download
+        :param sha256: The expected sha256, if known
+        :param name: The filename the user would recognise, used in error messages
+        :return: The sha256 of the downloaded file
+        """
+        headers = {}
+        known = SourceUrl.get_or_none(SourceUrl.url == url)
+        if known is not None and local.hash_to_file(known.sha256).exists() and sha256 in (None, known.sha256):
+            # we already have the last version we've seen, only get the body if it changed since
+            if known.etag:
+                headers["If-None-Match"] = known.etag
+            if known.last_modified:
+                headers["If-Modified-Since"] = known.last_modified
+
+        response = self._request("GET", url, headers=headers)
+        try:
+            if response.status == 304:
+                count("source_not_modified")
+                return known.sha256
+
+            downloaded_sha256 = local.store_stream(response.stream(BUF_SIZE, decode_content=False),
+                                                   sha256=sha256, name=name)
+        finally:
+            response.release_conn()
+
+        self.remember(url, response.headers, downloaded_sha256)
+        return downloaded_sha256
+
+    @staticmethod
+    def remember(url:str, headers, sha256:str):
+        """
+        Store the validators of a downloaded URL for later conditional requests
+
+        :param url:
+        :param headers: The response headers
+        :param sha256: The hash of the downloaded content
+        :return:
+        """
+        etag = headers.get("ETag")
+        last_modified = headers.get("Last-Modified")
+        if etag is None and last_modified is None:
+            return
+
+        SourceUrl.replace(url=url, etag=etag, last_modified=last_modified, sha256=sha256).execute()
@@ -1,8 +1,25 @@
-from typing import Optional
+from collections import OrderedDict
+from concurrent.futures import Future
+from typing import List, Optional
+import atexit
+import queue
+import threading
 
 from lazydata.config.config import Config
+from lazydata.metrics import count
 from lazydata.storage.local import LocalStorage
+from lazydata.storage.pack import get_pack_threshold
+from lazydata.storage.peers import fetch_from_peers, get_peers
 from lazydata.storage.remote import RemoteStorage, UrlRemoteStorage
+from lazydata.storage.status import get_status, STATUS_OK
+from lazydata.storage.transfer import call_with_retries, run_adaptive, INITIAL_CONCURRENCY
+
+# Number of files fetched in parallel by a background prefetch
+PREFETCH_WORKERS = INITIAL_CONCURRENCY
+
+# The background prefetch of this process, if any
+_prefetcher = None
+_prefetcher_lock = threading.Lock()
 
 
 def fetch_file(config: Config, local: LocalStorage, path: str, sha256: Optional[str] = None,
@@ -18,15 +35,20 @@ def fetch_file(config: Config, local: LocalStorage, path: str, sha256: Optional[
     :param path: where the file should be copied to
     :param sha256: hash of the file we need
     :param source_url: URL of the source of the file we need
-    :return:
+    :return: The sha256 of the fetched file
     """
     if sha256 is None and source_url is None:
         raise RuntimeError("Fetching file `%s`: neither sha256 nor source_url was specified.")
 
     if sha256 is not None:
+        # a background prefetch might already be bringing the file in
+        wait_for_prefetch(sha256)
         local_copy_success = local.copy_file_to(sha256, path)
     else:
         local_copy_success = False
+    count("cache_hit" if local_copy_success else "cache_miss")
+    if not local_copy_success and sha256 is not None and fetch_from_peers(local, sha256):
+        local_copy_success = local.copy_file_to(sha256, path)
     if not local_copy_success:
         if source_url is None:
             source_url = config.source_url(sha256=sha256)
@@ -34,7 +56,188 @@ def fetch_file(config: Config, local: LocalStorage, path: str, sha256: Optional[
             remote = RemoteStorage.get_from_config(config)
         else:
             remote = UrlRemoteStorage()
-        remote.download_to_local(config=config, local=local, sha256=sha256, source_url=source_url, path=path)
+        downloaded_sha256 = call_with_retries(remote.download_to_local, config=config, local=local, sha256=sha256,
+                                              source_url=source_url, path=path)
+        if sha256 is None:
+            sha256 = downloaded_sha256
+
+        local.copy_file_to(sha256, path)
+
+    return sha256
+
+
+def fetch_to_cache(config: Config, local: LocalStorage, sha256: str, use_peers: bool = True) -> int:
+    """
+    Make sure a file is in the local cache, without copying it anywhere
+
+    :param config: project Config instance
+    :param local: LocalStorage instance
+    :param sha256: hash of the file we need
+    :param use_peers: If False, the file is not looked for in the caches of the peers
+    :return: The size of the file
+    """
+    cached_path = local.hash_to_file(sha256)
+    count("cache_hit" if cached_path.exists() else "cache_miss")
+    if not cached_path.exists() and use_peers:
+        fetch_from_peers(local, sha256)
+    if not cached_path.exists():
+        source_url = config.source_url(sha256=sha256)
+        if source_url is None:
+            remote = RemoteStorage.get_from_config(config)
+        else:
+            remote = UrlRemoteStorage()
+        call_with_retries(remote.download_to_local, config=config, local=local, sha256=sha256, source_url=source_url)
+
+    return cached_path.stat().st_size
+
+
+def fetch_files(config: Config, local: LocalStorage, entries: List[dict], copy: bool = True):
+    """
+    Fetch the files for a list of config entries in parallel.
+
+    If there are multiple versions of the same path only the last one is fetched.
+
+    :param config: project Config instance
+    :param local: LocalStorage instance
+    :param entries: config file entries with `path` and `hash`
+    :param copy: If False, the files are only brought into the local cache
+    :return:
+    """
+    latest = OrderedDict((e["path"], e) for e in entries)
+
+    if copy:
+        # files already at the right version in the workspace are left alone, which only needs their stat
+        # unless they changed since they were last hashed
+        up_to_date = {s["path"] for s in get_status(config, local, list(latest.values())) if s["status"] == STATUS_OK}
+        if up_to_date:
+            print("LAZYDATA: %d files are already up to date" % len(up_to_date))
+            count("pull_up_to_date", len(up_to_date))
+            latest = OrderedDict((path, e) for path, e in latest.items() if path not in up_to_date)
+        if not latest:
+            return
 
-        if sha256 is not None:
-            local.copy_file_to(sha256, path)
+    if get_pack_threshold(config) and "remote" in config.config and not get_peers():
+        # bring in whole packs in bulk where that beats reading the files one by one
+        # (with peers, the files are brought in one by one from the peers that own them)
+        missing = [e["hash"] for e in latest.values() if not local.hash_to_file(e["hash"]).exists()]
+        if missing:
+            RemoteStorage.get_from_config(config).download_packs(local, missing)
+
+    def fetch_entry(e):
+        if copy:
+            fetch_file(config=config, local=local, path=str(config.abs_path(e["path"])), sha256=e["hash"])
+        return fetch_to_cache(config, local, e["hash"])
+
+    # the number of parallel downloads adapts to the throughput and throttling
+    stats = run_adaptive(fetch_entry, list(latest.values()))
+    print(stats.summary())
+
+
+class Prefetcher:
+    """
+    Fetches files into the local cache in the background, so that later fetches find them there
+    """
+
+    def __init__(self, config: Config, local: LocalStorage):
+        self.config = config
+        self.local = local
+        self.queue = queue.Queue()
+        self.workers = []
+        self.futures = {}
+        self.lock = threading.Lock()
+        # the workers are daemon threads, so that exiting doesn't wait for them to run through the queue
+        atexit.register(self.shutdown)
+
+    def _work(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                return
+            config, sha256, future = item
+            if not future.set_running_or_notify_cancel():
+                # cancelled at exit
+                continue
+            try:
+                future.set_result(fetch_to_cache(config, self.local, sha256))
+            except BaseException as e:
+                future.set_exception(e)
+
+    def submit(self, entries: List[dict]):
+        """
+        Start fetching the latest version of the files for these config entries
+
+        :param entries: config file entries with `path` and `hash`
+        :return:
+        """
+        latest = OrderedDict((e["path"], e) for e in entries)
+        with self.lock:
+            if not self.workers:
+                for i in range(PREFETCH_WORKERS):
+                    worker = threading.Thread(target=self._work, name="lazydata-prefetch-%d" % i, daemon=True)
+                    worker.start()
+                    self.workers.append(worker)
+
+            for e in latest.values():
+                sha256 = e["hash"]
+                if sha256 not in self.futures and not self.local.hash_to_file(sha256).exists():
+                    future = self.futures[sha256] = Future()
+                    self.queue.put((self.config, sha256, future))
+
+    def wait_for(self, sha256: str):
+        """
+        Wait until the file is prefetched, if it's being prefetched
+
+        :param sha256: hash of the file
+        :return:
+        """
+        with self.lock:
+            future = self.futures.get(sha256)
+        if future is not None:
+            try:
+                future.result()
+            except Exception:
+                # the foreground fetch will try again and report the error
+                pass
+
+    def shutdown(self):
+        """
+        Cancel the prefetches that haven't started, and wait for the files being transferred
+
+        :return:
+        """
+        with self.lock:
+            for future in self.futures.values():
+                future.cancel()
+            workers, self.workers = self.workers, []
+            for _ in workers:
+                self.queue.put(None)
+        for worker in workers:
+            worker.join()
+
+
+def start_prefetch(config: Config, local: LocalStorage, entries: List[dict]) -> Prefetcher:
+    """
+    Start fetching the files for these config entries in the background of this process
+
+    :param config: project Config instance
+    :param local: LocalStorage instance
+    :param entries: config file entries with `path` and `hash`
+    :return: The Prefetcher of this process
+    """
+    global _prefetcher
+    with _prefetcher_lock:
+        if _prefetcher is None:
+            _prefetcher = Prefetcher(config, local)
+    _prefetcher.submit(entries)
+    return _prefetcher
+
+
+def wait_for_prefetch(sha256: str):
+    """
+    Wait for the background prefetch of this file, if there is one
+
+    :param sha256: hash of the file
+    :return:
+    """
+    if _prefetcher is not None:
+        _prefetcher.wait_for(sha256)
@@ -4,6 +4,8 @@ Hashing-related function
 
 import hashlib
 
+from lazydata.metrics import timed
+
 # BUF_SIZE is totally arbitrary, change for your app!
 BUF_SIZE = 65536  # lets read stuff in 64kb chunks!
 
@@ -18,11 +20,39 @@ def calculate_file_sha256(path:str) -> str:
 
     sha256 = hashlib.sha256()
 
-    with open(path, 'rb') as f:
+    with timed("hash") as event, open(path, 'rb') as f:
         while True:
             data = f.read(BUF_SIZE)
             if not data:
                 break
             sha256.update(data)
+            event["bytes"] += len(data)
 
     return sha256.hexdigest()
+
+
+class HashingWriter:
+    """
+    A write-only file-like wrapper that calculates the SHA256 of the bytes as they are written,
+    so that the data doesn't need to be read back to be verified.
+    """
+
+    def __init__(self, fp):
+        """
+        :param fp: The underlying binary file object to write to
+        """
+        self.fp = fp
+        self.sha256 = hashlib.sha256()
+        self.size = 0
+
+    def write(self, data) -> int:
+        self.sha256.update(data)
+        self.size += len(data)
+        return self.fp.write(data)
+
+    def seekable(self) -> bool:
+        # writes have to arrive in order for the running hash to be correct
+        return False
+
+    def hexdigest(self) -> str:
+        return self.sha256.hexdigest()
@@ -4,19 +4,32 @@ An abstraction layer for the local cache
 """
 
 from pathlib import Path, PurePosixPath
+from typing import Dict, Iterable, List, Optional
 import yaml
 import os
 import stat
+import tempfile
 
-from peewee import SqliteDatabase, Model, CharField, IntegerField
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
 
-from lazydata.storage.hash import calculate_file_sha256
+from peewee import SqliteDatabase, Model, CharField, IntegerField, TextField, FloatField
+
+from lazydata.metrics import count, timed
+from lazydata.storage.hash import calculate_file_sha256, HashingWriter, BUF_SIZE
 import shutil
 
-BASE_PATH = Path(Path.home().resolve(), ".lazydata")
+# Set the LAZYDATA_HOME environment variable to keep the cache and the metadb somewhere else than ~/.lazydata
+HOME_ENV_VAR = "LAZYDATA_HOME"
+
+BASE_PATH = Path(os.environ[HOME_ENV_VAR]).resolve() if os.environ.get(HOME_ENV_VAR) \
+    else Path(Path.home().resolve(), ".lazydata")
 METADB_PATH = Path(BASE_PATH, "metadb.sqlite3")
 
 db = SqliteDatabase(str(METADB_PATH))
+_tables_created = False
 
 
 class LocalStorage:
@@ -28,7 +41,7 @@ class LocalStorage:
 
     def __init__(self):
         """
-        Initialise the object and make sure the ~/.lazydata directory exists
+        Initialise the object and make sure the ~/.lazydata (or LAZYDATA_HOME) directory exists
 
         """
 
@@ -36,12 +49,14 @@ class LocalStorage:
         self.base_path = BASE_PATH
         self.config_path = Path(self.base_path, "config.yml")
         self.data_path = Path(self.base_path, "data")
+        self.tmp_path = Path(self.base_path, "tmp")
         self.metadb_path = METADB_PATH
 
         # make sure base path exists
         if not self.base_path.exists():
-            self.base_path.mkdir()
+            self.base_path.mkdir(parents=True)
 
+        if not self.config_path.exists():
             # write a stub config file
             with open(str(self.config_path), "w") as fp:
                 fp.write("version: 1\n")
@@ -50,19 +65,28 @@ class LocalStorage:
         if not self.data_path.exists():
             self.data_path.mkdir()
 
+        # partial downloads live next to the data so that they can be atomically renamed into it
+        if not self.tmp_path.exists():
+            self.tmp_path.mkdir()
+
         # Load in the config file
         with open(str(self.config_path)) as fp:
-            self.config = yaml.load(fp)
+            self.config = yaml.safe_load(fp)
 
         self.metadb = db
         # open a connection to the sqlite database with file metadata
-        if not Path(self.metadb_path).exists():
-            # Make sure the DB exists
-            self.metadb.connect()
-            self.metadb.create_tables([DataFile])
-        elif self.metadb.is_closed():
+        if self.metadb.is_closed():
             self.metadb.connect()
 
+        # Make sure the DB has all the tables, including the ones added in newer versions
+        global _tables_created
+        if not _tables_created:
+            self.metadb.create_tables(METADB_TABLES, safe=True)
+            _tables_created = True
+
+        # (abspath, mtime, size) -> sha256 found in the metadata DB, saving the query in long-running processes
+        self._sha256_memo = {}
+
     def hash_to_file(self, sha256:str) -> Path:
         """Get the data storage path to a file with this hash
 
@@ -72,6 +96,25 @@ class LocalStorage:
 
         return Path(self.data_path, sha256[:2], sha256[2:])
 
+    def hash_to_parsed_file(self, sha256:str, reader_key:str) -> Path:
+        """Get the path to the pickled object parsed from a file by a reader, next to the stored file
+
+        :param sha256:
+        :param reader_key: Key identifying the reader
+        :return:
+        """
+
+        return Path(self.data_path, sha256[:2], "%s.%s.pickle" % (sha256[2:], reader_key))
+
+    def hash_to_chunks_file(self, sha256:str) -> Path:
+        """Get the path to the list of content-defined chunks of a file, next to the stored file
+
+        :param sha256:
+        :return:
+        """
+
+        return Path(self.data_path, sha256[:2], "%s.chunks" % sha256[2:])
+
     def hash_to_remote_path(self, sha256:str) -> PurePosixPath:
         """Get the remote path (in posix format)
 
@@ -81,18 +124,19 @@ class LocalStorage:
 
         return PurePosixPath("data", sha256[:2], sha256[2:])
 
-    def store_file(self, path:str):
+    def store_file(self, path:str, sha256:Optional[str] = None) -> str:
         """
         Store a file in the local backend.
 
         :ivar path: The path to the file to store
-        :return:
+        :ivar sha256: The sha256 of the file, if it's already known
+        :return: The sha256 of the stored file
         """
 
-        stat = os.stat(path)
         abspath = Path(path).resolve()
 
-        sha256 = calculate_file_sha256(path)
+        if sha256 is None:
+            sha256 = calculate_file_sha256(path)
 
         # see if we stored this file already
         datapath = self.hash_to_file(sha256)
@@ -101,7 +145,71 @@ class LocalStorage:
         # TODO: option to hardlink
         datapath.parent.mkdir(parents=True, exist_ok=True)
         if not datapath.exists():
-            shutil.copyfile(str(abspath), str(datapath))
+            with timed("cache_store", os.path.getsize(str(abspath))):
+                fast_copyfile(str(abspath), str(datapath))
+
+        self.register_file(path, sha256)
+
+        return sha256
+
+    def store_stream(self, chunks:Iterable[bytes], sha256:Optional[str] = None, name:str = "") -> str:
+        """
+        Store a stream of bytes (e.g. a download) in the local backend.
+
+        The bytes are hashed as they are written into a temporary file, which is then atomically
+        renamed into the cache, so the data never needs to be read back.
+
+        :param chunks: An iterable of bytes objects with the file content
+        :param sha256: The expected sha256, if known. The stream is rejected if it doesn't match.
+        :param name: The filename the user would recognise, used in error messages
+        :return: The sha256 of the stored file
+        """
+
+        fd, tmp_name = tempfile.mkstemp(dir=str(self.tmp_path), suffix=".download")
+        try:
+            with os.fdopen(fd, "wb") as fp:
+                writer = HashingWriter(fp)
+                for chunk in chunks:
+                    writer.write(chunk)
+
+            downloaded_sha256 = writer.hexdigest()
+            if sha256 is not None and sha256 != downloaded_sha256:
+                raise RuntimeError("Hash for the downloaded file `%s` is incorrect. "
+                                   "File might be corrupted in the remote storage backend." % name)
+
+            self.commit_temp_file(tmp_name, downloaded_sha256)
+        finally:
+            if os.path.exists(tmp_name):
+                os.unlink(tmp_name)
+
+        return downloaded_sha256
+
+    def commit_temp_file(self, tmp_name:str, sha256:str) -> Path:
+        """
+        Atomically move a fully written and verified temporary file into the cache
+
+        :param tmp_name: Path to the temporary file (on the same filesystem as the cache)
+        :param sha256: The verified sha256 of the file
+        :return: Path to the stored file
+        """
+
+        datapath = self.hash_to_file(sha256)
+        datapath.parent.mkdir(parents=True, exist_ok=True)
+        os.replace(tmp_name, str(datapath))
+        return datapath
+
+    def register_file(self, path:str, sha256:str):
+        """
+        Record the current mtime and size of a file with a known sha256 in the metadata DB,
+        so the next check on it doesn't need to re-hash it.
+
+        :param path: The path to the file
+        :param sha256: The sha256 of the file
+        :return:
+        """
+
+        stat = os.stat(path)
+        abspath = Path(path).resolve()
 
         # Store in the metadata DB if doesn't exist already
         existing_entries = DataFile.select().where(
@@ -115,6 +223,28 @@ class LocalStorage:
 
         if existing_entries.count() == 0:
             DataFile.create(abspath=abspath, sha256=sha256, mtime=stat.st_mtime, size=stat.st_size)
+        self._sha256_memo.pop((str(abspath), int(stat.st_mtime), stat.st_size), None)
+
+    def register_files(self, hashes:Dict[str, str]):
+        """
+        Bulk version of register_file for many files that aren't in the metadata DB with their current mtime and size
+
+        :param hashes: dict of path to the sha256 of the file
+        :return:
+        """
+
+        rows = []
+        dir_cache = {}
+        for path, sha256 in hashes.items():
+            stat = os.stat(path)
+            rows.append({"abspath": resolve_path(path, dir_cache), "sha256": sha256, "mtime": stat.st_mtime, "size": stat.st_size})
+
+        with self.metadb.atomic():
+            # stay well under the limit on the number of SQL variables
+            for i in range(0, len(rows), 200):
+                DataFile.insert_many(rows[i:i + 200]).execute()
+        for row in rows:
+            self._sha256_memo.pop((str(row["abspath"]), int(row["mtime"]), row["size"]), None)
 
     def get_file_sha256(self, path:str) -> list:
         """
@@ -124,25 +254,70 @@ class LocalStorage:
         :return: A list of sha256 strings
         """
 
-        stat = os.stat(path)
-        abspath = Path(path).resolve()
-
-        existing_entries = DataFile.select().where(
-            (
-                (DataFile.abspath == abspath) &
-                (DataFile.mtime == stat.st_mtime) &
-                (DataFile.size == stat.st_size)
+        with timed("stat_cache_lookup"):
+            stat = os.stat(path)
+            abspath = Path(path).resolve()
+
+            key = (str(abspath), int(stat.st_mtime), stat.st_size)
+            if key in self._sha256_memo:
+                count("stat_cache_hit")
+                return list(self._sha256_memo[key])
+
+            existing_entries = DataFile.select().where(
+                (
+                    (DataFile.abspath == abspath) &
+                    (DataFile.mtime == stat.st_mtime) &
+                    (DataFile.size == stat.st_size)
+                )
             )
-        )
 
-        sha256 = [e.sha256 for e in existing_entries]
+            sha256 = [e.sha256 for e in existing_entries]
+            if sha256:
+                # rows are only ever added, so a file with a known hash keeps it until its stat changes
+                self._sha256_memo[key] = sha256
+
+        count("stat_cache_hit" if sha256 else "stat_cache_miss")
         return sha256
 
+    def get_files_sha256(self, paths:List[str]) -> Dict[str, list]:
+        """
+        Bulk version of get_file_sha256 for many files, with a single query to the metadata DB
+
+        :param paths: Paths to existing files
+        :return: dict of each path to a list of sha256 strings
+        """
+        result = {path: [] for path in paths}
+        if not paths:
+            return result
+
+        with timed("stat_cache_lookup"):
+            dir_cache = {}
+            abspaths = {resolve_path(path, dir_cache): path for path in paths}
+            prefix = os.path.commonpath(list(abspaths))
+
+            stats = {}
+            query = DataFile.select(DataFile.abspath, DataFile.sha256, DataFile.mtime, DataFile.size) \
+                .where(DataFile.abspath.startswith(prefix)).tuples()
+            for abspath, sha256, mtime, size in query:
+                path = abspaths.get(abspath)
+                if path is None:
+                    continue
+                if path not in stats:
+                    stats[path] = os.stat(path)
+                if int(stats[path].st_mtime) == mtime and stats[path].st_size == size:
+                    result[path].append(sha256)
+
+        hits = sum(1 for sha256 in result.values() if sha256)
+        count("stat_cache_hit", hits)
+        count("stat_cache_miss", len(paths) - hits)
+        return result
+
     def copy_file_to(self, sha256:str, path:str) -> bool:
         """
         Copy the file from local cache to user's local copy.
 
-        If the file is not available locally it will return False, otherwise return True if successful
+        If the file is not available locally it will return False, otherwise return True if successful.
+        A file that is already at this version is not copied again.
 
         :param config: The project config used to get the remote if the files needs downloading
         :param sha256: The sha256 of the file we need
@@ -153,6 +328,10 @@ class LocalStorage:
         cached_path = self.hash_to_file(sha256)
         path_obj = Path(path)
 
+        if path_obj.is_file() and sha256 in self.get_file_sha256(path):
+            # already there, rewriting it would only cost I/O and change its mtime
+            return True
+
         if cached_path.exists():
             if path_obj.exists():
                 # delete the old file as we'll need to overwrite it
@@ -161,12 +340,77 @@ class LocalStorage:
                 # we might need to make some directories to pull the file...
                 path_obj.parent.mkdir(parents=True, exist_ok=True)
 
-            shutil.copyfile(str(cached_path), str(path))
+            with timed("cache_copy") as event:
+                fast_copyfile(str(cached_path), str(path))
+                self.register_file(path, sha256)
+                event["bytes"] = os.path.getsize(path)
             return True
         else:
             return False
 
 
+def resolve_path(path:str, dir_cache:Optional[dict] = None) -> str:
+    """
+    Same as `str(Path(path).resolve())`, but the resolved directories can be cached between calls,
+    which makes resolving many files in the same directories much faster
+
+    :param path: The path to resolve
+    :param dir_cache: dict to cache the resolved directories in
+    :return: The absolute path with all the symlinks resolved
+    """
+    if dir_cache is None or os.path.islink(path):
+        return str(Path(path).resolve())
+
+    dirname, basename = os.path.split(os.path.abspath(path))
+    resolved_dir = dir_cache.get(dirname)
+    if resolved_dir is None:
+        resolved_dir = dir_cache[dirname] = str(Path(dirname).resolve())
+    return os.path.join(resolved_dir, basename)
+
+
+# ioctl to share the data blocks of two files on copy-on-write filesystems (btrfs, xfs)
+FICLONE = 0x40049409
+
+
+def fast_copyfile(src:str, dst:str):
+    """
+    Copy the content of `src` into `dst` without passing the data through user space where possible.
+
+    A reflink is tried first (instant on copy-on-write filesystems), then `copy_file_range`,
+    and finally a regular copy.
+
+    :param src: Source path
+    :param dst: Destination path, overwritten if it exists
+    :return:
+    """
+    with open(src, "rb") as fsrc, open(dst, "wb") as fdst:
+        if fcntl is not None:
+            try:
+                fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+                return
+            except OSError:
+                pass
+
+        if hasattr(os, "copy_file_range"):
+            try:
+                remaining = os.fstat(fsrc.fileno()).st_size
+                while remaining > 0:
+                    copied = os.copy_file_range(fsrc.fileno(), fdst.fileno(), remaining)
+                    if copied == 0:
+                        break
+                    remaining -= copied
+                if remaining == 0:
+                    return
+            except OSError:
+                pass
+            # start over with a regular copy
+            fsrc.seek(0)
+            fdst.seek(0)
+            fdst.truncate()
+
+        shutil.copyfileobj(fsrc, fdst, BUF_SIZE * 16)
+
+
 def is_same_hard_link(filename:str, other:str):
     s1 = os.stat(filename)
     s2 = os.stat(other)
@@ -197,4 +441,38 @@ class DataFile(BaseModel):
     size = IntegerField(index=True)
 
 
+class SourceUrl(BaseModel):
+    """
+    The model stores the HTTP validators of the last download of a source URL,
+    so re-downloads can be conditional requests.
+
+    :ivar url: The source URL
+    :ivar etag: The ETag header of the last download
+    :ivar last_modified: The Last-Modified header of the last download
+    :ivar sha256: The SHA256 of the downloaded content
+    """
+    url = TextField(unique=True)
+    etag = TextField(null=True)
+    last_modified = TextField(null=True)
+    sha256 = CharField(max_length=70)
+
+
+
+class RemoteStat(BaseModel):
+    """
+    The model stores the observed performance of a remote, used to pick the fastest mirror
+
+    :ivar url: The remote URL
+    :ivar latency: Moving average of the request latency in seconds
+    :ivar throughput: Moving average of the download throughput in bytes per second
+    :ivar failures: Number of failed downloads since the last successful one
+    :ivar updated: Unix time of the last update
+    """
+    url = TextField(unique=True)
+    latency = FloatField(null=True)
+    throughput = FloatField(null=True)
+    failures = IntegerField(default=0)
+    updated = FloatField(default=0)
+
 
+METADB_TABLES = [DataFile, SourceUrl, RemoteStat]
@@ -0,0 +1,132 @@
+"""
+Output files hashed and stored in the local cache as they are written, used by `lazydata.output()`
+
+"""
+
+from typing import Callable
+import io
+import os
+import tempfile
+
+from lazydata.metrics import timed
+from lazydata.storage.hash import HashingWriter
+from lazydata.storage.local import LocalStorage
+
+
+class OutputFile(io.RawIOBase):
+    """
+    A binary file being written to the workspace, with every write also hashed and teed into a temporary
+    file in the local cache. Once closed, the cache copy is committed under its hash and the hash is recorded
+    for the workspace file, so tracking it needs neither a hashing nor a copying pass over the file.
+
+    Writes need to be sequential for this. If the writer seeks elsewhere or takes the file descriptor, the tee
+    is dropped and the file is hashed and copied by track() as usual.
+    """
+
+    def __init__(self, path:str, local:LocalStorage, on_close:Callable[[str], None]):
+        """
+        :param path: The path of the output file in the workspace
+        :param local: LocalStorage instance
+        :param on_close: Called with the path once the file is written and stored, e.g. to track it
+        """
+        super().__init__()
+        self.path = path
+        self.local = local
+        self.on_close = on_close
+
+        self.fp = open(path, "wb")
+        fd, self.tmp_name = tempfile.mkstemp(dir=str(local.tmp_path), suffix=".output")
+        self.writer = HashingWriter(os.fdopen(fd, "wb"))
+
+    def writable(self) -> bool:
+        return True
+
+    def seekable(self) -> bool:
+        return True
+
+    def write(self, data) -> int:
+        written = self.fp.write(data)
+        if self.writer is not None:
+            self.writer.write(memoryview(data)[:written])
+        return written
+
+    def tell(self) -> int:
+        return self.fp.tell()
+
+    def seek(self, offset:int, whence:int = io.SEEK_SET) -> int:
+        position = self.fp.seek(offset, whence)
+        if self.writer is not None and position != self.writer.size:
+            # e.g. a header patched at the end, the running hash is of no use anymore
+            self._drop_tee()
+        return position
+
+    def truncate(self, size=None) -> int:
+        size = self.fp.truncate(size)
+        if self.writer is not None and size != self.writer.size:
+            self._drop_tee()
+        return size
+
+    def flush(self):
+        if not self.fp.closed:
+            self.fp.flush()
+
+    def fileno(self) -> int:
+        # the writes through the descriptor can't be seen, e.g. numpy's tofile()
+        self.flush()
+        if self.writer is not None:
+            self._drop_tee()
+        return self.fp.fileno()
+
+    def _drop_tee(self):
+        self.writer.fp.close()
+        os.unlink(self.tmp_name)
+        self.writer = None
+
+    def abort(self):
+        """
+        Close the file without storing or tracking it, e.g. if writing it failed
+        """
+        if self.closed:
+            return
+        self.fp.close()
+        if self.writer is not None:
+            self._drop_tee()
+        super().close()
+
+    def close(self):
+        if self.closed:
+            return
+
+        self.fp.close()
+        if self.writer is not None:
+            self.writer.fp.close()
+            sha256 = self.writer.hexdigest()
+            with timed("cache_store", self.writer.size):
+                if self.local.hash_to_file(sha256).exists():
+                    os.unlink(self.tmp_name)
+                else:
+                    self.local.commit_temp_file(self.tmp_name, sha256)
+            self.local.register_file(self.path, sha256)
+            self.writer = None
+        super().close()
+
+        self.on_close(self.path)
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is not None:
+            # don't track a partially written output
+            self.abort()
+        else:
+            self.close()
+
+
+class TextOutputFile(io.TextIOWrapper):
+    """
+    The text mode version of OutputFile
+    """
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is not None:
+            self.buffer.abort()
+        else:
+            self.close()
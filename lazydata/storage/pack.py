@@ -0,0 +1,196 @@
+"""
+Pack files bundling many small blobs into a few large remote objects
+
+A pack is stored as two objects in the remote:
+
+- `packs/<pack_id>.pack` with the concatenated content of the blobs
+- `packs/<pack_id>.idx` with a JSON index mapping each hash to its offset and length in the pack
+
+The index is uploaded after the pack, so it also acts as the completion marker. The pack id is the
+sha256 of the pack content, which makes both objects immutable and safe to cache locally forever.
+"""
+
+from pathlib import Path, PurePosixPath
+from typing import Dict, Iterable, List, Tuple
+import hashlib
+import json
+import os
+import tempfile
+
+from lazydata.storage.hash import BUF_SIZE, HashingWriter
+from lazydata.storage.local import LocalStorage
+
+# Default size under which files are packed, used when `pack_threshold: true` is set in lazydata.yml
+DEFAULT_PACK_THRESHOLD = 1024 * 1024
+# Target size of a single pack
+PACK_SIZE = 64 * 1024 * 1024
+# Download the whole pack instead of ranges if at least this fraction of it is needed
+WHOLE_PACK_FRACTION = 0.5
+
+PACKS_PREFIX = "packs/"
+
+
+def get_pack_threshold(config) -> int:
+    """
+    Get the size under which files are packed for this project, 0 if packing is disabled
+
+    :param config: project Config instance
+    :return:
+    """
+    threshold = config.config.get("pack_threshold")
+    if threshold is True:
+        return DEFAULT_PACK_THRESHOLD
+    elif not threshold:
+        return 0
+    return int(threshold)
+
+
+def pack_key(pack_id:str) -> str:
+    return str(PurePosixPath("packs", "%s.pack" % pack_id))
+
+
+def index_key(pack_id:str) -> str:
+    return str(PurePosixPath("packs", "%s.idx" % pack_id))
+
+
+def group_into_packs(local:LocalStorage, hashes:List[str]) -> List[List[str]]:
+    """
+    Split the hashes into groups with a total size of about PACK_SIZE
+
+    :param local: LocalStorage instance holding the blobs
+    :param hashes: list of sha256 of the blobs
+    :return:
+    """
+    groups = []
+    group, group_size = [], 0
+    for sha256 in hashes:
+        size = local.hash_to_file(sha256).stat().st_size
+        if group and group_size + size > PACK_SIZE:
+            groups.append(group)
+            group, group_size = [], 0
+        group.append(sha256)
+        group_size += size
+    if group:
+        groups.append(group)
+    return groups
+
+
+def write_pack(local:LocalStorage, hashes:List[str]) -> Tuple[str, str, Dict[str, List[int]]]:
+    """
+    Write a pack with the blobs into a temporary file
+
+    :param local: LocalStorage instance holding the blobs
+    :param hashes: list of sha256 of the blobs to pack
+    :return: tuple of the temporary file path, the pack id and the index
+    """
+    index = {}
+    fd, tmp_name = tempfile.mkstemp(dir=str(local.tmp_path), suffix=".pack")
+    with os.fdopen(fd, "wb") as fp:
+        writer = HashingWriter(fp)
+        for sha256 in hashes:
+            offset = writer.size
+            with open(str(local.hash_to_file(sha256)), "rb") as blob:
+                for data in iter(lambda: blob.read(BUF_SIZE), b""):
+                    writer.write(data)
+            index[sha256] = [offset, writer.size - offset]
+
+    return tmp_name, writer.hexdigest(), index
+
+
+def encode_index(index:Dict[str, List[int]]) -> bytes:
+    return json.dumps({"version": 1, "blobs": index}, sort_keys=True).encode("utf-8")
+
+
+class PackIndex:
+    """
+    The merged index of all the packs in a remote, mapping hash to (pack_id, offset, length).
+
+    Pack indices are downloaded once and kept in `~/.lazydata/packs`.
+    """
+
+    def __init__(self, remote, local:LocalStorage):
+        """
+        :param remote: RemoteStorage instance holding the packs
+        :param local: LocalStorage instance
+        """
+        self.cache_path = Path(local.base_path, "packs")
+        self.cache_path.mkdir(exist_ok=True)
+
+        self.locations = {}
+        self.pack_sizes = {}
+        for key, size in remote.list_objects(PACKS_PREFIX):
+            if key.endswith(".pack"):
+                self.pack_sizes[PurePosixPath(key).stem] = size
+
+        for pack_id in self.pack_sizes:
+            for sha256, (offset, length) in self._load_index(remote, pack_id).items():
+                self.locations[sha256] = (pack_id, offset, length)
+
+    def _load_index(self, remote, pack_id:str) -> Dict[str, List[int]]:
+        cached = Path(self.cache_path, "%s.idx" % pack_id)
+        if cached.exists():
+            with open(str(cached), "rb") as fp:
+                data = fp.read()
+        else:
+            key = index_key(pack_id)
+            if not remote.object_exists(key):
+                # the pack is still being uploaded
+                return {}
+            data = b"".join(remote.read_object(key))
+            tmp_name = "%s.tmp" % str(cached)
+            with open(tmp_name, "wb") as fp:
+                fp.write(data)
+            os.replace(tmp_name, str(cached))
+
+        return json.loads(data.decode("utf-8"))["blobs"]
+
+    def lookup(self, sha256:str):
+        """
+        :return: (pack_id, offset, length) or None if the blob is not in any pack
+        """
+        return self.locations.get(sha256)
+
+    def group_by_pack(self, hashes:Iterable[str]) -> Dict[str, List[str]]:
+        """
+        Group the hashes that are in packs by the pack they are in
+        """
+        groups = {}
+        for sha256 in hashes:
+            location = self.locations.get(sha256)
+            if location is not None:
+                groups.setdefault(location[0], []).append(sha256)
+        return groups
+
+
+class ChunkReader:
+    """
+    Read exact byte counts from an iterable of chunks
+    """
+
+    def __init__(self, chunks:Iterable[bytes]):
+        self.chunks = iter(chunks)
+        self.buffer = b""
+        self.position = 0
+
+    def read(self, size:int) -> bytes:
+        while len(self.buffer) < size:
+            chunk = next(self.chunks, None)
+            if chunk is None:
+                break
+            self.buffer += chunk
+        data, self.buffer = self.buffer[:size], self.buffer[size:]
+        self.position += len(data)
+        return data
+
+    def iter_exact(self, size:int) -> Iterable[bytes]:
+        while size > 0:
+            data = self.read(min(size, BUF_SIZE * 16))
+            if not data:
+                raise RuntimeError("Pack ended unexpectedly.")
+            size -= len(data)
+            yield data
+
+    def skip_to(self, position:int):
+        while self.position < position:
+            if not self.read(min(position - self.position, BUF_SIZE * 16)):
+                raise RuntimeError("Pack ended unexpectedly.")
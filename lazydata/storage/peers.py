@@ -0,0 +1,295 @@
+"""
+Sharing the local caches of the nodes of a cluster over HTTP
+
+Each node runs `lazydata peer`, which serves the blobs of its local cache. With the same list of peers
+in LAZYDATA_PEERS on every node, each blob has an owner picked by rendezvous hashing: a node missing a blob
+asks its owner for it, and the owner downloads it from the remote once and serves it to all the others.
+If the owner is down, the next peer in the ranking takes its place, so the nodes still agree on who
+downloads. The blobs are verified against their hash as they are received.
+
+The peers only answer the requests carrying the shared secret in LAZYDATA_PEER_TOKEN. Without it, they only
+listen on the loopback interface.
+"""
+
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+from typing import List, Optional
+import hashlib
+import hmac
+import ipaddress
+import os
+import re
+import sys
+import threading
+import time
+
+import lazy_import
+urllib3 = lazy_import.lazy_module("urllib3")
+
+from lazydata.metrics import count, timed
+from lazydata.storage.hash import BUF_SIZE
+from lazydata.storage.local import LocalStorage
+from lazydata.storage.transfer import MAX_CONCURRENCY, CONNECT_TIMEOUT
+
+# Comma-separated `host:port` of the peers, the same on all the nodes
+PEERS_ENV_VAR = "LAZYDATA_PEERS"
+# The `host:port` of this node's own peer in the list, it downloads the blobs this node owns from the remote
+PEER_ADDRESS_ENV_VAR = "LAZYDATA_PEER_ADDRESS"
+# Shared secret of the peers, the same on all the nodes
+PEER_TOKEN_ENV_VAR = "LAZYDATA_PEER_TOKEN"
+DEFAULT_PEER_HOST = "127.0.0.1"
+DEFAULT_PEER_PORT = 7373
+
+# Number of peers asked for a blob before falling back to the remote
+PEER_ATTEMPTS = 2
+# Seconds a peer that couldn't be reached is left alone
+PEER_RETRY_AFTER = 30.0
+
+BLOB_PATH_RE = re.compile(r"^/blobs/([0-9a-f]{64})(\?fetch=1)?$")
+
+_client = None
+_client_lock = threading.Lock()
+
+
+def _normalize_address(address:str) -> str:
+    address = address.strip()
+    if ":" not in address:
+        address = "%s:%d" % (address, DEFAULT_PEER_PORT)
+    return address
+
+
+def get_peers() -> List[str]:
+    """
+    Get the peers from the environment
+
+    :return: list of `host:port`, empty if the peer cache is not used
+    """
+    peers = os.environ.get(PEERS_ENV_VAR, "")
+    return [_normalize_address(p) for p in peers.split(",") if p.strip()]
+
+
+def get_peer_token() -> Optional[str]:
+    return os.environ.get(PEER_TOKEN_ENV_VAR) or None
+
+
+def _is_loopback(host:str) -> bool:
+    if host == "localhost":
+        return True
+    try:
+        return ipaddress.ip_address(host).is_loopback
+    except ValueError:
+        return False
+
+
+def rank_peers(peers:List[str], sha256:str) -> List[str]:
+    """
+    Order the peers by their rendezvous score for a blob, the owner first.
+    Adding or removing a peer only moves the blobs it owns.
+
+    :param peers: list of `host:port`
+    :param sha256: hash of the blob
+    :return: The peers, the highest score first
+    """
+    def score(peer):
+        return hashlib.sha1((peer + "/" + sha256).encode("utf-8")).digest()
+    return sorted(peers, key=score, reverse=True)
+
+
+class PeerClient:
+    """
+    Fetches blobs from the peers over a pool of keep-alive connections
+    """
+
+    def __init__(self, peers:List[str], address:Optional[str]):
+        self.peers = peers
+        self.address = _normalize_address(address) if address else None
+        headers = {"User-Agent": "lazydata"}
+        token = get_peer_token()
+        if token is not None:
+            headers["Authorization"] = "Bearer %s" % token
+        # no read timeout: the owner might be downloading the blob from the remote before it sends anything
+        self.pool = urllib3.PoolManager(maxsize=MAX_CONCURRENCY, retries=False,
+                                        timeout=urllib3.Timeout(connect=CONNECT_TIMEOUT, read=None),
+                                        headers=headers)
+        # peer -> time it couldn't be reached
+        self.down = {}
+
+    def fetch(self, local:LocalStorage, sha256:str) -> bool:
+        """
+        Fetch a blob into the local cache from the peers
+
+        :param local: LocalStorage instance
+        :param sha256: hash of the blob
+        :return: True if a peer had it, False if it should be downloaded from the remote
+        """
+        for peer in rank_peers(self.peers, sha256)[:PEER_ATTEMPTS]:
+            down_since = self.down.get(peer)
+            if down_since is not None and time.monotonic() - down_since < PEER_RETRY_AFTER:
+                continue
+
+            if peer == self.address:
+                # we're the one downloading it for the others: our own peer shares this cache, have it download
+                # the blob so that it's not downloaded twice when a peer asks for it at the same time
+                return self.fetch_through_own_peer(local, sha256)
+
+            try:
+                with timed("peer_download") as event:
+                    response = self.pool.request("GET", "http://%s/blobs/%s?fetch=1" % (peer, sha256),
+                                                 preload_content=False)
+                    try:
+                        if response.status != 200:
+                            count("peer_miss")
+                            continue
+                        local.store_stream(response.stream(BUF_SIZE, decode_content=False), sha256=sha256,
+                                           name="%s from peer %s" % (sha256, peer))
+                    finally:
+                        response.release_conn()
+                    event["bytes"] = local.hash_to_file(sha256).stat().st_size
+            except RuntimeError:
+                # corrupted or cut short, the hash didn't match
+                count("peer_corrupted")
+                continue
+            except (urllib3.exceptions.HTTPError, OSError):
+                self.down[peer] = time.monotonic()
+                count("peer_down")
+                continue
+
+            count("peer_hit")
+            return True
+        return False
+
+    def fetch_through_own_peer(self, local:LocalStorage, sha256:str) -> bool:
+        try:
+            response = self.pool.request("HEAD", "http://%s/blobs/%s?fetch=1" % (self.address, sha256))
+        except (urllib3.exceptions.HTTPError, OSError):
+            # not running, download it ourselves
+            return False
+        return response.status == 200 and local.hash_to_file(sha256).exists()
+
+
+def fetch_from_peers(local:LocalStorage, sha256:str) -> bool:
+    """
+    Fetch a blob into the local cache from the peers, if the peer cache is used
+
+    :param local: LocalStorage instance
+    :param sha256: hash of the blob
+    :return: True if a peer had it
+    """
+    global _client
+
+    peers = get_peers()
+    if not peers:
+        return False
+
+    with _client_lock:
+        if _client is None or _client.peers != peers:
+            _client = PeerClient(peers, os.environ.get(PEER_ADDRESS_ENV_VAR))
+    return _client.fetch(local, sha256)
+
+
+class PeerServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address:tuple, config, local:LocalStorage, token:Optional[str] = None):
+        self.config = config
+        self.local = local
+        self.token = token
+        # sha256 -> lock held while it's downloaded from the remote, so it's downloaded once
+        self.fetch_locks = {}
+        self.fetch_locks_lock = threading.Lock()
+        super().__init__(address, PeerHandler)
+
+    def ensure_cached(self, sha256:str):
+        """
+        Download a blob into the local cache from the remote, if it's not already there
+        """
+        from lazydata.storage.fetch_file import fetch_to_cache
+
+        with self.fetch_locks_lock:
+            lock = self.fetch_locks.setdefault(sha256, threading.Lock())
+        try:
+            with lock:
+                if not self.local.hash_to_file(sha256).exists():
+                    fetch_to_cache(self.config, self.local, sha256, use_peers=False)
+        finally:
+            with self.fetch_locks_lock:
+                self.fetch_locks.pop(sha256, None)
+
+
+class PeerHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_HEAD(self):
+        self.send_blob(body=False)
+
+    def do_GET(self):
+        self.send_blob(body=True)
+
+    def send_blob(self, body:bool):
+        if self.server.token is not None:
+            expected = "Bearer %s" % self.server.token
+            if not hmac.compare_digest(self.headers.get("Authorization", "").encode("utf-8"),
+                                       expected.encode("utf-8")):
+                self.send_error(403)
+                return
+
+        match = BLOB_PATH_RE.match(self.path)
+        if match is None:
+            self.send_error(404)
+            return
+        sha256, fetch = match.group(1), match.group(2) is not None
+
+        path = self.server.local.hash_to_file(sha256)
+        if not path.exists() and fetch:
+            try:
+                self.server.ensure_cached(sha256)
+                count("peer_served_from_remote")
+            except Exception as e:
+                print("LAZYDATA: ERROR: Cannot download `%s` for a peer: %s" % (sha256, e))
+                self.send_error(502)
+                return
+
+        try:
+            fp = open(str(path), "rb")
+        except FileNotFoundError:
+            self.send_error(404)
+            return
+
+        with fp:
+            size = os.fstat(fp.fileno()).st_size
+            self.send_response(200)
+            self.send_header("Content-Type", "application/octet-stream")
+            self.send_header("Content-Length", str(size))
+            self.end_headers()
+            if body:
+                with timed("peer_serve", size):
+                    self.wfile.flush()
+                    self.connection.sendfile(fp)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def run_peer_server(config, local:LocalStorage, host:str, port:int):
+    """
+    Serve the local cache to the peers in the foreground
+
+    :param config: project Config instance, whose remote the blobs owned by this node are downloaded from
+    :param local: LocalStorage instance
+    :param host: address to listen on
+    :param port: port to listen on, 0 for any free port
+    :return:
+    """
+    token = get_peer_token()
+    if token is None and not _is_loopback(host):
+        raise RuntimeError("Set the same secret in the %s environment variable on all the nodes to serve the "
+                           "local cache on `%s`, anyone who can reach the port could read it otherwise."
+                           % (PEER_TOKEN_ENV_VAR, host))
+
+    server = PeerServer((host, port), config, local, token=token)
+    print("LAZYDATA: Serving the local cache to peers on %s:%d" % server.server_address[:2])
+    sys.stdout.flush()
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
@@ -2,46 +2,143 @@
 Remote storage backend implementation
 
 """
-from typing import Optional
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
 
 import lazy_import
 from pathlib import PurePosixPath, Path
+from peewee import Case
 
-import os, threading, sys
+import hashlib, os, threading, sys, tempfile, time, uuid
 
 from lazydata.config.config import Config
-from lazydata.storage.hash import calculate_file_sha256
-from lazydata.storage.local import LocalStorage
+from lazydata.metrics import count, timed
+from lazydata.storage.chunking import CHUNKS_PREFIX, MANIFESTS_PREFIX, assemble_chunks, chunk_key, decode_manifest, \
+    encode_manifest, find_reusable_chunks, get_chunk_threshold, get_chunks, manifest_key, save_chunks, \
+    CHUNK_UPLOAD_CONCURRENCY
+from lazydata.storage.compression import CompressingReader, ENCODING_METADATA_KEY, decompress_stream, \
+    get_codec, should_compress
+from lazydata.storage.downloader import get_downloader
+from lazydata.storage.hash import BUF_SIZE, calculate_file_sha256
+from lazydata.storage.local import LocalStorage, RemoteStat, fast_copyfile
+from lazydata.storage.pack import PackIndex, ChunkReader, get_pack_threshold, group_into_packs, write_pack, \
+    encode_index, pack_key, index_key, WHOLE_PACK_FRACTION
+from lazydata.storage.transfer import RangedDownload, RANGED_DOWNLOAD_THRESHOLD, MAX_CONCURRENCY, run_adaptive, \
+    AdaptiveConcurrency, call_with_retries, hedged_range_reader, hedged_stream, get_latency_tracker, CONNECT_TIMEOUT, \
+    READ_TIMEOUT
 
-from pySmartDL import SmartDL
 
 boto3 = lazy_import.lazy_module("boto3")
 botocore = lazy_import.lazy_module("botocore")
+BotoConfig = lazy_import.lazy_callable("botocore.config.Config")
+TransferConfig = lazy_import.lazy_callable("boto3.s3.transfer.TransferConfig")
 from urllib.parse import urlparse
 
 import logging
 logging.getLogger('boto3').setLevel(logging.CRITICAL)
 logging.getLogger('botocore').setLevel(logging.CRITICAL)
 
+# Size of the HTTP connection pool shared by all threads using the same remote
+MAX_POOL_CONNECTIONS = MAX_CONCURRENCY
+
+# Mirrors with stats older than this (in seconds) are probed before picking one
+PROBE_INTERVAL = 3600
+# Weight of a new sample in the moving averages of mirror latency and throughput
+STAT_SMOOTHING = 0.3
+# Download size at which the latency and the throughput of a mirror are weighed
+TYPICAL_DOWNLOAD_SIZE = 1024 * 1024
+
+# Maximum number of keys in a single bulk delete request (the S3 limit)
+DELETE_BATCH_SIZE = 1000
+
+# Per-process registry of remote backends, keyed by (remote_url, endpoint_url)
+_remotes = {}
+_remotes_lock = threading.Lock()
+
+
 class RemoteStorage:
     """
     A storage backend abstraction layer
     """
 
+    # if the backend can store object metadata, and therefore compressed blobs
+    supports_compression = False
+
+    # if slow requests are worth sending twice, see transfer.hedged_stream
+    hedge_requests = True
+
+    # index of the packs in the remote, loaded on first use
+    _pack_index = None
+    _pack_index_lock = threading.Lock()
+
+    # hashes of the chunks in the remote, loaded on first use
+    _chunk_index = None
+    _chunk_index_lock = threading.Lock()
+
     @staticmethod
-    def get_from_url(remote_url:str, endpoint_url:str):
-        if remote_url.startswith("s3://"):
-            return AWSRemoteStorage(remote_url, endpoint_url=endpoint_url)
-        else:
-            raise RuntimeError("Url `%s` is not supported as a remote storage backend" % remote_url)
+    def get_from_url(remote_url:str, endpoint_url:Optional[str] = None):
+        """
+        Get the remote backend for this URL.
+
+        Backends are created once per process and then reused, so that the clients
+        and their warm connection pools are shared by all fetches, pulls and pushes.
+
+        :param remote_url: URL of the remote storage, e.g. `s3://mybucket/myfolder`
+        :param endpoint_url: Optional custom endpoint URL for the backend
+        :return: RemoteStorage instance
+        """
+        key = (remote_url, endpoint_url)
+        with _remotes_lock:
+            remote = _remotes.get(key)
+            if remote is None:
+                if remote_url.startswith("s3://"):
+                    remote = AWSRemoteStorage(remote_url, endpoint_url=endpoint_url)
+                elif remote_url.startswith("file://"):
+                    remote = FileRemoteStorage(remote_url)
+                else:
+                    raise RuntimeError("Url `%s` is not supported as a remote storage backend" % remote_url)
+                _remotes[key] = remote
+        return remote
 
     @staticmethod
     def get_from_config(config:Config):
+        """
+        Get the remote backend of a project. If the project has mirrors, this is a MirroredRemoteStorage
+        that pushes to the primary remote and fetches from the fastest one.
+
+        :param config: project Config instance
+        :return: RemoteStorage instance
+        """
         if "remote" in config.config:
-            return RemoteStorage.get_from_url(config.config["remote"], config.config["endpoint"])
+            primary = RemoteStorage.get_from_url(config.config["remote"], config.config.get("endpoint"))
+            mirrors = RemoteStorage.get_mirrors_from_config(config)
+            if mirrors:
+                return MirroredRemoteStorage(primary, mirrors)
+            return primary
         else:
             raise RuntimeError("Remote storage backend not configured for this lazydata project.")
 
+    @staticmethod
+    def get_mirrors_from_config(config:Config) -> list:
+        """
+        Get the backends of the mirrors of a project, in the configured order
+
+        :param config: project Config instance
+        :return: list of RemoteStorage instances
+        """
+        return [RemoteStorage.get_from_url(m["url"], m.get("endpoint")) for m in config.config.get("mirrors", [])]
+
+    @staticmethod
+    def clear_registry():
+        """
+        Forget all the cached remote backends, e.g. after the credentials have changed
+
+        :return:
+        """
+        with _remotes_lock:
+            _remotes.clear()
+
 
     def check_storage_exists(self):
         """
@@ -59,18 +156,476 @@ class RemoteStorage:
         :param config:
         :return:
         """
-        raise NotImplementedError("Not implemented for this storage backend.")
 
+        # look for all hashes in the config file and upload
+        all_sha256 = list(OrderedDict.fromkeys(e["hash"] for e in config.config["files"]))
+
+        # get the filename the user would recognise
+        real_paths = {e["hash"]: e["path"] for e in config.config["files"]}
+
+        codec = get_codec(config.config.get("compression"))
+        if codec is not None and not self.supports_compression:
+            print("NOTE: Compression is not supported by the remote `%s`, files are stored uncompressed." % self.url)
+            codec = None
+
+        pack_threshold = get_pack_threshold(config)
+        if pack_threshold:
+            # a single listing instead of a request per file to find what needs uploading
+            existing = self.list_blobs(local)
+            missing = [sha256 for sha256 in all_sha256 if sha256 not in existing]
+
+            # small files are bundled into packs, the rest is uploaded as usual
+            small = [sha256 for sha256 in missing if local.hash_to_file(sha256).stat().st_size < pack_threshold]
+            small_set = set(small)
+            loose = [sha256 for sha256 in missing if sha256 not in small_set]
+            packs = group_into_packs(local, small)
+        else:
+            loose, packs = all_sha256, []
+
+        chunk_threshold = get_chunk_threshold(config)
+
+        def upload_item(item):
+            if isinstance(item, list):
+                return self.upload_pack(local, item)
+            if chunk_threshold:
+                # checked before the size, old versions in the remote might have never been pulled here
+                if not pack_threshold and self.blob_uploaded(local, item):
+                    return 0
+                if local.hash_to_file(item).stat().st_size >= chunk_threshold:
+                    return self.upload_chunked(local, item, real_paths[item], check_exists=False)
+                return self.upload_blob(local, item, real_paths[item], codec=codec, check_exists=False)
+            return self.upload_blob(local, item, real_paths[item], codec=codec, check_exists=not pack_threshold)
+
+        # the number of parallel uploads adapts to the throughput and throttling
+        stats = run_adaptive(upload_item, packs + loose)
+
+        if packs:
+            # make sure the new packs are picked up
+            self._pack_index = None
+        self._chunk_index = None
+
+        # Final newline to flush the progress indicator
+        print()
+        print(stats.summary())
+
+    def upload_blob(self, local:LocalStorage, sha256:str, real_path:str = "", codec=None, check_exists:bool = True):
+        """
+        Upload a single file from the local cache, unless it's already in the remote
+
+        :param local:
+        :param sha256:
+        :param real_path: The filename the user would recognise
+        :param codec: Compression codec to use, if any
+        :param check_exists: If False, the caller already knows the file is not in the remote
+        :return: The number of bytes read from the local cache
+        """
+        local_path = local.hash_to_file(sha256)
+        key = str(local.hash_to_remote_path(sha256))
+        success_key = "%s.completed" % key
+
+        # check if the remote location already exists
+        if not check_exists or not self.object_exists(success_key):
+            size = local_path.stat().st_size
+            with timed("upload", size):
+                progress = ProgressPercentage(str(local_path), real_path)
+                if codec is not None and should_compress(real_path):
+                    with CompressingReader(str(local_path), codec, callback=progress) as reader:
+                        self.upload_stream(reader, key, metadata={ENCODING_METADATA_KEY: codec.name})
+                else:
+                    self.upload_file(str(local_path), key, callback=progress)
+
+                # Upload the success key, to verify that the upload has completed
+                self.put_bytes(success_key, b"")
+            return size
+
+        return 0
+
+    def upload_pack(self, local:LocalStorage, hashes:List[str]):
+        """
+        Bundle files from the local cache into a pack and upload it
+
+        :param local:
+        :param hashes: sha256 of the files to bundle
+        :return: The size of the pack
+        """
+        tmp_name, pack_id, index = write_pack(local, hashes)
+        try:
+            size = os.path.getsize(tmp_name)
+            with timed("upload", size):
+                self.upload_file(tmp_name, pack_key(pack_id),
+                                 callback=ProgressPercentage(tmp_name, "pack of %d files" % len(hashes)))
+                # the index is uploaded last and marks the pack as completed
+                self.put_bytes(index_key(pack_id), encode_index(index))
+        finally:
+            os.unlink(tmp_name)
+        return size
+
+    def upload_chunked(self, local:LocalStorage, sha256:str, real_path:str = "", check_exists:bool = True):
+        """
+        Upload a big file from the local cache as content-defined chunks, skipping the chunks that are already
+        in the remote, e.g. the unchanged parts of the previous version
+
+        :param local:
+        :param sha256:
+        :param real_path: The filename the user would recognise
+        :param check_exists: If False, the caller already knows the file is not in the remote
+        :return: The number of bytes uploaded
+        """
+        key = manifest_key(sha256)
+        if check_exists and self.blob_uploaded(local, sha256):
+            return 0
+
+        chunks = get_chunks(local, sha256)
+        existing = self.chunk_index()
+
+        missing = OrderedDict()
+        offset = 0
+        for chunk_sha256, size in chunks:
+            if chunk_sha256 not in existing and chunk_sha256 not in missing:
+                missing[chunk_sha256] = (offset, size)
+            offset += size
+
+        local_path = str(local.hash_to_file(sha256))
+
+        def upload_chunk(chunk_sha256):
+            chunk_offset, size = missing[chunk_sha256]
+            with open(local_path, "rb") as fp:
+                fp.seek(chunk_offset)
+                self.put_bytes(chunk_key(chunk_sha256), fp.read(size))
+            return size
+
+        num_bytes = sum(size for _, size in missing.values())
+        with timed("upload", num_bytes):
+            # a few at a time, this already runs in one of the parallel uploads of the files
+            run_adaptive(upload_chunk, list(missing),
+                         controller=AdaptiveConcurrency(CHUNK_UPLOAD_CONCURRENCY, CHUNK_UPLOAD_CONCURRENCY))
+            # the manifest is uploaded last and marks the file as completed
+            self.put_bytes(key, encode_manifest(chunks))
+
+        count("chunk_uploaded", len(missing))
+        count("chunk_skipped", len(chunks) - len(missing))
+        print("LAZYDATA: Uploaded %d of the %d chunks of `%s` (%d of %d bytes)" %
+              (len(missing), len(chunks), real_path, num_bytes, offset))
+        return num_bytes
 
-    def download_to_local(self, config:Config, local:LocalStorage, sha256:str):
+    def blob_uploaded(self, local:LocalStorage, sha256:str) -> bool:
         """
-        Download a file with a specific SHA256 and save it into path
+        Check if a file is in the remote, stored individually or in chunks
+
+        :param local:
+        :param sha256:
+        :return:
+        """
+        return (self.object_exists(manifest_key(sha256)) or
+                self.object_exists("%s.completed" % local.hash_to_remote_path(sha256)))
+
+    def chunk_index(self) -> set:
+        """
+        Get the hashes of all the chunks in this remote
+
+        :return:
+        """
+        with self._chunk_index_lock:
+            if self._chunk_index is None:
+                self._chunk_index = {PurePosixPath(key).name for key, _ in self.list_objects(CHUNKS_PREFIX)}
+            return self._chunk_index
+
+    def pack_index(self, local:LocalStorage) -> PackIndex:
+        """
+        Get the index of all the packs in this remote
+
+        :param local:
+        :return:
+        """
+        with self._pack_index_lock:
+            if self._pack_index is None:
+                self._pack_index = PackIndex(self, local)
+            return self._pack_index
+
+    def list_blobs(self, local:LocalStorage) -> set:
+        """
+        Get the sha256 of all the files in the remote, stored individually, in packs or in chunks
+
+        :param local:
+        :return:
+        """
+        existing = set(self.pack_index(local).locations)
+        for key, _ in self.list_objects(MANIFESTS_PREFIX):
+            existing.add(PurePosixPath(key).stem)
+        for key, _ in self.list_objects("data/"):
+            if key.endswith(".completed"):
+                parts = PurePosixPath(key[:-len(".completed")]).parts
+                existing.add(parts[-2] + parts[-1])
+        return existing
+
+    def collect_garbage(self, local:LocalStorage, live:set, dry_run:bool = False) -> dict:
+        """
+        Delete the files in the remote that are not in the live set.
+
+        Completion markers are deleted before the files, so an interrupted run never leaves a file marked as
+        complete without its content. Packs are deleted only if none of the files in them are live, and chunks
+        only if none of the live chunked files contain them.
+
+        :param local:
+        :param live: sha256 of all the files to keep
+        :param dry_run: Only report what would be deleted
+        :return: dict with the number of `files`, `objects` and `bytes` that are (or would be) deleted,
+                 and the number of packs kept for some of their files (`partial_packs`)
+        """
+        markers, blobs, dead = [], [], set()
+        num_bytes = 0
+        for key, size in self.list_objects("data/"):
+            is_marker = key.endswith(".completed")
+            parts = PurePosixPath(key[:-len(".completed")] if is_marker else key).parts
+            sha256 = parts[-2] + parts[-1]
+            if sha256 in live:
+                continue
+            dead.add(sha256)
+            num_bytes += size
+            (markers if is_marker else blobs).append(key)
+
+        index = self.pack_index(local)
+        pack_hashes = {}
+        for sha256, (pack_id, _, _) in index.locations.items():
+            pack_hashes.setdefault(pack_id, []).append(sha256)
+        partial_packs = 0
+        for pack_id, hashes in pack_hashes.items():
+            num_live = sum(1 for sha256 in hashes if sha256 in live)
+            if num_live:
+                if num_live < len(hashes):
+                    partial_packs += 1
+                continue
+            dead.update(hashes)
+            num_bytes += index.pack_sizes[pack_id]
+            # the index marks the pack as complete
+            markers.append(index_key(pack_id))
+            blobs.append(pack_key(pack_id))
+
+        live_chunks = set()
+        for key, size in self.list_objects(MANIFESTS_PREFIX):
+            sha256 = PurePosixPath(key).stem
+            if sha256 in live:
+                live_chunks.update(chunk_sha256 for chunk_sha256, _ in decode_manifest(b"".join(self.read_object(key))))
+            else:
+                dead.add(sha256)
+                num_bytes += size
+                # the manifest marks the file as complete
+                markers.append(key)
+        for key, size in self.list_objects(CHUNKS_PREFIX):
+            if PurePosixPath(key).name not in live_chunks:
+                num_bytes += size
+                blobs.append(key)
+
+        if not dry_run:
+            for keys in (markers, blobs):
+                batches = [keys[i:i + DELETE_BATCH_SIZE] for i in range(0, len(keys), DELETE_BATCH_SIZE)]
+                run_adaptive(self.delete_objects, batches)
+            self._pack_index = None
+            self._chunk_index = None
+
+        return {"files": len(dead), "objects": len(markers) + len(blobs), "bytes": num_bytes,
+                "partial_packs": partial_packs}
+
+    def download_to_local(self, config:Config, local:LocalStorage, sha256:str, **kwargs):
+        """
+        Download a file with a specific SHA256 into the local cache
 
         :param config: Config
         :param local:
         :param sha256:
+        :return: The sha256 of the downloaded file
+        """
+
+        # file no longer in config? this shouldn't happen but don't fail.
+        real_path = config.path(sha256=sha256) or ""
+
+        print("Downloading `%s`" % real_path)
+
+        with timed("download") as event:
+            location = self.pack_index(local).lookup(sha256) if get_pack_threshold(config) else None
+            if location is not None:
+                # a single ranged read from the pack
+                pack_id, offset, length = location
+                chunks = self.range_fetcher(pack_key(pack_id), offset)(0, length - 1) if length else []
+                downloaded_sha256 = local.store_stream(chunks, sha256=sha256, name=real_path)
+            elif get_chunk_threshold(config) and self.object_exists(manifest_key(sha256)):
+                downloaded_sha256 = self.download_chunked(config, local, sha256, real_path)
+            else:
+                downloaded_sha256 = self.download_blob(local, sha256, real_path)
+            event["bytes"] = local.hash_to_file(downloaded_sha256).stat().st_size
+
+        return downloaded_sha256
+
+    def download_chunked(self, config:Config, local:LocalStorage, sha256:str, real_path:str = "") -> str:
+        """
+        Download a chunked file into the local cache, reusing the chunks of its other versions in the local cache
+
+        :param config: Config
+        :param local:
+        :param sha256:
+        :param real_path: The filename the user would recognise
+        :return: The sha256 of the downloaded file
+        """
+        chunks = decode_manifest(b"".join(self.read_object(manifest_key(sha256))))
+
+        others = [e["hash"] for e in config.config["files"] if e["path"] == real_path and e["hash"] != sha256]
+        reusable = find_reusable_chunks(local, others)
+
+        def read_chunk(chunk_sha256):
+            data = b"".join(self.read_object_hedged(chunk_key(chunk_sha256)))
+            if hashlib.sha256(data).hexdigest() != chunk_sha256:
+                raise RuntimeError("Hash for a chunk of the downloaded file `%s` is incorrect. "
+                                   "File might be corrupted in the remote storage backend." % real_path)
+            return data
+
+        downloaded_sha256 = local.store_stream(
+            assemble_chunks(chunks, reusable, lambda chunk_sha256: call_with_retries(read_chunk, chunk_sha256)),
+            sha256=sha256, name=real_path)
+        save_chunks(local, sha256, chunks)
+        return downloaded_sha256
+
+    def download_packs(self, local:LocalStorage, hashes:List[str]):
+        """
+        Download whole packs where most of their files are needed, instead of reading them one by one
+
+        :param local:
+        :param hashes: sha256 of the files needed
         :return:
         """
+        index = self.pack_index(local)
+        groups = index.group_by_pack(hashes)
+
+        whole = []
+        for pack_id, group in groups.items():
+            needed_bytes = sum(index.lookup(sha256)[2] for sha256 in group)
+            if needed_bytes >= WHOLE_PACK_FRACTION * index.pack_sizes[pack_id]:
+                whole.append(pack_id)
+
+        def download_pack(pack_id):
+            print("Downloading pack of %d files" % len(groups[pack_id]))
+            with timed("download", index.pack_sizes[pack_id]):
+                reader = ChunkReader(self.read_object(pack_key(pack_id)))
+                for sha256 in sorted(groups[pack_id], key=lambda sha256: index.lookup(sha256)[1]):
+                    _, offset, length = index.lookup(sha256)
+                    reader.skip_to(offset)
+                    local.store_stream(reader.iter_exact(length), sha256=sha256)
+            return index.pack_sizes[pack_id]
+
+        run_adaptive(download_pack, whole)
+
+    def range_reader(self, config:Config, local:LocalStorage, sha256:str):
+        """
+        Get random access to a file in the remote without downloading all of it
+
+        :param config: Config
+        :param local:
+        :param sha256:
+        :return: tuple of the file size and a function returning the bytes between `start` and `end` (inclusive),
+                 or None if the file can only be read whole (e.g. it's compressed)
+        """
+        if get_pack_threshold(config):
+            location = self.pack_index(local).lookup(sha256)
+            if location is not None:
+                pack_id, offset, length = location
+                return length, self.range_fetcher(pack_key(pack_id), offset)
+
+        if get_chunk_threshold(config) and self.object_exists(manifest_key(sha256)):
+            # the chunks are downloaded whole
+            return None
+
+        key = str(local.hash_to_remote_path(sha256))
+        size, metadata = self.object_info(key)
+        if metadata.get(ENCODING_METADATA_KEY) is not None:
+            return None
+        return size, self.range_fetcher(key)
+
+    def download_blob(self, local:LocalStorage, sha256:str, real_path:str = "") -> str:
+        """
+        Download a file stored individually in the remote into the local cache
+
+        :param local:
+        :param sha256:
+        :param real_path: The filename the user would recognise
+        :return: The sha256 of the downloaded file
+        """
+        key = str(local.hash_to_remote_path(sha256))
+
+        size, metadata = self.object_info(key)
+
+        encoding = metadata.get(ENCODING_METADATA_KEY)
+        if encoding is not None:
+            # compressed blobs are decompressed on the fly, the hash is of the uncompressed content
+            return local.store_stream(decompress_stream(self.read_object_hedged(key), encoding), sha256=sha256,
+                                      name=real_path)
+
+        if size >= RANGED_DOWNLOAD_THRESHOLD:
+            # big files are downloaded in parallel parts that survive an interrupted download
+            return RangedDownload(local, sha256, size, self.range_fetcher(key), name=real_path).run()
+
+        # stream the object into the cache, verifying the hash on the way
+        return local.store_stream(self.read_object_hedged(key), sha256=sha256, name=real_path)
+
+    def range_fetcher(self, key:str, offset:int = 0) -> Callable[[int, int], Iterable[bytes]]:
+        """
+        Get a function reading byte ranges of an object, with straggling reads hedged
+
+        :param key:
+        :param offset: Offset of the ranges in the object, e.g. of a file in a pack
+        :return: Function returning the bytes between `start` and `end` (inclusive)
+        """
+        fetch_range = lambda start, end: self.read_range(key, offset + start, offset + end)
+        if not self.hedge_requests:
+            return fetch_range
+        return hedged_range_reader(fetch_range, self.url)
+
+    def read_object_hedged(self, key:str) -> Iterable[bytes]:
+        if not self.hedge_requests:
+            return self.read_object(key)
+        return hedged_stream(lambda: self.read_object(key), get_latency_tracker(self.url))
+
+    # Low-level object operations implemented by each backend.
+    # Keys are posix paths relative to the root of the remote, e.g. `data/xx/xxxx`.
+
+    def object_exists(self, key:str) -> bool:
+        raise NotImplementedError("Not implemented for this storage backend.")
+
+    def list_objects(self, prefix:str) -> Iterable[Tuple[str, int]]:
+        """
+        List the keys and sizes of all the objects with the prefix
+        """
+        raise NotImplementedError("Not implemented for this storage backend.")
+
+    def object_info(self, key:str) -> Tuple[int, Dict[str, str]]:
+        """
+        Get the size and the metadata of an object
+        """
+        raise NotImplementedError("Not implemented for this storage backend.")
+
+    def read_object(self, key:str) -> Iterable[bytes]:
+        raise NotImplementedError("Not implemented for this storage backend.")
+
+    def read_range(self, key:str, start:int, end:int) -> Iterable[bytes]:
+        """
+        Read the bytes of an object between `start` and `end` (inclusive)
+        """
+        raise NotImplementedError("Not implemented for this storage backend.")
+
+    def upload_file(self, local_path:str, key:str, callback:Optional[Callable[[int], None]] = None):
+        raise NotImplementedError("Not implemented for this storage backend.")
+
+    def upload_stream(self, fileobj, key:str, metadata:Dict[str, str]):
+        """
+        Upload the content of a readable file-like object, storing the metadata with the object
+        """
+        raise NotImplementedError("Not implemented for this storage backend.")
+
+    def put_bytes(self, key:str, data:bytes):
+        raise NotImplementedError("Not implemented for this storage backend.")
+
+    def delete_objects(self, keys:List[str]):
+        """
+        Delete up to DELETE_BATCH_SIZE objects, ignoring the ones that don't exist
+        """
         raise NotImplementedError("Not implemented for this storage backend.")
 
 
@@ -90,7 +645,6 @@ class UrlRemoteStorage:
     def download_to_local(config: Config, local: LocalStorage, sha256: Optional[str] = None,
                           source_url: Optional[str] = None, path: Optional[str] = None):
         if sha256 is not None:
-            local_path = local.hash_to_file(sha256)
             source_url = config.source_url(sha256=sha256)
             if source_url is None:
                 raise RuntimeError("Cannot find source_url for file with hash `%s`. "
@@ -104,25 +658,48 @@ class UrlRemoteStorage:
                 path = config.path(source_url=source_url)
                 if path is None:
                     raise RuntimeError("Cannot find path for downloading a file.")
-            local_path = Path(path)
         else:
             raise RuntimeError("Cannot download a file without sha256 and source_url specified.")
 
-        local_path.parent.mkdir(parents=True, exist_ok=True)
-
-        f = SmartDL(urls=source_url, dest=str(local_path), progress_bar=False)
         print("Downloading `%s`" % path)
-        f.start()
-        # make sure the sha256 of the just downloaded file is correct
-        downloaded_sha256 = calculate_file_sha256(str(local_path))
-        if sha256 is not None and sha256 != downloaded_sha256:
-            raise RuntimeError("Hash for the downloaded file `%s` is incorrect. "
-                               "File might be corrupted in the remote storage backend." % str(local_path))
-        local.store_file(path=path)
+
+        downloader = get_downloader()
+        with timed("download") as event:
+            size, accepts_ranges = 0, False
+            if sha256 is not None:
+                # big files from servers that support byte ranges are downloaded in parallel parts
+                size, accepts_ranges = downloader.probe(source_url)
+            if accepts_ranges and size >= RANGED_DOWNLOAD_THRESHOLD:
+                fetch_range = hedged_range_reader(lambda start, end: downloader.fetch_range(source_url, start, end),
+                                                  urlparse(source_url).netloc)
+                downloaded_sha256 = RangedDownload(local, sha256, size, fetch_range, name=path).run()
+            else:
+                downloaded_sha256 = downloader.download(local, source_url, sha256=sha256, name=path)
+            event["bytes"] = local.hash_to_file(downloaded_sha256).stat().st_size
+
+        return downloaded_sha256
+
+    @staticmethod
+    def range_reader(config: Config, local: LocalStorage, sha256: str):
+        """
+        Get random access to a file at its source URL, if the server supports byte ranges
+
+        :return: tuple of the file size and a function returning the bytes between `start` and `end` (inclusive),
+                 or None if the file can only be read whole
+        """
+        source_url = config.source_url(sha256=sha256)
+        downloader = get_downloader()
+        size, accepts_ranges = downloader.probe(source_url)
+        if not accepts_ranges or not size:
+            return None
+        return size, hedged_range_reader(lambda start, end: downloader.fetch_range(source_url, start, end),
+                                         urlparse(source_url).netloc)
 
 
 class AWSRemoteStorage(RemoteStorage):
 
+    supports_compression = True
+
     def __init__(self, remote_url, endpoint_url=None):
         if not remote_url.startswith("s3://"):
             raise RuntimeError("AWSRemoteStorage URL needs to start with s3://")
@@ -134,14 +711,24 @@ class AWSRemoteStorage(RemoteStorage):
         self.path_prefix = p.path.strip()
         if self.path_prefix.startswith("/"):
             self.path_prefix = self.path_prefix[1:]
-        # get the reusable clients and resources
-        self.s3 = boto3.resource('s3', endpoint_url=endpoint_url)
-        self.client = boto3.client('s3', endpoint_url=endpoint_url)
+        self.endpoint_url = endpoint_url
+
+        # get the reusable client and transfer manager. The low-level client is thread-safe,
+        # so a single one (with a single connection pool) is shared by all the threads.
+        session = boto3.session.Session()
+        # Throttling and connection errors are retried by our transfer layer, which adjusts the concurrency,
+        # so every request below goes through call_with_retries()
+        self.client = session.client('s3', endpoint_url=endpoint_url,
+                                     config=BotoConfig(max_pool_connections=MAX_POOL_CONNECTIONS,
+                                                       connect_timeout=CONNECT_TIMEOUT, read_timeout=READ_TIMEOUT,
+                                                       retries={"mode": "standard", "total_max_attempts": 1}))
+        self.transfer_config = TransferConfig(max_concurrency=MAX_POOL_CONNECTIONS // 4)
+        self.transfer = boto3.s3.transfer.S3Transfer(self.client, config=self.transfer_config)
 
     def check_storage_exists(self):
         exists = True
         try:
-            self.s3.meta.client.head_bucket(Bucket=self.bucket_name)
+            call_with_retries(self.client.head_bucket, Bucket=self.bucket_name)
         except botocore.exceptions.ClientError as e:
             # If a client error is thrown, then check that it was a 404 error.
             # If it was a 404 error, then the bucket does not exist.
@@ -151,76 +738,335 @@ class AWSRemoteStorage(RemoteStorage):
 
         return exists
 
-    def upload(self, local: LocalStorage, config: Config):
-        transfer = boto3.s3.transfer.S3Transfer(self.client)
+    def download_to_local(self, config:Config, local: LocalStorage, sha256: str, **kwargs):
+        try:
+            return super().download_to_local(config, local, sha256, **kwargs)
+        except botocore.exceptions.NoCredentialsError:
+            raise RuntimeError("Download failed. AWS credentials not found. Run `lazydata config aws` to configure them.")
 
-        # look for all hashes in the config file and upload
-        all_sha256 = [e["hash"] for e in config.config["files"]]
-
-        for sha256 in all_sha256:
-            local_path = local.hash_to_file(sha256)
-            remote_path = local.hash_to_remote_path(sha256)
-            s3_key = str(PurePosixPath(self.path_prefix, remote_path))
-            s3_success_key = "%s.completed" % s3_key
-
-            # get the filename the user would recognise
-            real_path = [e["path"] for e in config.config["files"] if e["hash"] == sha256]
-            if len(real_path) > 0:
-                real_path = real_path[-1]
+    def s3_key(self, key:str) -> str:
+        return str(PurePosixPath(self.path_prefix, key))
+
+    def list_objects(self, prefix:str):
+        s3_prefix = self.s3_key(prefix) + ("/" if prefix.endswith("/") else "")
+        params = {"Bucket": self.bucket_name, "Prefix": s3_prefix}
+        while True:
+            # page by page, so that a failed request doesn't start the listing over
+            page = call_with_retries(self.client.list_objects_v2, **params)
+            for obj in page.get("Contents", []):
+                yield str(PurePosixPath(prefix, obj["Key"][len(s3_prefix):])), obj["Size"]
+            if not page.get("IsTruncated"):
+                break
+            params["ContinuationToken"] = page["NextContinuationToken"]
+
+    def object_exists(self, key:str) -> bool:
+        exists = True
+        try:
+            call_with_retries(self.client.head_object, Bucket=self.bucket_name, Key=self.s3_key(key))
+        except botocore.exceptions.ClientError as e:
+            if e.response['Error']['Code'] in ("404", "NoSuchKey"):
+                exists = False
             else:
-                # file no longer in config? this shouldn't happen but don't fail.
-                real_path = ""
+                raise
+        return exists
 
-            # check if the remote location already exists
-            exists = True
-            try:
-                self.client.head_object(Bucket=self.bucket_name, Key=s3_success_key)
-            except botocore.exceptions.ClientError as e:
-                error_code = int(e.response['Error']['Code'])
-                if error_code == 404:
-                    exists = False
-
-            if not exists:
-                transfer.upload_file(str(local_path),
-                                     self.bucket_name,
-                                     s3_key,
-                                     callback=S3ProgressPercentage(str(local_path), real_path))
+    def object_info(self, key:str):
+        response = call_with_retries(self.client.head_object, Bucket=self.bucket_name, Key=self.s3_key(key))
+        return response["ContentLength"], response.get("Metadata", {})
 
-                # Upload the success key, to verify that the upload has completed
-                self.s3.Bucket(self.bucket_name).put_object(Key=s3_success_key, Body="")
-        # Final newline to flush the progress indicator
-        print()
+    def read_object(self, key:str):
+        response = call_with_retries(self.client.get_object, Bucket=self.bucket_name, Key=self.s3_key(key))
+        yield from response["Body"].iter_chunks(BUF_SIZE)
 
-    def download_to_local(self, config:Config, local: LocalStorage, sha256: str, **kwargs):
+    def read_range(self, key:str, start:int, end:int):
+        response = call_with_retries(self.client.get_object, Bucket=self.bucket_name, Key=self.s3_key(key),
+                                     Range="bytes=%d-%d" % (start, end))
+        yield from response["Body"].iter_chunks(BUF_SIZE)
+
+    def upload_file(self, local_path:str, key:str, callback:Optional[Callable[[int], None]] = None):
+        self.transfer.upload_file(local_path, self.bucket_name, self.s3_key(key), callback=callback)
+
+    def upload_stream(self, fileobj, key:str, metadata:Dict[str, str]):
+        self.client.upload_fileobj(fileobj, self.bucket_name, self.s3_key(key),
+                                   ExtraArgs={"Metadata": metadata}, Config=self.transfer_config)
+
+    def put_bytes(self, key:str, data:bytes):
+        call_with_retries(self.client.put_object, Bucket=self.bucket_name, Key=self.s3_key(key), Body=data)
+
+    def delete_objects(self, keys:List[str]):
+        response = call_with_retries(self.client.delete_objects, Bucket=self.bucket_name,
+                                     Delete={"Objects": [{"Key": self.s3_key(key)} for key in keys], "Quiet": True})
+        errors = response.get("Errors", [])
+        if errors:
+            raise RuntimeError("Failed to delete %d objects from the remote, e.g. `%s`: %s" %
+                               (len(errors), errors[0]["Key"], errors[0].get("Message", errors[0].get("Code"))))
+
+
+class FileRemoteStorage(RemoteStorage):
+    """
+    A remote on a (shared) filesystem, e.g. `file:///mnt/shared/lazydata`.
+
+    It uses the same layout as the other remotes. Files are copied with reflinks or in-kernel
+    copies where the filesystem supports it, and always written to a temporary file first and then
+    atomically renamed, so readers never see a partially written file.
+    """
+
+    # reads from a filesystem don't straggle like network requests
+    hedge_requests = False
+
+    def __init__(self, remote_url):
+        if not remote_url.startswith("file://"):
+            raise RuntimeError("FileRemoteStorage URL needs to start with file://")
+
+        self.url = remote_url
+        self.root = Path(remote_url[len("file://"):])
+
+    def check_storage_exists(self):
+        return self.root.is_dir()
+
+    def download_blob(self, local:LocalStorage, sha256:str, real_path:str = ""):
+        path = self.object_path(str(local.hash_to_remote_path(sha256)))
+
+        fd, tmp_name = tempfile.mkstemp(dir=str(local.tmp_path), suffix=".download")
+        os.close(fd)
         try:
-            transfer = boto3.s3.transfer.S3Transfer(self.client)
+            fast_copyfile(str(path), tmp_name)
+            if calculate_file_sha256(tmp_name) != sha256:
+                raise RuntimeError("Hash for the downloaded file `%s` is incorrect. "
+                                   "File might be corrupted in the remote storage backend." % real_path)
+            local.commit_temp_file(tmp_name, sha256)
+        finally:
+            if os.path.exists(tmp_name):
+                os.unlink(tmp_name)
+
+        return sha256
+
+    def object_path(self, key:str) -> Path:
+        return Path(self.root, *PurePosixPath(key).parts)
 
-            local_path = local.hash_to_file(sha256)
-            remote_path = local.hash_to_remote_path(sha256)
-            s3_key = str(PurePosixPath(self.path_prefix, remote_path))
+    def object_exists(self, key:str) -> bool:
+        return self.object_path(key).exists()
 
-            local_path.parent.mkdir(parents=True, exist_ok=True)
+    def list_objects(self, prefix:str):
+        for dirpath, _, filenames in os.walk(str(self.object_path(prefix))):
+            for filename in filenames:
+                # skip files that are still being written
+                if filename.endswith(".tmp"):
+                    continue
+                path = Path(dirpath, filename)
+                yield path.relative_to(self.root).as_posix(), path.stat().st_size
 
-            real_path = [e["path"] for e in config.config["files"] if e["hash"] == sha256]
-            if len(real_path) > 0:
-                real_path = real_path[-1]
+    def object_info(self, key:str):
+        return self.object_path(key).stat().st_size, {}
+
+    def read_object(self, key:str):
+        with open(str(self.object_path(key)), "rb") as fp:
+            yield from iter(lambda: fp.read(BUF_SIZE), b"")
+
+    def read_range(self, key:str, start:int, end:int):
+        with open(str(self.object_path(key)), "rb") as fp:
+            fp.seek(start)
+            remaining = end - start + 1
+            while remaining > 0:
+                data = fp.read(min(BUF_SIZE, remaining))
+                if not data:
+                    break
+                remaining -= len(data)
+                yield data
+
+    def upload_file(self, local_path:str, key:str, callback:Optional[Callable[[int], None]] = None):
+        path = self.object_path(key)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_name = "%s.%s.tmp" % (str(path), uuid.uuid4().hex)
+        try:
+            fast_copyfile(local_path, tmp_name)
+            os.replace(tmp_name, str(path))
+        finally:
+            if os.path.exists(tmp_name):
+                os.unlink(tmp_name)
+
+        if callback is not None:
+            callback(os.path.getsize(str(path)))
+
+    def put_bytes(self, key:str, data:bytes):
+        path = self.object_path(key)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_name = "%s.%s.tmp" % (str(path), uuid.uuid4().hex)
+        with open(tmp_name, "wb") as fp:
+            fp.write(data)
+        os.replace(tmp_name, str(path))
+
+    def delete_objects(self, keys:List[str]):
+        for key in keys:
+            try:
+                self.object_path(key).unlink()
+            except FileNotFoundError:
+                pass
+
+
+class MirroredRemoteStorage(RemoteStorage):
+    """
+    A primary remote with an ordered list of mirrors.
+
+    Pushes go to the primary. Fetches go to the remote expected to be the fastest, based on the latency
+    and throughput observed so far (stored in the metadb), and fall back to the others on failure.
+    Remotes without recent stats are probed in parallel first.
+    """
+
+    # URLs of the remotes probed by this process
+    _probed = set()
+
+    def __init__(self, primary:RemoteStorage, mirrors:List[RemoteStorage]):
+        self.primary = primary
+        self.mirrors = mirrors
+        self.remotes = [primary] + mirrors
+        self.url = primary.url
+        self.supports_compression = primary.supports_compression
+
+    def check_storage_exists(self):
+        return self.primary.check_storage_exists()
+
+    def upload(self, local:LocalStorage, config:Config):
+        self.primary.upload(local, config)
+
+    def list_blobs(self, local:LocalStorage) -> set:
+        return self.primary.list_blobs(local)
+
+    def collect_garbage(self, local:LocalStorage, live:set, dry_run:bool = False) -> dict:
+        return self.primary.collect_garbage(local, live, dry_run=dry_run)
+
+    def download_to_local(self, config:Config, local:LocalStorage, sha256:str, **kwargs):
+        return self._with_fallback(self.ranked(local, sha256),
+                                   lambda remote: remote.download_to_local(config, local, sha256, **kwargs),
+                                   lambda: local.hash_to_file(sha256).stat().st_size)
+
+    def range_reader(self, config:Config, local:LocalStorage, sha256:str):
+        return self._with_fallback(self.ranked(local, sha256),
+                                   lambda remote: remote.range_reader(config, local, sha256))
+
+    def download_packs(self, local:LocalStorage, hashes:List[str]):
+        # packs are not necessarily the same in all the remotes, so we stick to one
+        self._with_fallback(self.ranked(local), lambda remote: remote.download_packs(local, hashes))
+
+    def _with_fallback(self, remotes:List[RemoteStorage], fn:Callable, size_fn:Optional[Callable] = None):
+        last_error = None
+        for remote in remotes:
+            start = time.monotonic()
+            try:
+                result = fn(remote)
+            except Exception as e:
+                print("LAZYDATA: Remote `%s` failed (%s), trying the next one..." % (remote.url, str(e)))
+                record_remote_stat(remote.url, failed=True)
+                last_error = e
+                continue
+
+            if size_fn is not None:
+                elapsed = max(time.monotonic() - start, 1e-6)
+                record_remote_stat(remote.url, throughput=size_fn() / elapsed)
+            return result
+
+        raise last_error
+
+    def ranked(self, local:LocalStorage, sha256:Optional[str] = None) -> List[RemoteStorage]:
+        """
+        Order the remotes by their expected download time, probing the ones we don't know enough about
+
+        :param local:
+        :param sha256: The file about to be downloaded, used for probing
+        :return: list of RemoteStorage
+        """
+        now = time.time()
+        stats = self._load_stats()
+        stale = [r for r in self.remotes
+                 if r.url not in self._probed and (r.url not in stats or now - stats[r.url].updated > PROBE_INTERVAL)]
+        missing = set()
+        if stale:
+            missing = self.probe(local, sha256, stale)
+            stats = self._load_stats()
+
+        def expected_time(remote):
+            stat = stats.get(remote.url)
+            if stat is None or stat.latency is None:
+                return float("inf")
+            time_estimate = stat.latency
+            if stat.throughput:
+                time_estimate += TYPICAL_DOWNLOAD_SIZE / stat.throughput
+            return time_estimate * (1 + stat.failures)
+
+        # sort is stable, so remotes we know nothing about stay in the configured order
+        return sorted(self.remotes, key=lambda r: (r.url in missing, expected_time(r)))
+
+    def probe(self, local:LocalStorage, sha256:Optional[str], remotes:List[RemoteStorage]) -> set:
+        """
+        Time a small request to each of the remotes in parallel
+
+        :param local:
+        :param sha256: If given, the probe checks if the remote has this file
+        :param remotes: The remotes to probe
+        :return: The URLs of the remotes that don't have the file
+        """
+        key = "%s.completed" % local.hash_to_remote_path(sha256) if sha256 is not None else "data/"
+
+        def probe_one(remote):
+            start = time.monotonic()
+            try:
+                exists = remote.object_exists(key)
+            except Exception:
+                return remote.url, False, None
+            return remote.url, exists, time.monotonic() - start
+
+        with ThreadPoolExecutor(max_workers=len(remotes)) as executor:
+            results = list(executor.map(probe_one, remotes))
+
+        # recorded from this thread once all the probes are done
+        for url, _, latency in results:
+            if latency is None:
+                record_remote_stat(url, failed=True)
             else:
-                # file no longer in config? this shouldn't happen but don't fail.
-                real_path = ""
+                record_remote_stat(url, latency=latency)
+        self._probed.update(r.url for r in remotes)
 
-            print("Downloading `%s`" % real_path)
+        missing = {url for url, exists, _ in results if not exists}
+        if sha256 is None or len(missing) == len(results):
+            # the file might be in a pack, so it's not evidence of the file missing
+            return set()
+        return missing
 
-            transfer.download_file(self.bucket_name, s3_key, str(local_path))
+    def _load_stats(self) -> dict:
+        urls = [r.url for r in self.remotes]
+        return {s.url: s for s in RemoteStat.select().where(RemoteStat.url.in_(urls))}
 
-            # make sure the sha256 of the just downloaded file is correct
-            downloaded_sha256 = calculate_file_sha256(str(local_path))
-            if sha256 != downloaded_sha256:
-                raise RuntimeError("Hash for the downloaded file `%s` is incorrect. File might be corrupted in the remote storage backend." % str(local_path))
-        except botocore.exceptions.NoCredentialsError:
-            raise RuntimeError("Download failed. AWS credentials not found. Run `lazydata config aws` to configure them.")
+
+def record_remote_stat(url:str, latency:Optional[float] = None, throughput:Optional[float] = None,
+                       failed:bool = False):
+    """
+    Update the moving averages of the performance of a remote
+
+    :param url: The remote URL
+    :param latency: A new latency sample in seconds
+    :param throughput: A new throughput sample in bytes per second
+    :param failed: If a request to the remote failed
+    :return:
+    """
+    # computed by a single UPDATE, so that concurrent samples from other threads and processes aren't lost
+    updates = {
+        RemoteStat.failures: RemoteStat.failures + 1 if failed else 0,
+        RemoteStat.updated: time.time(),
+    }
+    if latency is not None:
+        updates[RemoteStat.latency] = Case(None, [(RemoteStat.latency.is_null(), latency)],
+                                           (1 - STAT_SMOOTHING) * RemoteStat.latency + STAT_SMOOTHING * latency)
+    if throughput is not None:
+        updates[RemoteStat.throughput] = Case(None, [(RemoteStat.throughput.is_null(), throughput)],
+                                              (1 - STAT_SMOOTHING) * RemoteStat.throughput +
+                                              STAT_SMOOTHING * throughput)
+
+    with RemoteStat._meta.database.atomic():
+        RemoteStat.insert(url=url).on_conflict_ignore().execute()
+        RemoteStat.update(updates).where(RemoteStat.url == url).execute()
 
 
-class S3ProgressPercentage:
+class ProgressPercentage:
     def __init__(self, filename, real_filename):
         self._filename = filename
         self._size = float(os.path.getsize(filename))
@@ -231,7 +1077,8 @@ class S3ProgressPercentage:
     def __call__(self, bytes_amount):
         with self._lock:
             self._seen_so_far += bytes_amount
-            percentage = (self._seen_so_far / self._size) * 100
+            # an empty file is done as soon as it's there
+            percentage = (self._seen_so_far / self._size) * 100 if self._size else 100.0
             sys.stdout.write(
                 "\r Uploading `%s`  %s / %s  (%.2f%%)" % (
                     self._real_filename, self._seen_so_far, self._size,
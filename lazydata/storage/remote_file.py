@@ -0,0 +1,248 @@
+"""
+Random access to tracked files without downloading them whole
+
+"""
+
+from pathlib import Path
+from typing import Callable, Iterable
+import io
+import json
+import os
+import threading
+
+from lazydata.config.config import Config
+from lazydata.metrics import timed
+from lazydata.storage.fetch_file import fetch_to_cache, wait_for_prefetch
+from lazydata.storage.hash import calculate_file_sha256
+from lazydata.storage.local import LocalStorage
+from lazydata.storage.remote import RemoteStorage, UrlRemoteStorage
+from lazydata.storage.transfer import call_with_retries
+
+# Granularity of the ranged reads and of the local block cache
+BLOCK_SIZE = 1024 * 1024
+# Maximum number of blocks read ahead when the file is read sequentially
+MAX_READAHEAD_BLOCKS = 16
+
+
+def open_remote_file(config:Config, local:LocalStorage, sha256:str, name:str = ""):
+    """
+    Open a tracked file for reading, fetching only the parts that are actually read
+
+    :param config: project Config instance
+    :param local: LocalStorage instance
+    :param sha256: hash of the file
+    :param name: The filename the user would recognise, used in error messages
+    :return: A seekable, read-only binary file object
+    """
+    wait_for_prefetch(sha256)
+
+    cached_path = local.hash_to_file(sha256)
+    if not cached_path.exists():
+        if config.source_url(sha256=sha256) is None:
+            remote = RemoteStorage.get_from_config(config)
+        else:
+            remote = UrlRemoteStorage()
+
+        reader = call_with_retries(remote.range_reader, config, local, sha256)
+        if reader is not None:
+            size, fetch_range = reader
+            return io.BufferedReader(RemoteFile(local, sha256, size, fetch_range, name=name),
+                                     buffer_size=BLOCK_SIZE)
+
+        # no random access to this file, e.g. it's compressed in the remote
+        fetch_to_cache(config, local, sha256)
+
+    return open(str(cached_path), "rb")
+
+
+class RemoteFile(io.RawIOBase):
+    """
+    A read-only file backed by ranged reads of a remote object.
+
+    The blocks read are kept in a sparse file `<tmp>/<sha256>.blocks`, and the indices of the cached
+    blocks in `<tmp>/<sha256>.blocks.json`, so they are reused by later reads of the same file,
+    in this process or others. The state records the inode of the blocks file it describes, and is
+    ignored for any other blocks file. Once all the blocks have been read the file is verified against
+    its hash and moved into the local cache.
+    """
+
+    def __init__(self, local:LocalStorage, sha256:str, size:int,
+                 fetch_range:Callable[[int, int], Iterable[bytes]], name:str = ""):
+        """
+        :param local: LocalStorage instance holding the block cache
+        :param sha256: The sha256 of the file
+        :param size: The size of the file in bytes
+        :param fetch_range: Function returning the bytes between `start` and `end` (inclusive) of the file
+        :param name: The filename the user would recognise, used in error messages
+        """
+        super().__init__()
+        self.local = local
+        self.sha256 = sha256
+        self.size = size
+        self.fetch_range = fetch_range
+        self.name = name
+
+        self.blocks_path = Path(local.tmp_path, "%s.blocks" % sha256)
+        self.state_path = Path(local.tmp_path, "%s.blocks.json" % sha256)
+        self.num_blocks = max(1, (size + BLOCK_SIZE - 1) // BLOCK_SIZE)
+
+        self.fd = os.open(str(self.blocks_path), os.O_RDWR | os.O_CREAT, 0o644)
+        if os.fstat(self.fd).st_size != size:
+            os.truncate(self.fd, size)
+
+        self.done = self._load_state()
+        self.position = 0
+        self.completed = False
+
+        self._lock = threading.Lock()
+        self._last_end = None
+        self._readahead = 1
+
+    def readable(self) -> bool:
+        return True
+
+    def seekable(self) -> bool:
+        return True
+
+    def tell(self) -> int:
+        return self.position
+
+    def seek(self, offset:int, whence:int = io.SEEK_SET) -> int:
+        if whence == io.SEEK_SET:
+            position = offset
+        elif whence == io.SEEK_CUR:
+            position = self.position + offset
+        elif whence == io.SEEK_END:
+            position = self.size + offset
+        else:
+            raise ValueError("Invalid whence `%s`" % whence)
+
+        if position < 0:
+            raise ValueError("Negative seek position %d" % position)
+        self.position = position
+        return position
+
+    def readinto(self, buffer) -> int:
+        if self.position >= self.size:
+            return 0
+
+        length = min(len(buffer), self.size - self.position)
+        self._ensure_cached(self.position, self.position + length)
+
+        data = os.pread(self.fd, length, self.position)
+        buffer[:len(data)] = data
+        self.position += len(data)
+        return len(data)
+
+    def close(self):
+        if not self.closed:
+            os.close(self.fd)
+        super().close()
+
+    def _ensure_cached(self, start:int, end:int):
+        """
+        Fetch the missing blocks between `start` and `end` (exclusive), reading ahead when reads are sequential
+        """
+        with self._lock:
+            # grow the read-ahead window while the reads are sequential, reset it on a seek
+            if start == self._last_end:
+                self._readahead = min(self._readahead * 2, MAX_READAHEAD_BLOCKS)
+            else:
+                self._readahead = 1
+            self._last_end = end
+
+            first = start // BLOCK_SIZE
+            last = max((end - 1) // BLOCK_SIZE, first + self._readahead - 1)
+            last = min(last, self.num_blocks - 1)
+            missing = [i for i in range(first, last + 1) if i not in self.done]
+            if not missing:
+                return
+
+            # one ranged read per run of consecutive missing blocks
+            runs = []
+            for index in missing:
+                if runs and runs[-1][-1] == index - 1:
+                    runs[-1].append(index)
+                else:
+                    runs.append([index])
+
+            for run in runs:
+                call_with_retries(self._fetch_blocks, run[0], run[-1])
+                self.done.update(run)
+
+            self._save_state()
+            if len(self.done) == self.num_blocks:
+                self._complete()
+
+    def _fetch_blocks(self, first:int, last:int):
+        start = first * BLOCK_SIZE
+        end = min((last + 1) * BLOCK_SIZE, self.size) - 1
+
+        offset = start
+        with timed("range_read", end - start + 1):
+            for chunk in self.fetch_range(start, end):
+                os.pwrite(self.fd, chunk, offset)
+                offset += len(chunk)
+
+        if offset != end + 1:
+            raise RuntimeError("Read of `%s` was cut short at byte %d of %d." % (self.name, offset, self.size))
+
+    def _complete(self):
+        """
+        All the blocks have been read: verify the file and move it into the local cache
+        """
+        if self.completed:
+            return
+
+        if calculate_file_sha256(str(self.blocks_path)) != self.sha256:
+            self._cleanup()
+            raise RuntimeError("Hash for the downloaded file `%s` is incorrect. "
+                               "File might be corrupted in the remote storage backend." % self.name)
+
+        # removed first, so that the state never outlives the blocks it describes
+        if self.state_path.exists():
+            self.state_path.unlink()
+        # our descriptor stays valid after the rename, so reads continue from the cached file
+        self.local.commit_temp_file(str(self.blocks_path), self.sha256)
+        self._cleanup()
+        self.completed = True
+
+    def _blocks_file_id(self) -> list:
+        stat = os.fstat(self.fd)
+        return [stat.st_dev, stat.st_ino]
+
+    def _load_state(self) -> set:
+        if self.state_path.exists():
+            try:
+                with open(str(self.state_path)) as fp:
+                    state = json.load(fp)
+                # e.g. left behind when the blocks it describes were moved into the cache, and the blocks file
+                # was created again since
+                if state["size"] == self.size and state["block_size"] == BLOCK_SIZE and \
+                        state["blocks_file"] == self._blocks_file_id():
+                    return set(state["done"])
+            except (ValueError, KeyError):
+                # corrupted state, start from scratch
+                pass
+        return set()
+
+    def _save_state(self):
+        try:
+            if os.stat(str(self.blocks_path)).st_ino != os.fstat(self.fd).st_ino:
+                # another reader completed the file and moved it into the cache
+                return
+        except FileNotFoundError:
+            return
+
+        # merge with the blocks cached by other readers of the same file in the meantime
+        self.done |= self._load_state()
+        tmp_state_path = "%s.%d.tmp" % (str(self.state_path), os.getpid())
+        with open(tmp_state_path, "w") as fp:
+            json.dump({"size": self.size, "block_size": BLOCK_SIZE, "blocks_file": self._blocks_file_id(),
+                       "done": sorted(self.done)}, fp)
+        os.replace(tmp_state_path, str(self.state_path))
+
+    def _cleanup(self):
+        for p in [self.blocks_path, self.state_path]:
+            if p.exists():
+                p.unlink()
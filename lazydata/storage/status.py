@@ -0,0 +1,90 @@
+"""
+The status of the tracked files in the workspace
+
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+from collections import OrderedDict
+from typing import List, Optional
+import os
+
+from lazydata.config.config import Config
+from lazydata.storage.hash import calculate_file_sha256
+from lazydata.storage.local import LocalStorage
+
+# The file is at the latest tracked version
+STATUS_OK = "ok"
+# The file is not in the workspace
+STATUS_MISSING = "missing"
+# The file is at an older tracked version
+STATUS_STALE = "stale"
+# The file doesn't match any tracked version
+STATUS_MODIFIED = "modified"
+
+# Number of files hashed in parallel
+HASH_WORKERS = os.cpu_count() or 4
+
+
+def get_status(config:Config, local:LocalStorage, entries:List[dict], remote=None) -> List[dict]:
+    """
+    Get the status of the latest version of each tracked file.
+
+    Files are only hashed if their mtime or size changed since they were last hashed,
+    and the ones that need it are hashed in parallel.
+
+    :param config: project Config instance
+    :param local: LocalStorage instance
+    :param entries: config file entries with `path` and `hash`
+    :param remote: If given, the RemoteStorage instance to check for the files
+    :return: list of dicts with the `path`, `hash`, `status` and `cached` (bool) of each file,
+             and `remote` (bool) if a remote was given
+    """
+    latest = OrderedDict((e["path"], e) for e in entries)
+
+    # all the versions of each path, in a single pass over the config
+    versions = {}
+    for e in config.config["files"]:
+        if e["path"] in latest:
+            versions.setdefault(e["path"], []).append(e["hash"])
+
+    root = str(config.config_path.parent.resolve())
+    abs_paths = {path: os.path.join(root, path) for path in latest}
+    existing = [path for path in latest if os.path.isfile(abs_paths[path])]
+
+    known = local.get_files_sha256([abs_paths[path] for path in existing])
+    to_hash = [path for path in existing if not known[abs_paths[path]]]
+
+    if to_hash:
+        with ThreadPoolExecutor(max_workers=HASH_WORKERS) as executor:
+            hashes = list(executor.map(lambda path: calculate_file_sha256(abs_paths[path]), to_hash))
+        # remember the hashes so the next check is fast
+        new_hashes = {abs_paths[path]: sha256 for path, sha256 in zip(to_hash, hashes)}
+        local.register_files(new_hashes)
+        known.update((abs_path, [sha256]) for abs_path, sha256 in new_hashes.items())
+
+    remote_blobs = remote.list_blobs(local) if remote is not None else None
+
+    data_path = str(local.data_path)
+    result = []
+    for path, e in latest.items():
+        current = known.get(abs_paths[path])
+        if current is None:
+            status = STATUS_MISSING
+        elif e["hash"] in current:
+            status = STATUS_OK
+        elif any(sha256 in current for sha256 in versions[path][:-1]):
+            status = STATUS_STALE
+        else:
+            status = STATUS_MODIFIED
+
+        file_status = {
+            "path": path,
+            "hash": e["hash"],
+            "status": status,
+            "cached": os.path.exists(os.path.join(data_path, e["hash"][:2], e["hash"][2:])),
+        }
+        if remote_blobs is not None:
+            file_status["remote"] = e["hash"] in remote_blobs
+        result.append(file_status)
+
+    return result
@@ -0,0 +1,558 @@
+"""
+The transfer layer: adaptive concurrency with retries, and parallel resumable byte-range downloads
+
+"""
+
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Callable, Iterable, List, Optional
+from urllib.error import HTTPError
+import hashlib
+import json
+import os
+import queue
+import random
+import threading
+import time
+
+import lazy_import
+botocore = lazy_import.lazy_module("botocore")
+urllib3 = lazy_import.lazy_module("urllib3")
+
+from lazydata.metrics import count
+from lazydata.storage.hash import BUF_SIZE
+from lazydata.storage.local import LocalStorage
+
+try:
+    import fcntl
+except ImportError:
+    # not available on Windows, concurrent downloads of the same file are then not guarded
+    fcntl = None
+
+# Files at least this big are downloaded with parallel ranged requests
+RANGED_DOWNLOAD_THRESHOLD = 64 * 1024 * 1024
+# Size of a single ranged request, this is also the granularity at which downloads are resumed
+PART_SIZE = 32 * 1024 * 1024
+# Number of ranged requests in flight for a single file
+MAX_PARALLEL_PARTS = 8
+
+# Bounds for the number of files transferred in parallel, the actual number is adjusted while transferring
+INITIAL_CONCURRENCY = 8
+MAX_CONCURRENCY = 64
+
+
+def _env_number(name:str, default:float) -> float:
+    value = os.environ.get(name)
+    if not value:
+        return default
+    try:
+        return float(value)
+    except ValueError:
+        raise RuntimeError("The %s environment variable needs to be a number, got `%s`" % (name, value))
+
+
+# Retries of throttled and failed requests (including timeouts), with jittered exponential backoff
+MAX_ATTEMPTS = max(1, int(_env_number("LAZYDATA_MAX_ATTEMPTS", 6)))
+BASE_BACKOFF = 0.2
+MAX_BACKOFF = 20.0
+
+# Seconds to wait for a connection to the remote, and for the next bytes of a response, before retrying
+CONNECT_TIMEOUT = _env_number("LAZYDATA_CONNECT_TIMEOUT", 10.0)
+READ_TIMEOUT = _env_number("LAZYDATA_READ_TIMEOUT", 30.0)
+
+# Requests whose first bytes take longer than this percentile of the recent ones are hedged, i.e. sent again,
+# and the response that starts first is used. 0 disables hedging.
+HEDGE_PERCENTILE = _env_number("LAZYDATA_HEDGE_PERCENTILE", 95.0)
+# Number of recent first-byte latencies kept per remote, and how many are needed before hedging
+LATENCY_WINDOW = 200
+MIN_LATENCY_SAMPLES = 20
+# Never hedge sooner than this many seconds, so fast responses aren't requested twice
+MIN_HEDGE_DELAY = 0.05
+
+# Error codes with which S3 and S3-compatible services signal that we should slow down
+THROTTLE_ERROR_CODES = {"SlowDown", "Throttling", "ThrottlingException", "RequestLimitExceeded",
+                        "RequestThrottled", "TooManyRequests", "ServiceUnavailable", "503", "429"}
+
+THROTTLED = "throttled"
+TRANSIENT = "transient"
+
+# Set on the errors that were already retried MAX_ATTEMPTS times, so the callers don't retry them again
+RETRIES_EXHAUSTED_ATTR = "lazydata_retries_exhausted"
+
+# Whether the current thread is inside call_with_retries(), the nested calls leave the retrying to it
+_retrying = threading.local()
+
+
+def classify_error(e:Exception) -> Optional[str]:
+    """
+    Check if a failed request is worth retrying
+
+    :param e: The exception raised by the request
+    :return: THROTTLED if the service is asking us to slow down, TRANSIENT for other retryable errors
+             and None if the error is permanent
+    """
+    if getattr(e, RETRIES_EXHAUSTED_ATTR, False):
+        return None
+
+    if isinstance(e, HTTPError):
+        return THROTTLED if e.code in (429, 503) else None
+
+    response = getattr(e, "response", None)
+    if isinstance(response, dict):
+        code = response.get("Error", {}).get("Code")
+        status = response.get("ResponseMetadata", {}).get("HTTPStatusCode")
+        if code in THROTTLE_ERROR_CODES or status in (429, 503):
+            return THROTTLED
+        return TRANSIENT if status is not None and status >= 500 else None
+
+    if isinstance(e, (ConnectionError, TimeoutError)):
+        return TRANSIENT
+
+    if type(e).__module__.startswith("botocore") and \
+            isinstance(e, (botocore.exceptions.ConnectionError, botocore.exceptions.HTTPClientError)):
+        return TRANSIENT
+
+    if type(e).__module__.startswith("urllib3") and \
+            isinstance(e, (urllib3.exceptions.TimeoutError, urllib3.exceptions.ProtocolError,
+                           urllib3.exceptions.NewConnectionError)):
+        # urllib3 is used without its own retries, so timeouts and dropped connections end up here
+        return TRANSIENT
+
+    return None
+
+
+def backoff_delay(attempt:int) -> float:
+    """
+    Exponential backoff with full jitter
+
+    :param attempt: The number of the failed attempt, starting at 0
+    :return: Seconds to wait before the next attempt
+    """
+    return random.uniform(0, min(MAX_BACKOFF, BASE_BACKOFF * 2 ** attempt))
+
+
+def call_with_retries(fn:Callable, *args, controller:Optional["AdaptiveConcurrency"] = None, **kwargs):
+    """
+    Call `fn`, retrying throttled and transient failures with backoff
+
+    Calls nested in the same thread are not retried on their own, the outermost call retries the whole of it.
+
+    :param fn: The function making the request(s)
+    :param controller: If given, it's told about throttling so it can lower the concurrency
+    :return: The return value of `fn`
+    """
+    if getattr(_retrying, "active", False):
+        return fn(*args, **kwargs)
+
+    _retrying.active = True
+    try:
+        for attempt in range(MAX_ATTEMPTS):
+            try:
+                return fn(*args, **kwargs)
+            except Exception as e:
+                kind = classify_error(e)
+                if kind is None:
+                    raise
+                if attempt == MAX_ATTEMPTS - 1:
+                    try:
+                        setattr(e, RETRIES_EXHAUSTED_ATTR, True)
+                    except AttributeError:
+                        pass
+                    raise
+                count("request_throttled" if kind == THROTTLED else "request_retried")
+                if controller is not None:
+                    controller.on_retry(throttled=kind == THROTTLED)
+                time.sleep(backoff_delay(attempt))
+    finally:
+        _retrying.active = False
+
+
+class AdaptiveConcurrency:
+    """
+    Additive-increase/multiplicative-decrease control of the number of parallel transfers.
+
+    The limit grows by one after each round of transfers that didn't lower the throughput,
+    and is halved (at most once per second) when the service throttles us.
+    """
+
+    def __init__(self, initial:int = INITIAL_CONCURRENCY, maximum:int = MAX_CONCURRENCY):
+        self.limit = initial
+        self.maximum = maximum
+
+        self._active = 0
+        self._cond = threading.Condition()
+        self._last_decrease = 0.0
+        self._last_throughput = 0.0
+        self._reset_window()
+
+        # stats for the run
+        self.start_time = time.monotonic()
+        self.completed = 0
+        self.total_bytes = 0
+        self.throttled = 0
+        self.retried = 0
+        self.limit_samples = []
+
+    def _reset_window(self):
+        self._window_start = time.monotonic()
+        self._window_bytes = 0
+        self._window_count = 0
+
+    def acquire(self):
+        with self._cond:
+            while self._active >= self.limit:
+                self._cond.wait()
+            self._active += 1
+
+    def release(self):
+        with self._cond:
+            self._active -= 1
+            self._cond.notify_all()
+
+    def on_success(self, num_bytes:int):
+        with self._cond:
+            self.completed += 1
+            self.total_bytes += num_bytes
+            self.limit_samples.append(self.limit)
+
+            self._window_bytes += num_bytes
+            self._window_count += 1
+            if self._window_count >= self.limit:
+                elapsed = max(time.monotonic() - self._window_start, 1e-6)
+                throughput = self._window_bytes / elapsed
+                if throughput >= 0.95 * self._last_throughput and self.limit < self.maximum:
+                    self.limit += 1
+                    self._cond.notify_all()
+                self._last_throughput = throughput
+                self._reset_window()
+
+    def on_retry(self, throttled:bool):
+        with self._cond:
+            self.retried += 1
+            if throttled:
+                self.throttled += 1
+                now = time.monotonic()
+                if now - self._last_decrease > 1.0:
+                    self.limit = max(1, self.limit // 2)
+                    self._last_decrease = now
+                    self._last_throughput = 0.0
+                    self._reset_window()
+
+    def summary(self) -> str:
+        elapsed = time.monotonic() - self.start_time
+        samples = self.limit_samples or [self.limit]
+        return "Transferred %d files (%d bytes) in %.1fs, concurrency min %d / avg %.1f / max %d, " \
+               "%d throttled, %d retried" % (self.completed, self.total_bytes, elapsed, min(samples),
+                                             sum(samples) / len(samples), max(samples), self.throttled, self.retried)
+
+
+def run_adaptive(fn:Callable, items:List, controller:Optional[AdaptiveConcurrency] = None) -> AdaptiveConcurrency:
+    """
+    Run `fn` on all the items in parallel, with the concurrency adjusted by the controller.
+    Failed calls are retried with backoff, and the first permanent failure is re-raised.
+
+    :param fn: Function doing one transfer, returning the number of bytes transferred
+    :param items: The items to pass to `fn`
+    :param controller: AdaptiveConcurrency instance, a new one is created if not given
+    :return: The controller, with the stats of the run
+    """
+    if controller is None:
+        controller = AdaptiveConcurrency()
+
+    failed = threading.Event()
+
+    def run_one(item):
+        try:
+            num_bytes = call_with_retries(fn, item, controller=controller)
+            controller.on_success(num_bytes or 0)
+        except Exception:
+            failed.set()
+            raise
+        finally:
+            controller.release()
+
+    futures = []
+    with ThreadPoolExecutor(max_workers=controller.maximum) as executor:
+        for item in items:
+            if failed.is_set():
+                # stop starting new transfers after a permanent failure
+                break
+            controller.acquire()
+            futures.append(executor.submit(run_one, item))
+
+    for future in futures:
+        future.result()
+
+    return controller
+
+
+class LatencyTracker:
+    """
+    The recent first-byte latencies of the requests to one remote, to decide when a request is a straggler
+    """
+
+    def __init__(self):
+        self.samples = deque(maxlen=LATENCY_WINDOW)
+        self._lock = threading.Lock()
+
+    def add(self, seconds:float):
+        with self._lock:
+            self.samples.append(seconds)
+
+    def hedge_delay(self) -> Optional[float]:
+        """
+        :return: Seconds after which a request should be hedged, or None if it shouldn't be
+        """
+        if HEDGE_PERCENTILE <= 0:
+            return None
+        with self._lock:
+            if len(self.samples) < MIN_LATENCY_SAMPLES:
+                return None
+            samples = sorted(self.samples)
+        index = min(len(samples) - 1, int(HEDGE_PERCENTILE / 100.0 * len(samples)))
+        return max(MIN_HEDGE_DELAY, samples[index])
+
+
+# remote name -> LatencyTracker
+_latency_trackers = {}
+_latency_trackers_lock = threading.Lock()
+
+
+def get_latency_tracker(name:str) -> LatencyTracker:
+    with _latency_trackers_lock:
+        tracker = _latency_trackers.get(name)
+        if tracker is None:
+            tracker = _latency_trackers[name] = LatencyTracker()
+        return tracker
+
+
+def _close_stream(stream):
+    close = getattr(stream, "close", None)
+    if close is not None:
+        close()
+
+
+def hedged_stream(open_stream:Callable[[], Iterable[bytes]], tracker:LatencyTracker) -> Iterable[bytes]:
+    """
+    Stream the response of a request, sending the request again if its first bytes are slower to arrive
+    than most requests to the same remote. The response that starts first is used and the other is closed.
+
+    :param open_stream: Function making the request and returning its chunks, called once per attempt
+    :param tracker: LatencyTracker of the remote
+    :return: Generator over the chunks of the response
+    """
+    delay = tracker.hedge_delay()
+
+    if delay is None:
+        start = time.monotonic()
+        stream = iter(open_stream())
+        try:
+            chunk = next(stream, None)
+            tracker.add(time.monotonic() - start)
+            if chunk is not None:
+                yield chunk
+                yield from stream
+        finally:
+            _close_stream(stream)
+        return
+
+    results = queue.Queue()
+
+    def attempt(index:int):
+        start = time.monotonic()
+        try:
+            stream = iter(open_stream())
+            chunk = next(stream, None)
+        except Exception as e:
+            results.put((index, None, None, e))
+            return
+        tracker.add(time.monotonic() - start)
+        results.put((index, stream, chunk, None))
+
+    threading.Thread(target=attempt, args=(0,), daemon=True).start()
+    pending = 1
+    try:
+        result = results.get(timeout=delay)
+    except queue.Empty:
+        count("hedge_fired")
+        threading.Thread(target=attempt, args=(1,), daemon=True).start()
+        pending += 1
+        result = results.get()
+    pending -= 1
+
+    # use the first attempt that succeeds, and fail only if all of them failed
+    first_error = None
+    while result[3] is not None:
+        first_error = first_error or result[3]
+        if not pending:
+            raise first_error
+        result = results.get()
+        pending -= 1
+
+    if pending:
+        def close_rest(remaining:int):
+            # the slower attempts are closed once they respond
+            for _ in range(remaining):
+                _, stream, _, _ = results.get()
+                if stream is not None:
+                    _close_stream(stream)
+        threading.Thread(target=close_rest, args=(pending,), daemon=True).start()
+
+    index, stream, chunk, _ = result
+    if index > 0:
+        count("hedge_won")
+    try:
+        if chunk is not None:
+            yield chunk
+            yield from stream
+    finally:
+        _close_stream(stream)
+
+
+def hedged_range_reader(fetch_range:Callable[[int, int], Iterable[bytes]],
+                        name:str) -> Callable[[int, int], Iterable[bytes]]:
+    """
+    Wrap a function reading byte ranges from a remote so that straggling reads are hedged
+
+    :param fetch_range: Function returning the bytes between `start` and `end` (inclusive)
+    :param name: The name of the remote, e.g. its URL, whose latencies decide when to hedge
+    :return:
+    """
+    tracker = get_latency_tracker(name)
+    return lambda start, end: hedged_stream(lambda: fetch_range(start, end), tracker)
+
+
+class RangedDownload:
+    """
+    A download of a single blob into the local cache using parallel byte-range requests.
+
+    The blob is written into `<tmp>/<sha256>.partial` and the indices of the completed parts are
+    persisted in `<tmp>/<sha256>.partial.json` after each part, so that an interrupted download
+    resumes from the completed parts. The hash is calculated over the completed prefix of the
+    file while the rest is still downloading, and the file is atomically renamed into the cache
+    once it's verified.
+    """
+
+    def __init__(self, local:LocalStorage, sha256:str, size:int,
+                 fetch_range:Callable[[int, int], Iterable[bytes]], name:str = ""):
+        """
+        :param local: LocalStorage instance to download into
+        :param sha256: The sha256 of the blob
+        :param size: The size of the blob in bytes
+        :param fetch_range: Function returning the bytes between `start` and `end` (inclusive) of the blob
+        :param name: The filename the user would recognise, used in error messages
+        """
+        self.local = local
+        self.sha256 = sha256
+        self.size = size
+        self.fetch_range = fetch_range
+        self.name = name
+
+        self.partial_path = Path(local.tmp_path, "%s.partial" % sha256)
+        self.state_path = Path(local.tmp_path, "%s.partial.json" % sha256)
+
+        self.num_parts = max(1, (size + PART_SIZE - 1) // PART_SIZE)
+        self.done = set()
+
+        self._lock = threading.Lock()
+        self._hasher = hashlib.sha256()
+        self._hashed_parts = 0
+
+    def run(self) -> str:
+        """
+        Download the blob, resuming a previous partial download if there is one
+
+        :return: The sha256 of the downloaded file
+        """
+
+        with open(str(self.partial_path), "ab") as lock_fp:
+            if fcntl is not None:
+                # wait for any other process downloading the same blob
+                fcntl.flock(lock_fp.fileno(), fcntl.LOCK_EX)
+
+            if self.local.hash_to_file(self.sha256).exists():
+                # someone else finished the download while we were waiting
+                self._cleanup()
+                return self.sha256
+
+            self._load_state()
+
+            fd = os.open(str(self.partial_path), os.O_RDWR)
+            try:
+                os.truncate(fd, self.size)
+
+                # hash the parts completed in a previous run
+                self._advance_hash(fd)
+
+                todo = [i for i in range(self.num_parts) if i not in self.done]
+                with ThreadPoolExecutor(max_workers=MAX_PARALLEL_PARTS) as executor:
+                    # consume the results to re-raise any exceptions
+                    for _ in executor.map(lambda i: call_with_retries(self._download_part, fd, i), todo):
+                        pass
+            finally:
+                os.close(fd)
+
+            if self._hasher.hexdigest() != self.sha256:
+                self._cleanup()
+                raise RuntimeError("Hash for the downloaded file `%s` is incorrect. "
+                                   "File might be corrupted in the remote storage backend." % self.name)
+
+            self.local.commit_temp_file(str(self.partial_path), self.sha256)
+            self._cleanup()
+
+        return self.sha256
+
+    def _download_part(self, fd:int, index:int):
+        start = index * PART_SIZE
+        end = min(start + PART_SIZE, self.size) - 1
+
+        offset = start
+        for chunk in self.fetch_range(start, end):
+            os.pwrite(fd, chunk, offset)
+            offset += len(chunk)
+
+        if offset != end + 1:
+            raise RuntimeError("Download of `%s` was cut short at byte %d of %d." % (self.name, offset, self.size))
+
+        with self._lock:
+            self.done.add(index)
+            self._save_state()
+            self._advance_hash(fd)
+
+    def _advance_hash(self, fd:int):
+        """
+        Hash all the parts that form a contiguous completed prefix of the file and haven't been hashed yet.
+        The parts were just written, so this reads them from the page cache.
+        """
+        while self._hashed_parts in self.done:
+            offset = self._hashed_parts * PART_SIZE
+            end = min(offset + PART_SIZE, self.size)
+            while offset < end:
+                data = os.pread(fd, min(BUF_SIZE * 16, end - offset), offset)
+                self._hasher.update(data)
+                offset += len(data)
+            self._hashed_parts += 1
+
+    def _load_state(self):
+        self.done = set()
+        if self.state_path.exists():
+            try:
+                with open(str(self.state_path)) as fp:
+                    state = json.load(fp)
+                if state["size"] == self.size and state["part_size"] == PART_SIZE:
+                    self.done = set(state["done"])
+            except (ValueError, KeyError):
+                # corrupted state, start from scratch
+                pass
+
+    def _save_state(self):
+        tmp_state_path = "%s.tmp" % str(self.state_path)
+        with open(tmp_state_path, "w") as fp:
+            json.dump({"size": self.size, "part_size": PART_SIZE, "done": sorted(self.done)}, fp)
+        os.replace(tmp_state_path, str(self.state_path))
+
+    def _cleanup(self):
+        for p in [self.partial_path, self.state_path]:
+            if p.exists():
+                p.unlink()
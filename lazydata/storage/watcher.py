@@ -0,0 +1,235 @@
+"""
+A watcher keeping the hashes of the tracked files in the metadb up to date as they change
+
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Set
+import ctypes
+import ctypes.util
+import errno
+import os
+import select
+import struct
+import time
+
+from lazydata.config.config import Config
+from lazydata.storage.hash import calculate_file_sha256
+from lazydata.storage.local import LocalStorage
+from lazydata.storage.status import get_status, HASH_WORKERS
+
+# inotify event masks, from <sys/inotify.h>
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_CLOEXEC = 0o2000000
+IN_NONBLOCK = 0o4000
+
+WATCH_MASK = IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE | \
+             IN_DELETE_SELF | IN_ONLYDIR
+
+EVENT_HEADER = struct.Struct("iIII")
+
+# Seconds without writes to a file before it's rehashed
+DEFAULT_SETTLE_TIME = 1.0
+# Seconds between retries to watch the directories of tracked files that don't exist yet
+RESCAN_INTERVAL = 30.0
+
+
+class Inotify:
+    """
+    Minimal ctypes binding of the Linux inotify API
+    """
+
+    def __init__(self):
+        libc_name = ctypes.util.find_library("c")
+        libc = ctypes.CDLL(libc_name, use_errno=True) if libc_name else None
+        if libc is None or not hasattr(libc, "inotify_init1"):
+            raise RuntimeError("`lazydata watch` needs inotify, which is only available on Linux.")
+
+        self.libc = libc
+        self.fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), os.strerror(ctypes.get_errno()))
+
+    def add_watch(self, path:str, mask:int) -> int:
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(path), ctypes.c_uint32(mask))
+        if wd < 0:
+            error = ctypes.get_errno()
+            if error == errno.ENOSPC:
+                raise RuntimeError("Too many watched directories. Raise the limit with "
+                                   "`sysctl fs.inotify.max_user_watches=<number>`.")
+            raise OSError(error, os.strerror(error), path)
+        return wd
+
+    def read_events(self, timeout:float):
+        """
+        Wait for events
+
+        :param timeout: Maximum seconds to wait
+        :return: list of (watch descriptor, mask, name) tuples
+        """
+        ready, _, _ = select.select([self.fd], [], [], timeout)
+        if not ready:
+            return []
+
+        try:
+            data = os.read(self.fd, 1024 * 1024)
+        except BlockingIOError:
+            return []
+
+        events = []
+        offset = 0
+        while offset < len(data):
+            wd, mask, _, length = EVENT_HEADER.unpack_from(data, offset)
+            offset += EVENT_HEADER.size
+            name = os.fsdecode(data[offset:offset + length].rstrip(b"\0"))
+            offset += length
+            events.append((wd, mask, name))
+        return events
+
+    def close(self):
+        os.close(self.fd)
+
+
+class Watcher:
+    """
+    Watches the directories of the tracked files of a project and rehashes the files once writes to them
+    have settled, so that track() and `lazydata status` find their current hash in the metadb.
+
+    Directories are watched rather than files, so that 100k tracked files need only as many watches
+    as directories they are in, and files replaced by a rename are noticed too.
+    """
+
+    def __init__(self, config:Config, local:LocalStorage, settle_time:float = DEFAULT_SETTLE_TIME):
+        self.config = config
+        self.local = local
+        self.settle_time = settle_time
+
+        self.inotify = Inotify()
+        self.executor = ThreadPoolExecutor(max_workers=HASH_WORKERS)
+
+        # directory -> names of the tracked files in it
+        self.tracked = {}  # type: Dict[str, Set[str]]
+        self.watches = {}  # type: Dict[int, str]
+        self.watched_dirs = set()
+        # path -> time of the last event
+        self.dirty = {}  # type: Dict[str, float]
+        self.last_rescan = 0.0
+
+        self.config_dir = str(config.config_path.parent.resolve())
+        self.config_name = config.config_path.name
+
+    def load_tracked(self):
+        """
+        Read the tracked paths from the config and watch their directories
+        """
+        tracked = {}
+        for e in self.config.config["files"]:
+            dirname, name = os.path.split(os.path.join(self.config_dir, e["path"]))
+            tracked.setdefault(dirname, set()).add(name)
+        self.tracked = tracked
+        self.watch_directories()
+
+    def watch_directories(self):
+        for dirname in [self.config_dir] + list(self.tracked):
+            if dirname not in self.watched_dirs and os.path.isdir(dirname):
+                self.watches[self.inotify.add_watch(dirname, WATCH_MASK)] = dirname
+                self.watched_dirs.add(dirname)
+        self.last_rescan = time.monotonic()
+
+    def full_scan(self):
+        """
+        Bring the hashes of all the tracked files up to date, hashing only the ones whose stat changed
+        """
+        get_status(self.config, self.local, self.config.config["files"])
+
+    def run(self):
+        self.load_tracked()
+        print("LAZYDATA: Watching %d tracked files in %d directories" %
+              (sum(len(names) for names in self.tracked.values()), len(self.watched_dirs)))
+        self.full_scan()
+
+        try:
+            while True:
+                for wd, mask, name in self.inotify.read_events(timeout=self.settle_time / 2):
+                    self.handle_event(wd, mask, name)
+
+                self.rehash_settled()
+
+                if time.monotonic() - self.last_rescan > RESCAN_INTERVAL:
+                    self.watch_directories()
+        finally:
+            self.executor.shutdown()
+            self.inotify.close()
+
+    def handle_event(self, wd:int, mask:int, name:str):
+        if mask & IN_Q_OVERFLOW:
+            # events were lost, check everything
+            print("LAZYDATA: Too many changes at once, rescanning all tracked files...")
+            self.full_scan()
+            return
+
+        dirname = self.watches.get(wd)
+        if dirname is None:
+            return
+
+        if mask & (IN_IGNORED | IN_DELETE_SELF):
+            # the directory is gone, it's watched again if it's recreated
+            del self.watches[wd]
+            self.watched_dirs.discard(dirname)
+            return
+
+        if dirname == self.config_dir and name == self.config_name:
+            if mask & (IN_CLOSE_WRITE | IN_MOVED_TO):
+                self.config = Config(self.config.config_path.parent)
+                self.load_tracked()
+            return
+
+        if mask & IN_CREATE and name and os.path.join(dirname, name) in self.tracked:
+            # a directory with tracked files was created
+            self.watch_directories()
+
+        if name in self.tracked.get(dirname, ()):
+            self.dirty[os.path.join(dirname, name)] = time.monotonic()
+
+    def rehash_settled(self):
+        now = time.monotonic()
+        settled = [path for path, last_event in self.dirty.items() if now - last_event >= self.settle_time]
+        if not settled:
+            return
+        for path in settled:
+            del self.dirty[path]
+
+        settled = [path for path in settled if os.path.isfile(path)]
+        known = self.local.get_files_sha256(settled)
+        to_hash = [path for path in settled if not known[path]]
+
+        hashed = {}
+        for path, (sha256, stat_before) in zip(to_hash, self.executor.map(self.hash_file, to_hash)):
+            stat_after = os.stat(path) if os.path.exists(path) else None
+            if stat_after is None:
+                continue
+            if (stat_before.st_mtime, stat_before.st_size) != (stat_after.st_mtime, stat_after.st_size):
+                # written to while hashing, try again later
+                self.dirty[path] = time.monotonic()
+                continue
+            hashed[path] = sha256
+
+        if hashed:
+            self.local.register_files(hashed)
+            for path in hashed:
+                print("LAZYDATA: Updated the hash of `%s`" % os.path.relpath(path, self.config_dir))
+
+    @staticmethod
+    def hash_file(path:str):
+        stat = os.stat(path)
+        return calculate_file_sha256(path), stat
@@ -1,11 +1,73 @@
 from pathlib import Path
-from typing import Optional
-import traceback
+from typing import Any, Callable, Optional
+import mmap
+import os
+import sys
 
+from lazydata.agent import agent_prefetch, agent_track
 from lazydata.config.config import Config
-from lazydata.storage.fetch_file import fetch_file
+from lazydata.memo import load_parsed
+from lazydata.metrics import timed
+from lazydata.storage.fetch_file import fetch_file, fetch_to_cache, start_prefetch, wait_for_prefetch
 from lazydata.storage.hash import calculate_file_sha256
 from lazydata.storage.local import LocalStorage
+from lazydata.storage.output import OutputFile, TextOutputFile
+from lazydata.storage.remote_file import open_remote_file
+
+
+# Set the LAZYDATA_PREFETCH environment variable to prefetch all the files a script uses on its first track() call
+PREFETCH_ENV_VAR = "LAZYDATA_PREFETCH"
+
+_prefetch_started = False
+
+# Kept by load() for the whole process, its memo of known file hashes makes reloading an unchanged file cheap
+_load_local = None
+
+
+def caller_script_location() -> str:
+    """
+    Get the location of the script calling the lazydata function that calls this one
+
+    :return: The script path, or an empty string if called interactively
+    """
+
+    # only the frame we need, extracting the whole stack reads the source lines of every frame
+    try:
+        script_location = sys._getframe(2).f_code.co_filename
+    except ValueError:
+        script_location = ""
+
+    # remove the ipython hash because it's going to be changing all the time
+    if script_location.startswith("<ipython-input") or script_location.startswith("<stdin"):
+        script_location = ""
+
+    return script_location
+
+
+def prefetch(script_path: Optional[str] = None):
+    """
+    Start fetching all the tracked files a script is known to use into the local cache,
+    in the background and in parallel, so later track() calls find them already there.
+
+    :param script_path: path to the script, defaults to the calling script
+    :return:
+    """
+    global _prefetch_started
+
+    if script_path is None:
+        script_path = caller_script_location()
+    if not script_path:
+        return
+
+    if agent_prefetch(script_path):
+        _prefetch_started = True
+        return
+
+    config = Config()
+    entries = config.tracked_files_used_in(script_path)
+    if entries:
+        start_prefetch(config, LocalStorage(), entries)
+    _prefetch_started = True
 
 
 def track(path: str, source_url: Optional[str] = None) -> str:
@@ -17,16 +79,32 @@ def track(path: str, source_url: Optional[str] = None) -> str:
     :return: Returns the path string that is now tracked
     """
 
-    stack = traceback.extract_stack()
+    return _track_from(path, source_url, caller_script_location())
 
-    script_location = ""
-    if len(stack) >= 2:
-        script_location = stack[-2].filename
 
-    # remove the ipython hash because it's going to be changing all the time
-    if script_location.startswith("<ipython-input") or script_location.startswith("<stdin"):
-        script_location = ""
+def _track_from(path: str, source_url: Optional[str], script_location: str,
+                local: Optional[LocalStorage] = None) -> str:
+    """
+    Track a file used by a script, through the agent if it's running
+    """
+    with timed("track"):
+        # a running `lazydata agent` has everything warm already
+        if agent_track(path, source_url, script_location):
+            return path
+
+        if not _prefetch_started and os.environ.get(PREFETCH_ENV_VAR, "") not in ("", "0"):
+            prefetch(script_location)
+
+        return _track(path, source_url, script_location, local=local)
+
+
+def _track(path: str, source_url: Optional[str], script_location: str, config: Optional[Config] = None,
+           local: Optional[LocalStorage] = None, output=None) -> str:
+    """
+    The implementation of track(), also used by the agent with its long-lived config and local storage
 
+    :param output: Where the messages are written, stdout by default
+    """
     path_obj = Path(path)
 
     # 1) Check if the path exists
@@ -36,16 +114,20 @@ def track(path: str, source_url: Optional[str] = None) -> str:
         raise NotImplementedError("Tracking directories is not currently supported: `%s`" % path)
 
     # 2) Check it's present in the config file
-    config = Config()
+    if config is None:
+        config = Config()
     latest, older = config.get_latest_and_all_file_entries(path)
 
-    local = LocalStorage()
+    if local is None:
+        local = LocalStorage()
 
     if path_exists and latest is None:
         # CASE: Start tracking a new file
-        print("LAZYDATA: Tracking new file `%s`" % path)
-        local.store_file(path)
-        config.add_file_entry(path=path, script_path=script_location, source_url=source_url)
+        print("LAZYDATA: Tracking new file `%s`" % path, file=output)
+        # the hash might be known already, e.g. for files written with lazydata.output()
+        cached_sha256 = local.get_file_sha256(path)
+        sha256 = local.store_file(path, sha256=cached_sha256[0] if len(set(cached_sha256)) == 1 else None)
+        config.add_file_entry(path=path, script_path=script_location, source_url=source_url, sha256=sha256)
     elif path_exists and latest:
         if source_url is not None:
             entry_with_url = config.add_source(entry=latest, source_url=source_url)
@@ -67,30 +149,35 @@ def track(path: str, source_url: Optional[str] = None) -> str:
         # check if it's one of the stale versions
         matching_old = [e for e in older if e["hash"] in cached_sha256]
         if matching_old:
-            print("LAZYDATA: Detected an old version of `%s`, updating to the latest..." % path)
+            print("LAZYDATA: Detected an old version of `%s`, updating to the latest..." % path, file=output)
             fetch_file(config=config, local=local, path=path, sha256=latest["hash"])
             # make sure usage is recorded
             config.add_usage(latest, script_location)
         else:
             # It's not a stale version...
-            # So now recalculate the SHA256 to see if the file really changed
-            path_sha256 = calculate_file_sha256(path)
+            # So now recalculate the SHA256 to see if the file really changed,
+            # unless `lazydata watch` already did it for the current mtime and size
+            if len(set(cached_sha256)) == 1:
+                path_sha256 = cached_sha256[0]
+            else:
+                path_sha256 = calculate_file_sha256(path)
 
             if latest["hash"] != path_sha256:
-                print("LAZYDATA: Tracked file `%s` changed, recording a new version..." % path)
-                local.store_file(path)
-                config.add_file_entry(path=path, script_path=script_location, source_url=source_url)
+                print("LAZYDATA: Tracked file `%s` changed, recording a new version..." % path, file=output)
+                local.store_file(path, sha256=path_sha256)
+                config.add_file_entry(path=path, script_path=script_location, source_url=source_url,
+                                      sha256=path_sha256)
                 # make sure usage is recorded
                 config.add_usage(latest, script_location)
             else:
                 # the file hasn't changed but the metadata was missing locally, so add it...
-                local.store_file(path)
+                local.store_file(path, sha256=path_sha256)
                 # make sure usage is recorded
                 config.add_usage(latest, script_location)
 
     elif not path_exists and latest:
         # CASE: Remote download
-        print("LAZYDATA: Getting latest version of tracked file `%s`..." % path)
+        print("LAZYDATA: Getting latest version of tracked file `%s`..." % path, file=output)
         if source_url is not None:
             config.add_source(entry=latest, source_url=source_url)
         fetch_file(config=config, local=local, path=path, sha256=latest["hash"])
@@ -98,10 +185,145 @@ def track(path: str, source_url: Optional[str] = None) -> str:
         config.add_usage(latest, script_location)
     elif not path_exists and not latest:
         if source_url is not None:
-            fetch_file(config=config, local=local, path=path, source_url=source_url)
-            config.add_file_entry(path=path, script_path=script_location, source_url=source_url)
+            sha256 = fetch_file(config=config, local=local, path=path, source_url=source_url)
+            config.add_file_entry(path=path, script_path=script_location, source_url=source_url, sha256=sha256)
         else:
             # CASE: Trying to track non-existing without source_url
             raise RuntimeError("Cannot track file, because file is not found: %s" % path)
 
     return path
+
+
+def open_tracked(path: str):
+    """
+    Open a tracked file for reading without downloading all of it.
+
+    If the file is not present locally, only the parts that are read are fetched from the remote
+    (or the source URL), so e.g. reading the footer of a big parquet file costs a few megabytes.
+    The file is not copied to `path`, use track() for that.
+
+    :param path: a path to a tracked file
+    :return: A seekable, read-only binary file object
+    """
+
+    script_location = caller_script_location()
+
+    config = Config()
+    latest, _ = config.get_latest_and_all_file_entries(path)
+    if latest is None:
+        raise RuntimeError("Cannot open file, because it's not tracked: %s" % path)
+
+    local = LocalStorage()
+
+    if Path(path).exists() and latest["hash"] in local.get_file_sha256(path):
+        # the file is at the latest version, no need to go through the cache
+        fp = open(path, "rb")
+    else:
+        fp = open_remote_file(config, local, latest["hash"], name=path)
+
+    if script_location:
+        config.add_usage(latest, script_location)
+
+    return fp
+
+
+def load(path: str, reader: Callable[[str], Any], source_url: Optional[str] = None, disk_cache: bool = False) -> Any:
+    """
+    Track a file and parse it with the reader, e.g. `lazydata.load("data.csv", pd.read_csv)`.
+
+    The parsed object is memoized by the content hash of the file and the reader, so loading an unchanged
+    file again returns the same object without parsing it. Don't modify it in place, copy it first.
+
+    :param path: a path to the file to be tracked
+    :param reader: function taking the path and returning the parsed object
+    :param source_url: a URL to the file to download from
+    :param disk_cache: also keep the parsed object pickled in the local cache, for other processes
+    :return: The parsed object
+    """
+
+    global _load_local
+    if _load_local is None:
+        _load_local = LocalStorage()
+    local = _load_local
+
+    _track_from(path, source_url, caller_script_location(), local=local)
+
+    return load_parsed(local, path, _current_sha256(local, path), reader, disk_cache=disk_cache)
+
+
+def _current_sha256(local: LocalStorage, path: str) -> str:
+    """
+    Get the sha256 of a file that was just tracked, from the metadb if possible
+    """
+    known = local.get_file_sha256(path)
+    if len(set(known)) == 1:
+        return known[0]
+
+    sha256 = calculate_file_sha256(path)
+    local.register_file(path, sha256)
+    return sha256
+
+
+def map_tracked(path: str):
+    """
+    Memory-map a tracked file straight from the local cache, without copying it into the workspace.
+
+    All the processes mapping the same version of a file share its pages in the page cache,
+    e.g. `np.frombuffer(lazydata.mmap("embeddings.bin"), dtype=np.float32)` in every worker.
+    The file is downloaded into the cache if needed. If it exists in the workspace it's tracked
+    first, so local changes are recorded as a new version as with track().
+
+    :param path: a path to a tracked file
+    :return: A read-only mmap of the file (or empty bytes for an empty file, which can't be mapped)
+    """
+
+    script_location = caller_script_location()
+
+    local = LocalStorage()
+
+    if Path(path).exists():
+        _track_from(path, None, script_location, local=local)
+        sha256 = _current_sha256(local, path)
+        if not local.hash_to_file(sha256).exists():
+            # the hash was recorded without storing the file, e.g. by `lazydata watch`
+            local.store_file(path, sha256=sha256)
+    else:
+        config = Config()
+        latest, _ = config.get_latest_and_all_file_entries(path)
+        if latest is None:
+            raise RuntimeError("Cannot map file, because it's not tracked: %s" % path)
+        sha256 = latest["hash"]
+
+        wait_for_prefetch(sha256)
+        fetch_to_cache(config, local, sha256)
+        if script_location:
+            config.add_usage(latest, script_location)
+
+    with open(str(local.hash_to_file(sha256)), "rb") as fp:
+        if os.fstat(fp.fileno()).st_size == 0:
+            return b""
+        return mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+def output(path: str, mode: str = "wb", encoding: Optional[str] = None):
+    """
+    Open an output file for writing that is tracked once it's closed, e.g. `with lazydata.output("model.bin") as f:`.
+
+    The bytes are hashed and copied into the local cache as they are written, so tracking the file
+    doesn't need to read it again. If the `with` block raises, the file is not tracked.
+
+    :param path: a path to the file to write
+    :param mode: "wb" (default) or "w" for text
+    :param encoding: the encoding in text mode
+    :return: A writable file object
+    """
+    if mode not in ("wb", "w"):
+        raise ValueError("lazydata.output() only supports the modes `wb` and `w`, got `%s`" % mode)
+
+    script_location = caller_script_location()
+
+    Path(path).parent.mkdir(parents=True, exist_ok=True)
+    raw = OutputFile(path, LocalStorage(), lambda path: _track_from(path, None, script_location))
+    if mode == "w":
+        return TextOutputFile(raw, encoding=encoding)
+    return raw
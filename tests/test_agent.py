@@ -0,0 +1,60 @@
+import shutil
+import os
+import stat
+import subprocess
+from pathlib import Path
+
+AGENT_SCRIPT = """
+import lazydata
+
+lazydata.track("data/some_data_file.txt")
+try:
+    lazydata.track("data")
+except NotImplementedError:
+    print("NotImplementedError for a directory")
+"""
+
+
+def test_agent():
+    """
+    Test tracking through a running agent
+
+    :return:
+    """
+
+    cwd = os.getcwd()
+
+    shutil.rmtree("tests/projects", ignore_errors=True)
+    os.mkdir("tests/projects")
+    projects = Path("tests/projects").resolve()
+
+    shutil.copytree("tests/templates/sample-project", str(Path(projects, "agent1")))
+    home = Path(projects, "agent1-home")
+    env = dict(os.environ, LAZYDATA_HOME=str(home), PYTHONUNBUFFERED="1")
+
+    os.chdir(str(Path(projects, "agent1")))
+    agent = subprocess.Popen(["lazydata", "agent"], env=env, stdout=subprocess.PIPE, universal_newlines=True)
+    try:
+        assert "Agent listening" in agent.stdout.readline()
+        socket_path = Path(home, "agent.sock")
+        assert stat.S_IMODE(socket_path.stat().st_mode) == 0o600
+
+        subprocess.run(["lazydata", "init"], env=env, check=True)
+        with open("data/some_data_file.txt", "w") as f:
+            f.write("agent test data\n")
+        with open("agent_script.py", "w") as f:
+            f.write(AGENT_SCRIPT)
+
+        out = subprocess.run(["python", "agent_script.py"], env=env, check=True, stdout=subprocess.PIPE,
+                             universal_newlines=True).stdout
+        # the messages are sent back to the client, with the path as it gave it
+        assert "Tracking new file `data/some_data_file.txt`" in out
+        # the same exception as without the agent
+        assert "NotImplementedError for a directory" in out
+
+        with open("lazydata.yml", "r") as f:
+            assert "path: data/some_data_file.txt" in f.read()
+    finally:
+        subprocess.run(["lazydata", "agent", "--stop"], env=env)
+        agent.wait(timeout=10)
+        os.chdir(cwd)
@@ -0,0 +1,68 @@
+
+import shutil
+import os
+import subprocess
+import tarfile
+from pathlib import Path
+
+from lazydata.storage.bundle import _tar_info, TAR_BLOCK
+
+
+def test_bundle():
+    """
+    Test writing a bundle and importing it into an empty cache
+
+    :return:
+    """
+
+    cwd = os.getcwd()
+
+    shutil.rmtree("tests/projects", ignore_errors=True)
+    os.mkdir("tests/projects")
+
+    shutil.copytree("tests/templates/sample-project", "tests/projects/bundle1")
+    home = Path("tests/projects/bundle1-home").resolve()
+    home.mkdir()
+    other_home = Path("tests/projects/bundle1-other-home").resolve()
+    other_home.mkdir()
+    env = dict(os.environ, LAZYDATA_HOME=str(home))
+    other_env = dict(os.environ, LAZYDATA_HOME=str(other_home))
+
+    os.chdir("tests/projects/bundle1")
+    subprocess.run(["lazydata", "init"], env=env, check=True)
+
+    contents = {"data/some_data_file.txt": b"bundle test data\n", "data/empty.bin": b"",
+                "data/random.bin": os.urandom(3 * TAR_BLOCK + 17)}
+    for path, content in contents.items():
+        with open(path, "wb") as f:
+            f.write(content)
+        subprocess.run(["python", "-c", "import lazydata; lazydata.track('%s')" % path], env=env, check=True)
+
+    subprocess.run(["lazydata", "bundle", "../bundle1.tar"], env=env, check=True)
+    assert tarfile.open("../bundle1.tar").getnames()[0] == "lazydata-index.json"
+
+    # import from the file (in parallel) and from a pipe (sequentially)
+    out = subprocess.run(["lazydata", "unbundle", "../bundle1.tar"], env=other_env, check=True,
+                         stdout=subprocess.PIPE, universal_newlines=True).stdout
+    assert "Imported 3 files" in out
+    with open("../bundle1.tar", "rb") as f:
+        subprocess.run(["lazydata", "unbundle", "-"], env=dict(os.environ, LAZYDATA_HOME=str(home) + "-pipe"),
+                       stdin=f, check=True)
+
+    shutil.rmtree("data/")
+    subprocess.run(["lazydata", "pull"], env=other_env, check=True)
+    for path, content in contents.items():
+        with open(path, "rb") as f:
+            assert f.read() == content
+
+    # teardown
+
+    os.chdir(cwd)
+
+
+def test_bundle_large_member_header():
+    """
+    Blobs of 8GB and more still have a single header, which the offsets in the index rely on
+    """
+    info = _tar_info("data/ab/" + "c" * 62, 9 * 1024 ** 3, 0)
+    assert len(info.tobuf(tarfile.GNU_FORMAT)) == TAR_BLOCK
@@ -0,0 +1,108 @@
+
+import shutil
+import os
+from pathlib import Path
+
+def test_file_remote():
+    """
+    Test pushing to and pulling from a local filesystem remote
+
+    :return:
+    """
+
+    cwd = os.getcwd()
+
+    shutil.rmtree("tests/projects", ignore_errors=True)
+    os.mkdir("tests/projects")
+
+    shutil.copytree("tests/templates/sample-project", "tests/projects/file1")
+    remote_dir = Path("tests/projects/file1-remote").resolve()
+    remote_dir.mkdir()
+
+    os.chdir("tests/projects/file1")
+    os.system("lazydata init")
+
+    with open("data/some_data_file.txt", "w") as f:
+        f.write("file remote test data\n")
+
+    with os.popen("python sample_script.py") as f:
+        out = f.read()
+
+    assert "Tracking new file" in out
+
+    os.system("lazydata add-remote file://%s" % str(remote_dir))
+
+    with open("lazydata.yml", "r") as f:
+        config = f.read()
+
+    assert "remote: file://%s" % str(remote_dir) in config
+
+    os.system("lazydata push")
+
+    sha256 = "4985a4b21880a6629ed2a8e598f2cc2c02bbe3537af436f3e3f250475f89c166"
+    assert Path(remote_dir, "data", sha256[:2], sha256[2:]).exists()
+    assert Path(remote_dir, "data", sha256[:2], sha256[2:] + ".completed").exists()
+
+    # remove both the local copy and the cached copy, pull should restore them from the remote
+    shutil.rmtree("data/")
+    cached = Path(Path.home(), ".lazydata", "data", sha256[:2], sha256[2:])
+    cached.unlink()
+
+    os.system("lazydata pull")
+
+    assert cached.exists()
+    with open("data/some_data_file.txt", "r") as f:
+        assert f.read() == "file remote test data\n"
+
+    # teardown
+
+    os.chdir(cwd)
+
+
+def test_file_remote_empty_file():
+    """
+    Test pushing and pulling an empty file with a local filesystem remote
+
+    :return:
+    """
+
+    cwd = os.getcwd()
+
+    shutil.rmtree("tests/projects", ignore_errors=True)
+    os.mkdir("tests/projects")
+
+    shutil.copytree("tests/templates/sample-project", "tests/projects/file2")
+    remote_dir = Path("tests/projects/file2-remote").resolve()
+    remote_dir.mkdir()
+
+    os.chdir("tests/projects/file2")
+    os.system("lazydata init")
+
+    with open("data/some_data_file.txt", "w") as f:
+        pass
+
+    with os.popen("python sample_script.py") as f:
+        out = f.read()
+
+    assert "Tracking new file" in out
+
+    os.system("lazydata add-remote file://%s" % str(remote_dir))
+
+    assert os.system("lazydata push") == 0
+
+    sha256 = "e3b0c44298fc1c149afbf4c8996fb92427ae41e4649b934ca495991b7852b855"
+    assert Path(remote_dir, "data", sha256[:2], sha256[2:]).exists()
+    assert Path(remote_dir, "data", sha256[:2], sha256[2:] + ".completed").exists()
+
+    shutil.rmtree("data/")
+    cached = Path(Path.home(), ".lazydata", "data", sha256[:2], sha256[2:])
+    cached.unlink()
+
+    os.system("lazydata pull")
+
+    assert cached.exists()
+    assert Path("data/some_data_file.txt").stat().st_size == 0
+
+    # teardown
+
+    os.chdir(cwd)
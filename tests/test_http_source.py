@@ -0,0 +1,122 @@
+
+from http.server import BaseHTTPRequestHandler, HTTPServer
+import hashlib
+import shutil
+import os
+import subprocess
+import threading
+from pathlib import Path
+
+SOURCE_CONTENT = b"a,b\n1,2\n3,4\n"
+
+
+class SourceHandler(BaseHTTPRequestHandler):
+    """
+    Serves SOURCE_CONTENT with validators, like a static file server that doesn't allow HEAD requests
+    """
+    requests = []
+
+    def do_HEAD(self):
+        self.requests.append(("HEAD", dict(self.headers)))
+        self.send_response(405)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def do_GET(self):
+        self.requests.append(("GET", dict(self.headers)))
+        if self.headers.get("If-None-Match") == '"v1"':
+            self.send_response(304)
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header("Content-Length", str(len(SOURCE_CONTENT)))
+        self.send_header("ETag", '"v1"')
+        self.send_header("Last-Modified", "Mon, 01 Jan 2018 00:00:00 GMT")
+        self.end_headers()
+        self.wfile.write(SOURCE_CONTENT)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_server():
+    SourceHandler.requests = []
+    server = HTTPServer(("127.0.0.1", 0), SourceHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, "http://127.0.0.1:%d/data.csv" % server.server_port
+
+
+def test_source_url_without_head():
+    """
+    Test downloading a tracked file again from a source URL whose server rejects HEAD requests
+
+    :return:
+    """
+
+    cwd = os.getcwd()
+    server, url = start_server()
+
+    shutil.rmtree("tests/projects", ignore_errors=True)
+    os.mkdir("tests/projects")
+
+    shutil.copytree("tests/templates/sample-project", "tests/projects/source1")
+    home = Path("tests/projects/source1-home").resolve()
+    home.mkdir()
+    env = dict(os.environ, LAZYDATA_HOME=str(home))
+
+    try:
+        os.chdir("tests/projects/source1")
+        subprocess.run(["lazydata", "init"], env=env, check=True)
+
+        track = ["python", "-c", "import lazydata; lazydata.track('data/source.csv', '%s')" % url]
+        subprocess.run(track, env=env, check=True)
+
+        # remove both the local copy and the cached copy, it's downloaded again with a known hash
+        sha256 = hashlib.sha256(SOURCE_CONTENT).hexdigest()
+        os.unlink("data/source.csv")
+        Path(home, "data", sha256[:2], sha256[2:]).unlink()
+        subprocess.run(track, env=env, check=True)
+
+        with open("data/source.csv", "rb") as f:
+            assert f.read() == SOURCE_CONTENT
+        assert ("HEAD" in [method for method, _ in SourceHandler.requests])
+    finally:
+        server.shutdown()
+        os.chdir(cwd)
+
+
+def test_conditional_download():
+    """
+    Test that downloading a source URL again sends the validators of the last download and reuses the cached file
+    if the server answers 304 Not Modified
+
+    :return:
+    """
+    from lazydata.storage.downloader import get_downloader
+    from lazydata.storage.local import LocalStorage, SourceUrl
+
+    server, url = start_server()
+    try:
+        local = LocalStorage()
+        SourceUrl.delete().where(SourceUrl.url == url).execute()
+        downloader = get_downloader()
+        sha256 = hashlib.sha256(SOURCE_CONTENT).hexdigest()
+
+        assert downloader.download(local, url) == sha256
+        method, headers = SourceHandler.requests[-1]
+        assert method == "GET" and "If-None-Match" not in headers
+
+        assert downloader.download(local, url, sha256=sha256) == sha256
+        method, headers = SourceHandler.requests[-1]
+        assert headers["If-None-Match"] == '"v1"'
+        assert headers["If-Modified-Since"] == "Mon, 01 Jan 2018 00:00:00 GMT"
+
+        # without the cached file, there's nothing to reuse and the body is downloaded again
+        local.hash_to_file(sha256).unlink()
+        assert downloader.download(local, url) == sha256
+        method, headers = SourceHandler.requests[-1]
+        assert "If-None-Match" not in headers
+        assert local.hash_to_file(sha256).exists()
+        assert len(SourceHandler.requests) == 3
+    finally:
+        server.shutdown()
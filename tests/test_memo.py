@@ -0,0 +1,37 @@
+import json
+
+from lazydata.memo import reader_key
+
+SEPARATOR = ","
+
+
+def split_lines(path):
+    with open(path) as f:
+        return [line.split(SEPARATOR) for line in f]
+
+
+def test_reader_key():
+    """
+    Test that readers that would parse a file differently get different keys
+
+    :return:
+    """
+    global SEPARATOR
+
+    # the same bytecode, calling different functions
+    assert reader_key(lambda p: json.load(open(p))) != reader_key(lambda p: json.loads(open(p).read()))
+
+    # the difference is in a comprehension
+    assert reader_key(lambda p: [x + 1 for x in json.load(open(p))]) != \
+        reader_key(lambda p: [x + 2 for x in json.load(open(p))])
+
+    # the difference is in a global used by a helper
+    reader = lambda p: split_lines(p)
+    key = reader_key(reader)
+    assert key is not None
+    SEPARATOR = ";"
+    try:
+        assert reader_key(reader) != key
+    finally:
+        SEPARATOR = ","
+    assert reader_key(reader) == key
@@ -0,0 +1,102 @@
+
+import shutil
+import os
+import threading
+from pathlib import Path
+
+from lazydata.config.config import Config
+from lazydata.storage.local import LocalStorage, RemoteStat
+from lazydata.storage.remote import FileRemoteStorage, MirroredRemoteStorage, record_remote_stat, \
+    STAT_SMOOTHING
+
+
+def test_mirror_fallback():
+    """
+    Test that a download falls back to a mirror when the primary remote fails
+
+    :return:
+    """
+
+    cwd = os.getcwd()
+
+    shutil.rmtree("tests/projects", ignore_errors=True)
+    os.mkdir("tests/projects")
+
+    shutil.copytree("tests/templates/sample-project", "tests/projects/mirror1")
+    primary_dir = Path("tests/projects/mirror1-primary").resolve()
+    mirror_dir = Path("tests/projects/mirror1-mirror").resolve()
+    mirror_dir.mkdir()
+
+    os.chdir("tests/projects/mirror1")
+    try:
+        os.system("lazydata init")
+
+        with open("data/some_data_file.txt", "w") as f:
+            f.write("mirror test data\n")
+
+        with os.popen("python sample_script.py") as f:
+            f.read()
+
+        os.system("lazydata add-remote file://%s" % str(mirror_dir))
+        os.system("lazydata push")
+
+        # the primary has a corrupted copy of the file
+        shutil.copytree(str(mirror_dir), str(primary_dir))
+        config = Config(Path.cwd())
+        sha256 = config.config["files"][0]["hash"]
+        local = LocalStorage()
+        with open(str(Path(primary_dir, str(local.hash_to_remote_path(sha256)))), "w") as f:
+            f.write("corrupted\n")
+        local.hash_to_file(sha256).unlink()
+
+        primary = FileRemoteStorage("file://%s" % primary_dir)
+        mirror = FileRemoteStorage("file://%s" % mirror_dir)
+        remote = MirroredRemoteStorage(primary, [mirror])
+
+        # the primary looks like the fastest, so it's tried first
+        RemoteStat.delete().where(RemoteStat.url.in_([primary.url, mirror.url])).execute()
+        record_remote_stat(primary.url, latency=0.001)
+        record_remote_stat(mirror.url, latency=1.0)
+        assert remote.ranked(local, sha256) == [primary, mirror]
+
+        assert remote.download_to_local(config, local, sha256) == sha256
+        with open(str(local.hash_to_file(sha256)), "r") as f:
+            assert f.read() == "mirror test data\n"
+
+        primary_stat = RemoteStat.get(RemoteStat.url == primary.url)
+        mirror_stat = RemoteStat.get(RemoteStat.url == mirror.url)
+        assert primary_stat.failures == 1
+        assert mirror_stat.failures == 0
+        assert mirror_stat.throughput is not None
+    finally:
+        os.chdir(cwd)
+
+
+def test_remote_stat_concurrent():
+    """
+    Test that the samples recorded by concurrent downloads and probes are all counted
+
+    :return:
+    """
+    LocalStorage()
+    url = "file:///nonexistent/stat-test"
+    RemoteStat.delete().where(RemoteStat.url == url).execute()
+
+    def record_failures():
+        for _ in range(20):
+            record_remote_stat(url, failed=True)
+
+    threads = [threading.Thread(target=record_failures) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert RemoteStat.get(RemoteStat.url == url).failures == 160
+
+    record_remote_stat(url, latency=1.0)
+    record_remote_stat(url, latency=0.0)
+    stat = RemoteStat.get(RemoteStat.url == url)
+    assert stat.failures == 0
+    assert abs(stat.latency - (1 - STAT_SMOOTHING)) < 1e-9
+    assert stat.throughput is None
+    RemoteStat.delete().where(RemoteStat.url == url).execute()
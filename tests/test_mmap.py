@@ -0,0 +1,47 @@
+import shutil
+import os
+import subprocess
+from pathlib import Path
+
+MMAP_SCRIPT = """
+import lazydata
+
+with lazydata.mmap("data/some_data_file.txt") as m:
+    print(m[:])
+"""
+
+
+def test_mmap_not_in_cache():
+    """
+    Test mapping a tracked and unchanged file whose blob isn't in the local cache
+
+    :return:
+    """
+
+    cwd = os.getcwd()
+
+    shutil.rmtree("tests/projects", ignore_errors=True)
+    os.mkdir("tests/projects")
+    projects = Path("tests/projects").resolve()
+
+    shutil.copytree("tests/templates/sample-project", str(Path(projects, "mmap1")))
+    home = Path(projects, "mmap1-home")
+    env = dict(os.environ, LAZYDATA_HOME=str(home))
+
+    os.chdir(str(Path(projects, "mmap1")))
+    try:
+        subprocess.run(["lazydata", "init"], env=env, check=True)
+        with open("data/some_data_file.txt", "w") as f:
+            f.write("mapped data\n")
+        subprocess.run(["python", "sample_script.py"], env=env, check=True, stdout=subprocess.DEVNULL)
+
+        # the hash stays recorded for the workspace file, like after `lazydata watch`
+        shutil.rmtree(str(Path(home, "data")))
+
+        with open("mmap_script.py", "w") as f:
+            f.write(MMAP_SCRIPT)
+        out = subprocess.run(["python", "mmap_script.py"], env=env, check=True, stdout=subprocess.PIPE,
+                             universal_newlines=True).stdout
+        assert "mapped data" in out
+    finally:
+        os.chdir(cwd)
@@ -0,0 +1,53 @@
+import hashlib
+import shutil
+import os
+from pathlib import Path
+
+OUTPUT_SCRIPT = """
+import os
+import lazydata
+
+with lazydata.output("data/output.bin") as f:
+    f.write(b"written through the file\\n")
+    os.write(f.fileno(), b"written through the descriptor\\n")
+    f.write(b"written through the file again\\n")
+"""
+
+
+def test_output_fileno():
+    """
+    Test that an output file written through its file descriptor is tracked with the right hash
+
+    :return:
+    """
+
+    cwd = os.getcwd()
+
+    shutil.rmtree("tests/projects", ignore_errors=True)
+    os.mkdir("tests/projects")
+
+    shutil.copytree("tests/templates/sample-project", "tests/projects/output1")
+
+    os.chdir("tests/projects/output1")
+    try:
+        os.system("lazydata init")
+
+        with open("output_script.py", "w") as f:
+            f.write(OUTPUT_SCRIPT)
+        assert os.system("python output_script.py") == 0
+
+        with open("data/output.bin", "rb") as f:
+            content = f.read()
+        assert content == b"written through the file\nwritten through the descriptor\nwritten through the file again\n"
+        sha256 = hashlib.sha256(content).hexdigest()
+
+        with open("lazydata.yml", "r") as f:
+            config = f.read()
+
+        assert "hash: %s" % sha256 in config
+
+        cached = Path(Path.home(), ".lazydata", "data", sha256[:2], sha256[2:])
+        with open(str(cached), "rb") as f:
+            assert f.read() == content
+    finally:
+        os.chdir(cwd)
@@ -0,0 +1,130 @@
+
+import json
+import shutil
+import os
+import subprocess
+import urllib.error
+import urllib.request
+from pathlib import Path
+
+NUM_FILES = 6
+
+
+def start_peer(env):
+    """
+    Start `lazydata peer` on a free port
+
+    :return: tuple of the process and its `host:port`
+    """
+    process = subprocess.Popen(["lazydata", "peer", "--host", "127.0.0.1", "--port", "0"], env=env,
+                               stdout=subprocess.PIPE, universal_newlines=True)
+    line = process.stdout.readline()
+    assert "Serving the local cache" in line
+    return process, line.split()[-1]
+
+
+def remote_downloads(metrics_path):
+    """
+    Count the files downloaded from the remote, by all the processes writing to the metrics file
+    """
+    with open(metrics_path) as f:
+        events = [json.loads(line) for line in f]
+    return sum(1 for e in events if e["type"] == "stage" and e["name"] == "download" and not e["failed"])
+
+
+def counter(metrics_path, name):
+    with open(metrics_path) as f:
+        events = [json.loads(line) for line in f]
+    return sum(e["value"] for e in events if e["type"] == "counter" and e["name"] == name)
+
+
+def test_peers():
+    """
+    Test sharing the local caches of two nodes, with a process per node, over a single remote
+
+    :return:
+    """
+
+    cwd = os.getcwd()
+
+    shutil.rmtree("tests/projects", ignore_errors=True)
+    os.mkdir("tests/projects")
+    projects = Path("tests/projects").resolve()
+
+    shutil.copytree("tests/templates/sample-project", str(Path(projects, "peers1")))
+    remote_dir = Path(projects, "peers1-remote")
+    remote_dir.mkdir()
+    metrics_path = str(Path(projects, "peers1-metrics.jsonl"))
+
+    def node_env(name, **kwargs):
+        return dict(os.environ, LAZYDATA_HOME=str(Path(projects, name + "-home")), LAZYDATA_METRICS=metrics_path,
+                    PYTHONUNBUFFERED="1", LAZYDATA_PEER_TOKEN="peers1-token", **kwargs)
+
+    os.chdir(str(Path(projects, "peers1")))
+    servers = []
+    try:
+        env = node_env("origin")
+        subprocess.run(["lazydata", "init"], env=env, check=True)
+        subprocess.run(["lazydata", "add-remote", "file://%s" % remote_dir], env=env, check=True)
+        contents = {}
+        for i in range(NUM_FILES):
+            path = "data/peer_file_%d.bin" % i
+            contents[path] = os.urandom(100000 + i)
+            with open(path, "wb") as f:
+                f.write(contents[path])
+            subprocess.run(["python", "-c", "import lazydata; lazydata.track('%s')" % path], env=env, check=True)
+        subprocess.run(["lazydata", "push"], env=env, check=True, stdout=subprocess.DEVNULL)
+        os.unlink(metrics_path)
+
+        def check_workspace():
+            for path, content in contents.items():
+                with open(path, "rb") as f:
+                    assert f.read() == content
+
+        # two nodes, each with a peer serving its cache
+        server_a, address_a = start_peer(node_env("a"))
+        server_b, address_b = start_peer(node_env("b"))
+        servers = [server_a, server_b]
+        peers = "%s,%s" % (address_a, address_b)
+
+        # the blobs are only served to the peers with the token
+        try:
+            urllib.request.urlopen("http://%s/blobs/%s" % (address_a, "0" * 64))
+            assert False, "served without the token"
+        except urllib.error.HTTPError as e:
+            assert e.code == 403
+
+        # and without a token, only on the loopback interface
+        env = dict(node_env("a"), LAZYDATA_PEER_TOKEN="")
+        assert subprocess.run(["lazydata", "peer", "--host", "0.0.0.0", "--port", "0"], env=env,
+                              stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL).returncode != 0
+
+        for name, address in (("a", address_a), ("b", address_b)):
+            shutil.rmtree("data/")
+            os.mkdir("data")
+            subprocess.run(["lazydata", "pull"], env=node_env(name, LAZYDATA_PEERS=peers, LAZYDATA_PEER_ADDRESS=address),
+                           check=True, stdout=subprocess.DEVNULL)
+            check_workspace()
+
+        # each file was downloaded from the remote once, by the peer that owns it
+        assert remote_downloads(metrics_path) == NUM_FILES
+        assert counter(metrics_path, "peer_hit") == NUM_FILES
+
+        # a peer serving corrupted files is not trusted, they are downloaded from the remote instead
+        for blob in Path(projects, "a-home", "data").glob("*/*"):
+            os.chmod(str(blob), 0o644)
+            with open(str(blob), "r+b") as f:
+                f.write(b"corrupted")
+
+        shutil.rmtree("data/")
+        os.mkdir("data")
+        subprocess.run(["lazydata", "pull"], env=node_env("c", LAZYDATA_PEERS=address_a),
+                       check=True, stdout=subprocess.DEVNULL)
+        check_workspace()
+        assert counter(metrics_path, "peer_corrupted") == NUM_FILES
+        assert remote_downloads(metrics_path) == 2 * NUM_FILES
+    finally:
+        for server in servers:
+            server.terminate()
+            server.wait()
+        os.chdir(cwd)
@@ -0,0 +1,44 @@
+import hashlib
+import os
+
+from lazydata.storage.local import LocalStorage
+from lazydata.storage.remote_file import BLOCK_SIZE, RemoteFile
+
+
+def test_remote_file_stale_state():
+    """
+    Test that a block map left behind by a completed read is not trusted for a new blocks file
+
+    :return:
+    """
+    content = os.urandom(3 * BLOCK_SIZE + 5)
+    sha256 = hashlib.sha256(content).hexdigest()
+    fetch_range = lambda start, end: [content[start:end + 1]]
+
+    local = LocalStorage()
+
+    # a reader caches the first block
+    first = RemoteFile(local, sha256, len(content), fetch_range)
+    first.read(10)
+    with open(str(first.state_path)) as f:
+        stale_state = f.read()
+
+    # another reader reads it all, the file is moved into the cache
+    second = RemoteFile(local, sha256, len(content), fetch_range)
+    assert second.readall() == content
+    assert not second.state_path.exists()
+    second.close()
+
+    # the first one saves its state late
+    first._save_state()
+    assert not first.state_path.exists()
+    first.close()
+
+    # the map of the moved blocks file is still around when the file is read again
+    local.hash_to_file(sha256).unlink()
+    with open(str(first.state_path), "w") as f:
+        f.write(stale_state)
+
+    third = RemoteFile(local, sha256, len(content), fetch_range)
+    assert third.readall() == content
+    third.close()
@@ -0,0 +1,206 @@
+import hashlib
+import json
+import shutil
+import os
+import subprocess
+from pathlib import Path
+
+from lazydata.storage.compression import CODECS, CompressingReader, decompress_stream, \
+    zstandard_available
+
+
+def text_content(size, seed=0):
+    """
+    Deterministic text of exactly `size` bytes, with lines for the chunk boundaries to fall on
+    """
+    lines = []
+    total = 0
+    i = 0
+    while total < size:
+        line = ("%d %s\n" % (i, hashlib.sha256(("%d-%d" % (seed, i)).encode("utf-8")).hexdigest())).encode("utf-8")
+        lines.append(line)
+        total += len(line)
+        i += 1
+    return b"".join(lines)[:size]
+
+
+def round_trip(name, remote_args, contents):
+    """
+    Push files to a new file:// remote, then pull them into a fresh LAZYDATA_HOME and check their content
+
+    :param name: name of the test project
+    :param remote_args: extra arguments of `lazydata add-remote`
+    :param contents: dict of path in the project -> content
+    :return: Path of the remote
+    """
+
+    cwd = os.getcwd()
+
+    shutil.rmtree("tests/projects", ignore_errors=True)
+    os.mkdir("tests/projects")
+    projects = Path("tests/projects").resolve()
+
+    shutil.copytree("tests/templates/sample-project", str(Path(projects, name)))
+    remote_dir = Path(projects, name + "-remote")
+    remote_dir.mkdir()
+
+    def home_env(home):
+        return dict(os.environ, LAZYDATA_HOME=str(Path(projects, "%s-%s-home" % (name, home))))
+
+    os.chdir(str(Path(projects, name)))
+    try:
+        env = home_env("push")
+        subprocess.run(["lazydata", "init"], env=env, check=True)
+        subprocess.run(["lazydata", "add-remote", "file://%s" % remote_dir] + remote_args, env=env, check=True)
+        for path, content in contents.items():
+            with open(path, "wb") as f:
+                f.write(content)
+            subprocess.run(["python", "-c", "import lazydata; lazydata.track('%s')" % path], env=env, check=True)
+        subprocess.run(["lazydata", "push"], env=env, check=True, stdout=subprocess.DEVNULL)
+
+        shutil.rmtree("data/")
+        subprocess.run(["lazydata", "pull"], env=home_env("pull"), check=True, stdout=subprocess.DEVNULL)
+
+        for path, content in contents.items():
+            with open(path, "rb") as f:
+                assert hashlib.sha256(f.read()).hexdigest() == hashlib.sha256(content).hexdigest(), path
+    finally:
+        os.chdir(cwd)
+
+    return remote_dir
+
+
+def test_compression_codecs():
+    """
+    Test that the compressed stream of a file decompresses to the same content
+
+    :return:
+    """
+
+    shutil.rmtree("tests/projects", ignore_errors=True)
+    os.mkdir("tests/projects")
+
+    names = ["gzip"]
+    if zstandard_available():
+        names.append("zstd")
+
+    for name in names:
+        for size in [0, 1, 1024 * 1024 + 1]:
+            content = text_content(size)
+            path = "tests/projects/codec-%s-%d.txt" % (name, size)
+            with open(path, "wb") as f:
+                f.write(content)
+
+            with CompressingReader(path, CODECS[name]) as reader:
+                compressed = reader.read()
+            if size > 1024:
+                assert len(compressed) < size
+
+            # decompressed from small pieces, like a network stream
+            pieces = [compressed[i:i + 1000] for i in range(0, len(compressed), 1000)]
+            assert b"".join(decompress_stream(pieces, name)) == content
+
+
+def test_compression_round_trip():
+    """
+    Test pushing and pulling with compression enabled, including an empty and an incompressible file
+
+    :return:
+    """
+
+    round_trip("compression1", ["--compression", "gzip"], {
+        "data/empty.txt": b"",
+        "data/text.txt": text_content(300000),
+        "data/archive.gz": os.urandom(5000),
+    })
+
+
+def test_pack_round_trip():
+    """
+    Test pushing and pulling files bundled into packs, including an empty file and files around the threshold
+
+    :return:
+    """
+
+    remote_dir = round_trip("pack1", ["--pack", "4096"], {
+        "data/empty.txt": b"",
+        "data/small.txt": text_content(100, seed=1),
+        "data/under.txt": text_content(4095, seed=2),
+        "data/over.txt": text_content(4097, seed=3),
+    })
+
+    packs = list(Path(remote_dir, "packs").glob("*.pack"))
+    assert len(packs) == 1
+    # only the file over the threshold is stored on its own
+    assert len(list(Path(remote_dir, "data").glob("*/*.completed"))) == 1
+
+
+def test_chunk_round_trip():
+    """
+    Test pushing and pulling files stored in chunks, including an empty file and files around the threshold
+
+    :return:
+    """
+
+    threshold = 1000000
+    over = text_content(threshold + 1, seed=4)
+    remote_dir = round_trip("chunk1", ["--chunk", str(threshold)], {
+        "data/empty.txt": b"",
+        "data/under.txt": text_content(threshold - 1, seed=5),
+        "data/over.txt": over,
+        # a new version of the file, it shares the chunks after the edit
+        "data/over_edited.txt": b"edited\n" + over,
+    })
+
+    manifests = list(Path(remote_dir, "manifests").glob("*.json"))
+    assert len(manifests) == 2
+    assert len(list(Path(remote_dir, "data").glob("*/*.completed"))) == 2
+
+    listed = 0
+    for manifest in manifests:
+        with open(str(manifest)) as f:
+            listed += len(json.load(f)["chunks"])
+    # the versions share chunks in the remote
+    assert len(list(Path(remote_dir, "chunks").iterdir())) < listed
+
+
+def test_chunk_push_without_old_versions():
+    """
+    Test pushing from a cache that only has the latest version of a file, as it's the only one pulled
+
+    :return:
+    """
+
+    shutil.rmtree("tests/projects", ignore_errors=True)
+    os.mkdir("tests/projects")
+    projects = Path("tests/projects").resolve()
+    remote_dir = Path(projects, "chunk2-remote")
+    remote_dir.mkdir()
+
+    cwd = os.getcwd()
+    shutil.copytree("tests/templates/sample-project", str(Path(projects, "chunk2")))
+    os.chdir(str(Path(projects, "chunk2")))
+    try:
+        def write_and_track(env, content):
+            with open("data/versions.txt", "wb") as f:
+                f.write(content)
+            subprocess.run(["python", "-c", "import lazydata; lazydata.track('data/versions.txt')"], env=env,
+                           check=True)
+
+        env = dict(os.environ, LAZYDATA_HOME=str(Path(projects, "chunk2-first-home")))
+        subprocess.run(["lazydata", "init"], env=env, check=True)
+        subprocess.run(["lazydata", "add-remote", "file://%s" % remote_dir, "--chunk", "1000"], env=env, check=True)
+        write_and_track(env, text_content(2000, seed=6))
+        write_and_track(env, text_content(200, seed=7))
+        subprocess.run(["lazydata", "push"], env=env, check=True, stdout=subprocess.DEVNULL)
+
+        env = dict(os.environ, LAZYDATA_HOME=str(Path(projects, "chunk2-second-home")))
+        shutil.rmtree("data/")
+        subprocess.run(["lazydata", "pull"], env=env, check=True, stdout=subprocess.DEVNULL)
+        write_and_track(env, text_content(300, seed=8))
+        subprocess.run(["lazydata", "push"], env=env, check=True, stdout=subprocess.DEVNULL)
+    finally:
+        os.chdir(cwd)
+
+    assert len(list(Path(remote_dir, "manifests").glob("*.json"))) == 1
+    assert len(list(Path(remote_dir, "data").glob("*/*.completed"))) == 2